@@ -26,7 +26,8 @@ def create_app(config_class=Config):
     app.template_folder = config_class.TEMPLATE_FOLDER_MAIN
 
     db.init_app(app)
-    migrate.init_app(app,db)
+    from app.main.search import include_in_migrations
+    migrate.init_app(app,db, include_name=include_in_migrations)
     login.init_app(app)
     moment.init_app(app)
 
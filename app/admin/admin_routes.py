@@ -1,4 +1,4 @@
-import math
+import hashlib
 import re
 from tokenize import String
 
@@ -6,17 +6,55 @@ from app.admin import admin_blueprint as bp_admin
 import datetime
 import time
 from datetime import timedelta, timezone
-from flask import redirect, url_for, flash, jsonify, request
+from flask import redirect, url_for, flash, jsonify, request, Response
 import sqlalchemy as sqla
 from flask_login import current_user
 import json
 from sqlalchemy import or_, join, and_
 
 from app import db, ms_login, get_nav_pages, moment
-from app.main.models import User, Bike, Station, Ride, Location, Location, Report, Fleet
+from app.main.models import User, Bike, Station, Ride, Report, Fleet, TableVersion
 from app.admin.admin_forms import UserSortForm, BikeSortForm, FleetEditForm, StationEditForm, StationDeleteForm, ReportSortForm, MessagingForm
 from app.main.forms import SetLockForm, EndRentalForm
+from app.main.map_details import get_bike_map_details, get_station_map_details
+from app.main.geo import simplify_path, encode_polyline, METERS_PER_MILE
 from app.main.routes import render_template
+from app.admin.pagination import paginate
+from app.main.events import event_stream_response, publish_event
+from app.main.search import search_condition
+
+# the orders each admin table can be sorted in, see paginate. Each ends in the table's primary key
+RIDE_ORDERS = {'date': (Ride.ride_date, Ride.bike_id, Ride.user_id),
+               'user': (User.name, Ride.ride_date, Ride.bike_id, Ride.user_id),
+               'bike': (Bike.name, Ride.ride_date, Ride.bike_id, Ride.user_id),
+               'distance': (Ride.distance, Ride.ride_date, Ride.bike_id, Ride.user_id)}
+REPORT_ORDERS = {'date': (Report.timestamp, Report.bike_id, Report.user_id),
+                 'user': (User.name, Report.timestamp, Report.bike_id, Report.user_id),
+                 'bike': (Bike.name, Report.timestamp, Report.bike_id, Report.user_id)}
+USER_ORDERS = {'name': (User.name, User.id),
+               'email': (User.email, User.id)}
+
+# the fields every admin table is ordered by, see paginate. limit and cursor only pick a page of the same rows
+ORDER_FIELDS = ('sort', 'descending')
+
+def table_version(tables, data, filters, *extra):
+    """A version token for one view of the admin tables, which changes whenever the tables it reads from, the request's
+    filters and order or anything in extra change. Every page of a view shares it. Costs one small query instead of
+    the table's"""
+    key = [TableVersion.get_versions(tables), {field: data.get(field) for field in filters + ORDER_FIELDS}, extra]
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+def unchanged(version, data):
+    # the token can come back as the since field or as an If-None-Match ETag
+    if data.get('since') != version and version not in request.if_none_match:
+        return None
+    response = Response(status=304)
+    response.set_etag(version)
+    return response
+
+def versioned(response, version):
+    response.set_etag(version)
+    return response
 
 def admin_required(func):
     def wrapper(*args, **kwargs):
@@ -50,12 +88,18 @@ def filter_admin_rides():
     my_date = data['date'] #how many days old of dates to accept
     overtime = data['overtime'] #boolean
     comp_data = int(data['completed']) == 1 #integer
-    results = sqla.select(Ride).join(User).join(Bike).where(Ride.completed_ride == comp_data)
-    results = db.session.scalars(results
-                                 .where(
-                                    or_(User.name.contains(search_data),
-                                        User.email.contains(search_data),
-                                        Bike.name.contains(search_data)))
+    # ongoing durations and the date window move with the clock, so the rides table is rebuilt at least once a minute
+    version = table_version(('ride', 'user', 'bike'), data, ('search', 'date', 'overtime', 'completed'),
+                            int(time.time() // 60))
+    response = unchanged(version, data)
+    if response is not None:
+        return response
+    # only the columns the table shows are loaded, so the rows come back in one query with no lazy loads
+    results = (sqla.select(Ride.bike_id, Ride.ride_date, Ride.duration, Ride.distance, Ride.positive_rating,
+                           User.name.label('user_name'), User.email.label('user_email'), Bike.name.label('bike_name'))
+               .join(User).join(Bike).where(Ride.completed_ride == comp_data))
+    results = (results
+                                 .where(search_condition(search_data, users=True, bikes=True))
                                  .where(
                                     or_(Ride.ride_date >= datetime.datetime.now(timezone.utc) - datetime.timedelta(days=int(my_date)),
                                         int(my_date) == 0))
@@ -63,8 +107,11 @@ def filter_admin_rides():
                                     and_(comp_data == True,
                                         Ride.duration >= datetime.timedelta(hours=12)),
                                     and_(comp_data == False,
-                                        Ride.ride_date <= datetime.datetime.now(timezone.utc) - datetime.timedelta(hours=12))))
-                                .order_by(Ride.ride_date)).all()
+                                        Ride.ride_date <= datetime.datetime.now(timezone.utc) - datetime.timedelta(hours=12)))))
+    try:
+        results, next_cursor = paginate(results, RIDE_ORDERS, data, 'date')
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
     result = []
     
 
@@ -74,47 +121,85 @@ def filter_admin_rides():
         hours, seconds = divmod(ride_duration.seconds + (ride_duration.days*86400), 3600)
         the_duration = (str(hours) + " hours, " if hours > 0 else "") + str(round(seconds/60)) + " minutes"
         end_time = r.ride_date + ride_duration
-        result.append({'user_name': r.user.get_first_name(),
+        result.append({'user_name': User.first_name(r.user_name),
                     'bike_id': r.bike_id,
                     'timestamp': re.sub(r"0(?=.:)", "", r.ride_date.strftime("%b %-d, %Y at %I:%M %p")),
                     'start_time' : r.ride_date.isoformat(),
                     'end_time' : end_time.isoformat(),
-                    'user_email': r.user.get_email(),
-                    'bike': r.bike.get_name(),
+                    'user_email': r.user_email,
+                    'bike': r.bike_name,
                     'duration': str(the_duration).split('.', 2)[0],
+                    'distance': round((r.distance or 0) / METERS_PER_MILE, 2),
                     'pos_rating': r.positive_rating})
     
-    # overview data
-    num_reports = len(db.session.scalars(sqla.select(Report).where(Report.completed == False)).all())
-    num_trips = len(db.session.scalars(sqla.select(Ride).join(Bike).where(Bike.available == True).where(Ride.completed_ride == False)).all())
-    broken = db.session.scalars(sqla.select(Bike.name).select_from(join(Bike, Report)).distinct()).all()
-    rides_month = len(db.session.scalars(sqla.select(Ride).where(Ride.ride_date > datetime.datetime.now(timezone.utc) - datetime.timedelta(days=30))).all())
-    reports_month = len(db.session.scalars(sqla.select(Report).where(Report.timestamp > datetime.datetime.now() - datetime.timedelta(days=30))).all())
-    bikes_out = len(db.session.scalars(sqla.select(Bike).where(Bike.available == False)).all())
-
-    return jsonify({
-        'message': "success", 'result': result, 'num_reports': num_reports,
-        'num_trips': num_trips, 'broken_bikes': broken, 'rides_month': rides_month,
-        'reports_month': reports_month, 'bikes_out': bikes_out
-    })
+    return versioned(jsonify({'message': "success", 'result': result, 'next_cursor': next_cursor, 'version': version}), version)
+
+def get_overview_counts():
+    # each table is counted in a one row subquery, and the three rows are joined so all the counters come back in one query
+    month_ago = datetime.datetime.now(timezone.utc) - datetime.timedelta(days=30)
+    reports = sqla.select(sqla.func.count().filter(Report.completed == False).label('num_reports'),
+                          sqla.func.count().filter(Report.timestamp > month_ago).label('reports_month')).subquery()
+    rides = (sqla.select(sqla.func.count().filter(and_(Ride.completed_ride == False, Bike.available == True)).label('num_trips'),
+                         sqla.func.count().filter(Ride.ride_date > month_ago).label('rides_month'))
+             .select_from(Ride).join(Bike)).subquery()
+    bikes = sqla.select(sqla.func.count().filter(Bike.available == False).label('bikes_out')).subquery()
+    one_row = reports.join(rides, sqla.true()).join(bikes, sqla.true())
+    return db.session.execute(sqla.select(reports, rides, bikes).select_from(one_row)).one()._asdict()
+
+@bp_admin.route('/admin/overview', methods=['GET'])
+@admin_required
+def get_overview():
+    overview = get_overview_counts()
+    overview['broken_bikes'] = db.session.scalars(sqla.select(Bike.name).select_from(join(Bike, Report)).distinct()).all()
+    response = jsonify(dict(overview, message="success"))
+    # the dashboard only needs to be as fresh as the page's polling interval
+    response.headers['Cache-Control'] = 'private, max-age=15'
+    return response
+
+@bp_admin.route('/admin/events')
+@admin_required
+def events():
+    # the admin pages' stream, which also carries the admin only events
+    return event_stream_response(admin=True)
 
 @bp_admin.route('/admin/rides/path', methods=['POST'])
 @admin_required
 def get_ride_path():
     data = request.get_json()
     bike_id = int(data['bike_id'])
-    start_time = int(datetime.datetime.fromisoformat(data['start_time']).timestamp())
-    end_time = int(datetime.datetime.fromisoformat(data['end_time']).timestamp()) + 18900 # Add 15 minutes to end time to account for tag ping time
     location_icon = url_for('static', filename='pins/location.svg')
-    locations = db.session.scalars(sqla.select(Location)
-                                   .where(Location.bike_id == bike_id)
-                                   .where(Location.timestamp >= start_time)
-                                   .where(Location.timestamp <= end_time)
-                                   .order_by(Location.timestamp)).all()
-    for location in locations: print(datetime.datetime.fromtimestamp(location.timestamp))
-    location_list = list(map(lambda x: x.get_coords(), locations))
-    distance = round(sum([math.sqrt((y[0] - x[0])**2 + (y[1] - x[1])**2) for x, y in zip(location_list[:-1], location_list[1:])]) * 60, 2)
-    return jsonify({'message':'success', 'path':location_list, 'location_icon':location_icon, 'distance':distance})
+    # detail smaller than tolerance meters is dropped, and max_points caps how many points are sent back. Every path,
+    # stored or built, is already simplified at Ride.PATH_TOLERANCE, so a finer tolerance gives back that same path
+    try:
+        tolerance = Ride.PATH_TOLERANCE if data.get('tolerance') is None else float(data['tolerance'])
+        max_points = int(data['max_points']) if data.get('max_points') is not None else None
+        if tolerance < 0 or (max_points is not None and max_points < 2):
+            raise ValueError('tolerance must be at least 0 and max_points at least 2')
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+
+    # completed rides have their path and distance stored when they end
+    ride = db.session.scalar(sqla.select(Ride)
+                             .where(Ride.bike_id == bike_id)
+                             .where(Ride.ride_date == datetime.datetime.fromisoformat(data['start_time'])))
+    if ride is not None and ride.path is not None:
+        path, distance = ride.path, ride.distance
+    else:
+        if ride is not None:
+            start_time, end_time = ride.get_time_window()
+        else:
+            # ride times are stored in UTC without a timezone
+            start_time = int(datetime.datetime.fromisoformat(data['start_time']).replace(tzinfo=timezone.utc).timestamp())
+            end_time = int(datetime.datetime.fromisoformat(data['end_time']).replace(tzinfo=timezone.utc).timestamp()) + Ride.PATH_PADDING
+        path, distance = Ride.build_path(bike_id, start_time, end_time)
+
+    path = simplify_path(path, tolerance, max_points)
+    response = {'message':'success', 'location_icon':location_icon, 'distance':round(distance / METERS_PER_MILE, 2), 'points':len(path)}
+    if data.get('encoding') == 'polyline':
+        response['polyline'] = encode_polyline(path)
+    else:
+        response['path'] = path
+    return jsonify(response)
 
 @bp_admin.route('/admin/fleet', methods=['GET', 'POST'])
 @admin_required
@@ -220,13 +305,9 @@ def assets():
 @bp_admin.route('/admin/assets/mapDetails', methods=['POST'])
 @admin_required
 def get_map_details():
-    # Get all bikes that have a location in a list
-    bikes = db.session.scalars(sqla.select(Bike)).all()
-    bike_list = [bike.get_details() if bike.get_current_location() else {} for bike in bikes]
-
-    # Get all stations in a list
-    stations = db.session.scalars(sqla.select(Station)).all()
-    station_list = [station.get_details() for station in stations]
+    # Get all bikes, including unavailable and rented ones, and all stations
+    bike_list = get_bike_map_details(public=False)
+    station_list = get_station_map_details()
 
     pin_red = url_for('static', filename='pins/pin_red.svg')
     pin_white = url_for('static', filename='pins/pin0.svg')
@@ -250,31 +331,40 @@ def filter_admin_reports():
     search_data = data['search']
     cat_data = data['category']
     comp_data = int(data['completed']) == 1
-    results = db.session.scalars(sqla.select(Report)
-                                 .join(User).join(Bike)
-                                 .where(Report.completed == comp_data)
-                                 .where(or_(Report.category == cat_data, cat_data == '0'))
-                                 .where(or_(User.name.contains(search_data),
-                                                        User.email.contains(search_data),
-                                                        Bike.name.contains(search_data)))
-                                 ).all()
+    version = table_version(('report', 'user', 'bike'), data, ('search', 'category', 'completed'))
+    response = unchanged(version, data)
+    if response is not None:
+        return response
+    results = (sqla.select(Report.bike_id, Report.user_id, Report.timestamp, Report.category,
+                           Report.description, Report.completed, User.name.label('user_name'),
+                           User.email.label('user_email'), Bike.name.label('bike_name'), Bike.available)
+               .join(User).join(Bike)
+               .where(Report.completed == comp_data)
+               .where(or_(Report.category == cat_data, cat_data == '0'))
+               .where(search_condition(search_data, users=True, bikes=True, reports=True)))
+    try:
+        results, next_cursor = paginate(results, REPORT_ORDERS, data, 'date')
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
     result = []
     
     for r in results:
-        result.append({'name': r.user.get_first_name(),
+        result.append({'name': User.first_name(r.user_name),
                     'bike_id': r.bike_id,
                     'user_id': r.user_id,
                     'timestamp': r.timestamp.isoformat(),
-                    'email': r.user.get_email(),
-                    'bike': r.bike.get_name(),
+                    'email': r.user_email,
+                    'bike': r.bike_name,
                     'cat': r.category,
                     'desc': r.description,
                     'comp': r.completed,
-                    'avail': r.bike.available})
-    return jsonify({
+                    'avail': r.available})
+    return versioned(jsonify({
         'message': "success",
-        'result': result
-    })
+        'result': result,
+        'next_cursor': next_cursor,
+        'version': version
+    }), version)
 
 @bp_admin.route('/admin/reports/toggle/bike', methods=['POST'])
 @admin_required
@@ -283,6 +373,7 @@ def report_toggle_bike_availability():
     the_bike = db.session.get(Bike, the_bike_id)
     the_bike.available = False if the_bike.available else True
     db.session.add(the_bike)
+    publish_event('bike', {'bike_id': the_bike.id, 'locked': the_bike.locked, 'available': the_bike.available, 'station_id': the_bike.station_id})
     db.session.commit()
 
     return jsonify({'message': 'success', 'available': the_bike.available})
@@ -297,6 +388,7 @@ def report_toggle_report_completion():
     the_report = db.session.scalars(sqla.select(Report).where(Report.user_id == the_user_id).where(Report.bike_id == the_bike_id).where(Report.timestamp == the_timestamp)).first()
     the_report.completed = False if the_report.completed else True
     db.session.add(the_report)
+    publish_event('report', {'bike_id': the_report.bike_id, 'category': the_report.category}, admin=True)
     db.session.commit()
 
     return jsonify({'message': 'completion toggled'}) 
@@ -314,33 +406,33 @@ def filter_admin_users():
     search_data = data['search']
     is_admin = data['admin']
     is_banned = data['banned']
-    results = db.session.scalars(sqla.select(User))
-    print(is_banned)
-    print(search_data)
-    if search_data == "":
-        results = sqla.select(User)
-    else:
-        results = sqla.select(User).where(or_(
-            User.name.contains(search_data),
-            User.email.contains(search_data)))
+    version = table_version(('user',), data, ('search', 'admin', 'banned'))
+    response = unchanged(version, data)
+    if response is not None:
+        return response
+    results = sqla.select(User.id, User.name, User.email, User.is_admin, User.locked,
+                          User.notification_endpoint, User.notification_p256dh_key, User.notification_auth_key)
+    results = results.where(search_condition(search_data, users=True))
     results = results.where(or_(is_banned == False, User.locked == is_banned)).where(or_(is_admin == False, User.is_admin == is_admin))
-    results = results.order_by(User.name)
-    results = db.session.scalars(results).all()
-    for r in results:
-        print(r)
+    try:
+        results, next_cursor = paginate(results, USER_ORDERS, data, 'name')
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
     result = []
     
     for r in results:
-        result.append({'name': r.get_first_name(),
-                    'user_id': r.get_id(),
-                    'email': r.get_email(),
+        result.append({'name': User.first_name(r.name),
+                    'user_id': r.id,
+                    'email': r.email,
                     'admin': r.is_admin,
                     'banned': r.locked,
-                    'subscribed': r.has_notification_keys()})
-    return jsonify({
+                    'subscribed': User.notification_keys_set(r.notification_endpoint, r.notification_p256dh_key, r.notification_auth_key)})
+    return versioned(jsonify({
         'message': "success",
-        'result': result
-    })
+        'result': result,
+        'next_cursor': next_cursor,
+        'version': version
+    }), version)
 
 @bp_admin.route('/admin/users/toggle/admin', methods=['GET', 'POST'])
 @admin_required
@@ -370,33 +462,29 @@ def messaging():
     form = MessagingForm()
 
     if form.validate_on_submit():
-        no_keys = 0
-        success = 0
-        fail = 0
-
         recipients = form.recipients.data
 
         if form.recipients_all.data:
-            recipients = db.session.scalars(sqla.select(User)).all()
-
-        for recipient in recipients:
-            if recipient.has_notification_keys():
-                if not form.mock.data and recipient.send_notification(json.dumps(dict(title=form.subject.data, body=form.body.data))):
-                    success += 1
-                else:
-                    fail += 1
-            else:
-                no_keys += 1
-        
-        if success == 0 and fail == 0 and no_keys == 0:
+            # only the columns a push needs, not every user's whole row
+            recipients = db.session.execute(sqla.select(User.id, User.notification_endpoint,
+                                                        User.notification_p256dh_key, User.notification_auth_key)).all()
+
+        if not recipients:
             flash("No recipients selected")
             return render_template('messaging.html',
                 title="Messaging",
                 form = form)
         
         if form.mock.data:
+            no_keys = sum(1 for recipient in recipients if not User.notification_keys_set(
+                recipient.notification_endpoint, recipient.notification_p256dh_key, recipient.notification_auth_key))
             return jsonify(dict(recipients=list(map(lambda u : u.id, recipients)), no_keys=no_keys))
         
+        results = User.send_notifications(recipients, json.dumps(dict(title=form.subject.data, body=form.body.data)))
+        success = sum(1 for result in results if result.status == 'sent')
+        no_keys = sum(1 for result in results if result.status == 'no_keys')
+        fail = len(results) - success - no_keys
+
         flash("Notified {} users ({} failed, {} not subscribed)".format(success, fail, no_keys))
 
     return render_template('messaging.html',
@@ -0,0 +1,69 @@
+import base64
+import binascii
+import datetime
+import json
+
+import sqlalchemy as sqla
+
+from app import db
+
+# Keyset pagination for the admin tables. Each table names the orders it can be sorted in, every order being a
+# tuple of columns that ends in the table's primary key so no two rows share a position. A page is the first
+# limit rows after the cursor, which holds the sort key of the last row sent, so every page costs the same no
+# matter how deep into the history it is
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(sort, descending, values):
+    values = [{'datetime': value.isoformat()} if isinstance(value, datetime.datetime) else value for value in values]
+    token = json.dumps([sort, descending, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Returns the (sort, descending, values) a cursor was made from, raises ValueError for anything else"""
+    try:
+        sort, descending, values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    return sort, descending, [datetime.datetime.fromisoformat(value['datetime']) if isinstance(value, dict) else value
+                              for value in values]
+
+def paginate(query, orders, data, default):
+    """Runs one page of query. orders maps each sort name to its columns, and data is the request's json with the
+    optional sort, descending, limit and cursor fields. Returns (rows, next cursor or None on the last page),
+    raises ValueError for an unknown sort, a bad limit or a cursor from a different sort"""
+    sort = data.get('sort') or default
+    descending = data.get('descending', False)
+    if sort not in orders:
+        raise ValueError("Unknown sort {}".format(sort))
+    # only json true and false, a string like "false" would otherwise be truthy
+    if not isinstance(descending, bool):
+        raise ValueError("Invalid descending {}".format(descending))
+    try:
+        limit = int(data.get('limit') or DEFAULT_PAGE_SIZE)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid limit {}".format(data.get('limit')))
+    if limit < 1:
+        raise ValueError("Invalid limit {}".format(limit))
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    columns = orders[sort]
+    if data.get('cursor'):
+        cursor_sort, cursor_descending, values = decode_cursor(data['cursor'])
+        if cursor_sort != sort or cursor_descending != descending or len(values) != len(columns):
+            raise ValueError("Cursor is for a different sort")
+        # a row value comparison, so the database can seek straight to the cursor along the sort's index
+        position = sqla.tuple_(*columns)
+        after = sqla.tuple_(*[sqla.literal(value, column.type) for column, value in zip(columns, values)])
+        query = query.where(position < after if descending else position > after)
+
+    # the sort key is selected after the table's own columns so the next cursor can be read off the last row,
+    # and one extra row tells whether there is another page without counting the rest
+    rows = db.session.execute(query.add_columns(*[column.label('sort_key_{}'.format(i)) for i, column in enumerate(columns)])
+                              .order_by(*[column.desc() if descending else column for column in columns])
+                              .limit(limit + 1)).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(sort, descending, list(rows[-1][-len(columns):]))
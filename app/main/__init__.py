@@ -2,4 +2,4 @@ from flask import Blueprint
 
 main_blueprint = Blueprint('main', __name__)
 
-from app.main import routes
\ No newline at end of file
+from app.main import routes, commands
\ No newline at end of file
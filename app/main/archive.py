@@ -0,0 +1,104 @@
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+from flask import current_app, has_app_context
+
+# Long term location history, kept out of the location table in one .npy file per month and bike:
+# <root>/<YYYY-MM>/<bike id>.npy, each a timestamp sorted array of LOCATION_DTYPE records, and a <root>/<YYYY-MM>/.complete
+# marker once every bike's month has been written.
+# Files are memory mapped when read, so slicing a ride out of a month doesn't copy or load the rest of it
+
+LOCATION_DTYPE = np.dtype([('timestamp', '<i8'), ('latitude', '<f8'), ('longitude', '<f8')])
+
+def month_of(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m')
+
+def month_start(month):
+    return int(datetime.strptime(month, '%Y-%m').replace(tzinfo=timezone.utc).timestamp())
+
+def next_month(month):
+    year, number = int(month[:4]), int(month[5:])
+    return '{:04d}-{:02d}'.format(year + number // 12, number % 12 + 1)
+
+class LocationArchive:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, month, bike_id):
+        return os.path.join(self.root, month, '{}.npy'.format(bike_id))
+
+    def months(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if len(name) == 7 and name[4] == '-')
+
+    def marker(self, month):
+        return os.path.join(self.root, month, '.complete')
+
+    def complete(self, month):
+        """Marks a month as holding every bike's locations, see horizon"""
+        os.makedirs(os.path.join(self.root, month), exist_ok=True)
+        open(self.marker(month), 'w').close()
+
+    def is_complete(self, month):
+        return os.path.exists(self.marker(month))
+
+    def horizon(self):
+        """Returns the unix timestamp everything before is archived, or None when nothing is. Only the months up to
+        the first one that isn't marked complete count, so a month an archive run was interrupted in stays with the
+        database until a later run finishes it"""
+        horizon = None
+        for month in self.months():
+            if not self.is_complete(month):
+                break
+            horizon = month_start(next_month(month))
+        return horizon
+
+    def load(self, month, bike_id):
+        """Memory maps one month of a bike's history, or returns None when there is no file for it"""
+        path = self.path(month, bike_id)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def read(self, bike_id, start, end):
+        """Returns a bike's archived locations with start <= timestamp <= end, oldest first. A range inside one
+        month comes back as a view straight onto the memory mapped file"""
+        parts = []
+        month = month_of(start)
+        while month_start(month) <= end:
+            records = self.load(month, bike_id)
+            if records is not None:
+                timestamps = records['timestamp']
+                parts.append(records[np.searchsorted(timestamps, start, 'left'):np.searchsorted(timestamps, end, 'right')])
+            month = next_month(month)
+
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return np.empty(0, dtype=LOCATION_DTYPE)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def write(self, month, bike_id, records):
+        """Adds records to a month of a bike's history. Timestamps already archived are kept as they are, so
+        archiving the same rows twice is harmless"""
+        records = np.asarray(records, dtype=LOCATION_DTYPE)
+        existing = self.load(month, bike_id)
+        if existing is not None:
+            records = np.concatenate([np.array(existing), records])
+        # np.unique keeps the first of each timestamp and sorts them
+        records = records[np.unique(records['timestamp'], return_index=True)[1]]
+
+        path = self.path(month, bike_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written next to the real file and swapped in, so readers never see half a file
+        temporary = path + '.tmp.npy'
+        np.save(temporary, records)
+        os.replace(temporary, path)
+        return len(records)
+
+# the archive configured for the current app, None outside of flask or when archiving is turned off
+def get_location_archive():
+    if not has_app_context() or not current_app.config.get('LOCATION_ARCHIVE_DIR'):
+        return None
+    return LocationArchive(current_app.config['LOCATION_ARCHIVE_DIR'])
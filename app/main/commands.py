@@ -0,0 +1,64 @@
+from datetime import datetime, timezone
+
+import click
+from flask import current_app
+
+from app.main import main_blueprint as bp_main
+from app import db
+from app.main.models import BikePosition, Location
+from app.main.docking import dock_bikes
+from app.main.retention import compact_locations, archive_locations
+from app.main.archive import LocationArchive
+from app.main.search import create_search_index
+
+# maintenance commands, run with "flask main <command>"
+
+@bp_main.cli.command('rebuild-positions')
+@click.option('--full', is_flag=True, help="Replace every stored position, even ones newer than the location table "
+                                             "still holds after compaction or archiving.")
+def rebuild_positions(full):
+    """Fills in the bike_position table from the location history for bikes without a position."""
+    filled = BikePosition.rebuild(full=full)
+    click.echo("Filled {} bike positions".format(filled))
+
+@bp_main.cli.command('dedupe-locations')
+def dedupe_locations():
+    """Removes duplicate location pings and adds the unique (bike_id, timestamp) index."""
+    removed = Location.dedupe()
+    click.echo("Removed {} duplicate locations".format(removed))
+
+@bp_main.cli.command('dock-bikes')
+def dock_bikes_command():
+    """Docks idle bikes to the station their newest position is inside."""
+    docked = dock_bikes(db.session.connection())
+    db.session.commit()
+    click.echo("Docked {} bikes".format(docked))
+
+@bp_main.cli.command('compact-locations')
+@click.option('--full', is_flag=True, help="Go through the whole history instead of carrying on from the last run, "
+                                             "needed after the tiers change.")
+@click.option('--pause', default=0.0, help="Seconds to wait between transactions.")
+def compact_locations_command(full, pause):
+    """Thins old location history down to the LOCATION_RETENTION tiers, from where the last run stopped."""
+    removed = compact_locations(current_app.config['LOCATION_RETENTION'], full=full, pause=pause)
+    for age, count in removed.items():
+        click.echo("Removed {} locations older than {} days".format(count, age))
+
+@bp_main.cli.command('archive-locations')
+@click.option('--before', default=None, help="Archive every month before this one, as YYYY-MM.")
+@click.option('--pause', default=0.0, help="Seconds to wait between transactions.")
+def archive_locations_command(before, pause):
+    """Moves whole months of old locations out of the database into the .npy archive."""
+    if before is None:
+        now = datetime.now(timezone.utc)
+        months = now.year * 12 + now.month - 1 - current_app.config['LOCATION_ARCHIVE_AFTER_MONTHS']
+        before = '{:04d}-{:02d}'.format(months // 12, months % 12 + 1)
+    moved = archive_locations(LocationArchive(current_app.config['LOCATION_ARCHIVE_DIR']), before, pause=pause)
+    click.echo("Archived {} locations from before {}".format(moved, before))
+
+@bp_main.cli.command('build-search-index')
+def build_search_index():
+    """Creates the admin search index and fills it again from the user, bike and report tables."""
+    create_search_index(db.session.connection(), rebuild=True)
+    db.session.commit()
+    click.echo("Built the search index")
@@ -0,0 +1,49 @@
+from datetime import timedelta, timezone
+
+import sqlalchemy as sqla
+
+from app.main.models import Bike, BikePosition, Ride, Station, TableVersion
+
+# Docks bikes to the station their newest position is inside, so bikes left at a station without a proper
+# return still show up there. Takes a plain connection so the ingest service can run it after each cycle
+
+BIKE_STATION_UPDATE = (sqla.update(Bike.__table__)
+                       .where(Bike.__table__.c.id == sqla.bindparam('bike'))
+                       .values(station_id=sqla.bindparam('station')))
+
+def ride_end_times(connection):
+    """The unix time each bike's newest completed ride ended, by bike id"""
+    newest = (sqla.select(Ride.bike_id, sqla.func.max(Ride.ride_date).label('ride_date'))
+              .where(Ride.completed_ride == True)
+              .group_by(Ride.bike_id)).subquery()
+    rides = connection.execute(sqla.select(Ride.bike_id, Ride.ride_date, Ride.duration)
+                               .join(newest, sqla.and_(Ride.bike_id == newest.c.bike_id, Ride.ride_date == newest.c.ride_date))).all()
+    return {ride.bike_id: (ride.ride_date.replace(tzinfo=timezone.utc) + (ride.duration or timedelta())).timestamp() for ride in rides}
+
+def dock_bikes(connection):
+    """Tests every idle bike's newest position against all stations at once and writes the changed
+    assignments in one statement. Bikes outside every station keep their station. Returns the number of bikes moved"""
+    stations = Station.get_polygon_set(connection)
+    if len(stations) == 0:
+        return 0
+
+    # bikes out on a ride are left alone, endride docks them when the ride is over
+    riding = sqla.select(Ride.bike_id).where(Ride.completed_ride == False)
+    bikes = connection.execute(sqla.select(Bike.id, Bike.station_id, BikePosition.latitude, BikePosition.longitude, BikePosition.timestamp)
+                               .join(BikePosition, BikePosition.bike_id == Bike.id)
+                               .where(Bike.id.not_in(riding))).all()
+
+    # a position from before the bike's last ride ended is where it was picked up, not where endride left it, so it
+    # only counts once the tag has reported from after the return
+    ended = ride_end_times(connection)
+    bikes = [bike for bike in bikes if bike.timestamp > ended.get(bike.id, 0)]
+    if not bikes:
+        return 0
+
+    located = stations.locate([bike.latitude for bike in bikes], [bike.longitude for bike in bikes])
+    changes = [{'bike': bike.id, 'station': int(station_id)} for bike, station_id in zip(bikes, located)
+               if station_id != -1 and station_id != bike.station_id]
+    if changes:
+        connection.execute(BIKE_STATION_UPDATE, changes)
+        TableVersion.bump(connection, ['bike'])
+    return len(changes)
@@ -0,0 +1,274 @@
+import json
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+import sqlalchemy as sqla
+import sqlalchemy.orm as sqlo
+from flask import current_app, has_app_context, request, Response
+
+from app import db
+from app.main.models import BikePosition, FleetEvent
+
+# Live fleet updates for the /events and /admin/events streams. Each event is a kind and a json payload:
+#   bike       a bike was locked, unlocked or taken in or out of service   {bike_id, locked, available, station_id}
+#   ride       a ride started or ended                                     {bike_id, action, station_id}
+#              or completed rides' paths were rebuilt, admins only         {bike_ids, action: 'path', station_id}
+#   dock       the ingest service docked idle bikes to stations            {docked}
+#   report     a report was filed or marked done, admins only              {bike_id, category}
+#   positions  the ingest service stored new positions, admins only        {bikes: [{bike_id, timestamp, latitude, longitude}]}
+# A backend carries the events between processes. Each web worker has one hub that reads them from the backend on a
+# single thread and hands them to every stream the worker is serving
+
+logger = logging.getLogger(__name__)
+
+Event = namedtuple('Event', ['id', 'kind', 'data', 'admin'])
+
+class MemoryEventBackend:
+    """Keeps events inside this process, for a single worker"""
+
+    def __init__(self, size=1000):
+        self.events = deque(maxlen=size)
+        self.condition = threading.Condition()
+        self.last = 0
+
+    def publish(self, kind, data, admin=False, connection=None):
+        with self.condition:
+            self.last += 1
+            self.events.append(Event(self.last, kind, data, admin))
+            self.condition.notify_all()
+            return self.last
+
+    def last_id(self):
+        return self.last
+
+    def read(self, after, timeout, stop=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.last > after or (stop is not None and stop.is_set()), timeout)
+            return [event for event in self.events if event.id > after]
+
+    def history(self, after, upto):
+        with self.condition:
+            return [event for event in self.events if after < event.id <= upto]
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+class DatabaseEventBackend:
+    """Shares events through the fleet_event table, so every web worker and the ingest service see the same ones.
+    Readers look for rows past the last id they have every poll_interval seconds"""
+
+    def __init__(self, engine, poll_interval=1, retention=3600, settle=5):
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.settle = settle
+        # missing ids that were passed over, and when each was first seen missing
+        self.gaps = {}
+
+    def publish(self, kind, data, admin=False, connection=None):
+        if connection is None:
+            with self.engine.begin() as connection:
+                return self.publish(kind, data, admin, connection)
+        table = FleetEvent.__table__
+        now = int(time.time())
+        event_id = connection.execute(sqla.insert(table).values(timestamp=now, kind=kind, admin=admin, data=data)).inserted_primary_key[0]
+        # old events are only read by streams reconnecting after a short drop, so they are cleared out every so often
+        if event_id % 100 == 0:
+            connection.execute(sqla.delete(table).where(table.c.timestamp < now - self.retention))
+        return event_id
+
+    def last_id(self):
+        with self.engine.connect() as connection:
+            return connection.scalar(sqla.select(sqla.func.max(FleetEvent.id))) or 0
+
+    def settled(self, after, rows):
+        """The rows that can be handed out after the id after. Ids are taken when a transaction inserts its event
+        but only show up once it commits, so a missing id may still be on its way. Rows past one are held back
+        until it turns up, or until it has been missing for settle seconds and is taken to be rolled back"""
+        now = time.monotonic()
+        expected = after + 1
+        ready = []
+        for row in rows:
+            for missing in range(expected, row.id):
+                first_seen = self.gaps.setdefault(missing, now)
+                if now - first_seen < self.settle:
+                    break
+            else:
+                ready.append(row)
+                expected = row.id + 1
+                continue
+            break
+        for missing in [missing for missing in self.gaps if missing < expected]:
+            del self.gaps[missing]
+        return ready
+
+    def read(self, after, timeout, stop=None):
+        stop = stop or threading.Event()
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.engine.connect() as connection:
+                rows = connection.execute(sqla.select(FleetEvent.id, FleetEvent.kind, FleetEvent.data, FleetEvent.admin)
+                                          .where(FleetEvent.id > after)
+                                          .order_by(FleetEvent.id)
+                                          .limit(500)).all()
+            rows = self.settled(after, rows)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0 or stop.is_set():
+                return [Event(*row) for row in rows]
+            stop.wait(min(self.poll_interval, remaining))
+
+    def history(self, after, upto):
+        """The events after the id after up to the id upto, which a hub has already read past so none of them are
+        still on their way"""
+        with self.engine.connect() as connection:
+            rows = connection.execute(sqla.select(FleetEvent.id, FleetEvent.kind, FleetEvent.data, FleetEvent.admin)
+                                      .where(FleetEvent.id > after, FleetEvent.id <= upto)
+                                      .order_by(FleetEvent.id)
+                                      .limit(500)).all()
+        return [Event(*row) for row in rows]
+
+    def wake(self):
+        # a read waiting on its stop event is woken by the event itself
+        pass
+
+class EventHub:
+    """Fans the events from a backend out to the streams of one worker. Only one thread reads from the backend,
+    however many streams are open"""
+
+    def __init__(self, backend, size=1000, read_timeout=15):
+        self.backend = backend
+        self.events = deque(maxlen=size)
+        self.condition = threading.Condition()
+        self.last = backend.last_id()
+        # the events up to this id aren't kept here, from before the hub started or pushed out of its buffer
+        self.floor = self.last
+        self.read_timeout = read_timeout
+        self.reader = None
+        self.closed = threading.Event()
+
+    def publish(self, kind, data, admin=False, connection=None):
+        return self.backend.publish(kind, data, admin, connection)
+
+    def read_forever(self):
+        while not self.closed.is_set():
+            try:
+                events = self.backend.read(self.last, self.read_timeout, self.closed)
+            except Exception:
+                # the reader runs outside of any app context, so it logs through its module's logger
+                logger.exception("Error reading events")
+                self.closed.wait(self.read_timeout)
+                continue
+            if events:
+                with self.condition:
+                    self.events.extend(events)
+                    self.last = events[-1].id
+                    if len(self.events) == self.events.maxlen:
+                        self.floor = max(self.floor, self.events[0].id - 1)
+                    self.condition.notify_all()
+
+    def close(self, timeout=5):
+        """Stops the reader thread, waiting up to timeout seconds for its current read to return"""
+        self.closed.set()
+        self.backend.wake()
+        if self.reader is not None:
+            self.reader.join(timeout)
+
+    def wait(self, after, timeout):
+        """Returns the events after the id after, waiting up to timeout seconds for there to be one"""
+        with self.condition:
+            if self.reader is None:
+                self.reader = threading.Thread(target=self.read_forever, name='event-hub', daemon=True)
+                self.reader.start()
+            floor = self.floor
+        if after < floor:
+            # a stream further behind than the buffer goes back is replayed from the backend, once it has caught up
+            # to the buffer it carries on from there
+            events = self.backend.history(after, floor)
+            if events:
+                return events
+            after = floor
+        with self.condition:
+            self.condition.wait_for(lambda: self.last > after, timeout)
+            return [event for event in self.events if event.id > after]
+
+    def stream(self, after=None, admin=False, timeout=300, heartbeat=15):
+        """Yields the events after the id after as Server-Sent Events for timeout seconds, with a comment every
+        heartbeat seconds so proxies keep the connection open. Admin only events are skipped unless admin"""
+        # an id from before a restart of the memory backend would wait for events that never come
+        newest = self.backend.last_id()
+        after = newest if after is None or after > newest else after
+        yield 'retry: 2000\n\n'
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            events = self.wait(after, min(heartbeat, remaining))
+            if not events:
+                yield ': keepalive\n\n'
+            for event in events:
+                after = event.id
+                if event.admin and not admin:
+                    continue
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(event.id, event.kind, json.dumps(event.data))
+
+EVENT_BACKENDS = {
+    'memory': lambda config: MemoryEventBackend(),
+    'database': lambda config: DatabaseEventBackend(db.engine, config['EVENT_POLL_INTERVAL'], config['EVENT_RETENTION'], config['EVENT_SETTLE']),
+}
+
+def get_event_hub():
+    hub = current_app.extensions.get('event_hub')
+    if hub is None:
+        hub = current_app.extensions['event_hub'] = EventHub(EVENT_BACKENDS[current_app.config['EVENT_BACKEND']](current_app.config))
+    return hub
+
+def event_stream_response(admin):
+    """The Server-Sent Events response for the current request, with the admin only events included if admin"""
+    # EventSource sends the id of the last event it got when it reconnects, so nothing is missed in between
+    last_id = request.headers.get('Last-Event-ID', '')
+    stream = get_event_hub().stream(int(last_id) if last_id.isdigit() else None, admin=admin,
+                                    timeout=current_app.config['EVENT_STREAM_TIMEOUT'], heartbeat=current_app.config['EVENT_HEARTBEAT'])
+    response = Response(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # stops nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def publish_event(kind, data, admin=False):
+    """Publishes an event once the current transaction commits, so a stream never hears about a change before it is
+    stored, and never about one that was rolled back"""
+    db.session.info.setdefault('events', []).append((kind, data, admin))
+
+def position_timestamps(connection):
+    return dict(connection.execute(sqla.select(BikePosition.bike_id, BikePosition.timestamp)).all())
+
+def publish_positions(backend, connection, before):
+    """Publishes the bike positions that changed since before, taken from position_timestamps before new locations
+    were written, as one positions event. Returns the number of bikes in it"""
+    rows = [row for row in connection.execute(sqla.select(BikePosition.bike_id, BikePosition.timestamp,
+                                                          BikePosition.latitude, BikePosition.longitude)).all()
+            if before.get(row.bike_id) != row.timestamp]
+    if rows:
+        backend.publish('positions', {'bikes': [row._asdict() for row in rows]}, admin=True, connection=connection)
+    return len(rows)
+
+@sqla.event.listens_for(sqlo.Session, 'after_commit')
+def events_commit(session):
+    events = session.info.pop('events', None)
+    if not events or not has_app_context():
+        return
+    try:
+        hub = get_event_hub()
+        for kind, data, admin in events:
+            hub.publish(kind, data, admin)
+    except Exception:
+        # the change itself is already committed, a lost update only means streams catch up on the next one
+        current_app.logger.exception("Error publishing events")
+
+@sqla.event.listens_for(sqlo.Session, 'after_rollback')
+def events_rollback(session):
+    session.info.pop('events', None)
@@ -0,0 +1,219 @@
+import heapq
+import math
+
+import numpy as np
+
+# geometry helpers for stations and ride paths, points and polygon vertices are [latitude, longitude] in degrees
+
+# mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+METERS_PER_MILE = 1609.344
+
+def haversine(lat1, long1, lat2, long2):
+    """Great circle distance in meters between two points"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+def equirectangular(lat1, long1, lat2, long2):
+    """Flat earth approximation of haversine in meters, within a fraction of a percent over a few kilometers"""
+    x = math.radians(long2 - long1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.hypot(x, y)
+
+def haversine_array(lat1, long1, lat2, long2):
+    """haversine over NumPy arrays, inputs broadcast against each other"""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(np.subtract(long2, long1)) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+def equirectangular_array(lat1, long1, lat2, long2):
+    """equirectangular over NumPy arrays, inputs broadcast against each other"""
+    x = np.radians(np.subtract(long2, long1)) * np.cos(np.radians(np.add(lat1, lat2) / 2))
+    y = np.radians(np.subtract(lat2, lat1))
+    return EARTH_RADIUS * np.hypot(x, y)
+
+def segment_lengths(path, kernel=haversine_array):
+    """Distance in meters between each pair of consecutive [latitude, longitude] points"""
+    path = np.asarray(path, dtype=float).reshape(-1, 2)
+    return kernel(path[:-1, 0], path[:-1, 1], path[1:, 0], path[1:, 1])
+
+def path_length(path, kernel=haversine_array):
+    """Total length of a path of [latitude, longitude] points in meters"""
+    return float(segment_lengths(path, kernel).sum())
+
+def project(path):
+    """Projects [latitude, longitude] points onto a flat plane in meters around the path's first point"""
+    path = np.asarray(path, dtype=float).reshape(-1, 2)
+    if len(path) == 0:
+        return path
+    scale = np.cos(np.radians(path[0, 0]))
+    return np.column_stack((np.radians(path[:, 1]) * scale, np.radians(path[:, 0]))) * EARTH_RADIUS
+
+def douglas_peucker(points, tolerance):
+    """Returns the indices of the points kept by Douglas-Peucker, for projected points in meters"""
+    keep = np.zeros(len(points), dtype=bool)
+    if len(points) == 0:
+        return np.flatnonzero(keep)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        between = points[first + 1:last]
+        segment = end - start
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(*(between - start).T)
+        else:
+            distances = np.abs(segment[0] * (between[:, 1] - start[1]) - segment[1] * (between[:, 0] - start[0])) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+def visvalingam(points, max_points):
+    """Returns the indices of the max_points points kept by Visvalingam-Whyatt, which repeatedly drops the point
+    forming the smallest triangle with its neighbours"""
+    count = len(points)
+    if count <= max_points:
+        return np.arange(count)
+    max_points = max(max_points, 2)
+
+    def area(i):
+        a, b, c = points[previous[i]], points[i], points[following[i]]
+        return abs((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1])) / 2
+
+    previous = list(range(-1, count - 1))
+    following = list(range(1, count + 1))
+    areas = [0.0] + [area(i) for i in range(1, count - 1)] + [0.0]
+    heap = [(areas[i], i) for i in range(1, count - 1)]
+    heapq.heapify(heap)
+    removed = np.zeros(count, dtype=bool)
+    remaining = count
+    while remaining > max_points:
+        smallest, i = heapq.heappop(heap)
+        # skip heap entries left behind when a point's area changed
+        if removed[i] or smallest != areas[i]:
+            continue
+        removed[i] = True
+        remaining -= 1
+        before, after = previous[i], following[i]
+        following[before], previous[after] = after, before
+        for neighbour in (before, after):
+            if 0 < neighbour < count - 1:
+                # a neighbour never gets less important than the point just removed
+                areas[neighbour] = max(area(neighbour), smallest)
+                heapq.heappush(heap, (areas[neighbour], neighbour))
+    return np.flatnonzero(~removed)
+
+def simplify_path(path, tolerance=5, max_points=None):
+    """Simplifies a path of [latitude, longitude] points with Douglas-Peucker, dropping detail smaller than tolerance
+    meters. If more than max_points remain, Visvalingam-Whyatt trims it down to that many. Both ends are always kept"""
+    points = project(path)
+    kept = douglas_peucker(points, tolerance)
+    if max_points is not None and len(kept) > max_points:
+        kept = kept[visvalingam(points[kept], max_points)]
+    return [list(path[i]) for i in kept]
+
+def encode_polyline(path, precision=5):
+    """Encodes [latitude, longitude] points in Google's encoded polyline format"""
+    factor = 10 ** precision
+    encoded = []
+    last_lat = last_long = 0
+    for latitude, longitude in path:
+        lat, long = round(latitude * factor), round(longitude * factor)
+        for delta in (lat - last_lat, long - last_long):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        last_lat, last_long = lat, long
+    return ''.join(encoded)
+
+def polygon_contains(polygon, latitude, longitude):
+    """Ray cast point-in-polygon test for a polygon with any number of vertices"""
+    inside = False
+    for i in range(len(polygon)):
+        lat1, long1 = polygon[i - 1]
+        lat2, long2 = polygon[i]
+        if longitude > min(long1, long2) and longitude <= max(long1, long2) and latitude <= max(lat1, lat2):
+            intersection = (longitude - long1) * (lat2 - lat1) / (long2 - long1) + lat1
+            if lat1 == lat2 or latitude <= intersection:
+                inside = not inside
+    return inside
+
+def bounding_box(polygon):
+    """Returns (min latitude, min longitude, max latitude, max longitude)"""
+    lats = [vertex[0] for vertex in polygon]
+    longs = [vertex[1] for vertex in polygon]
+    return (min(lats), min(longs), max(lats), max(longs))
+
+class PolygonSet:
+    """Holds many polygons, each with any number of vertices, in contiguous edge arrays so a whole batch of points
+    can be tested against every polygon at once. Uses the same ray cast rules as polygon_contains"""
+
+    # limits the points x edges work arrays to about this many cells, bigger batches are split up
+    MAX_CELLS = 1000000
+
+    def __init__(self, polygons, ids=None):
+        self.ids = np.asarray(ids if ids is not None else range(len(polygons)))
+        counts = [len(polygon) for polygon in polygons]
+        if any(count < 3 for count in counts):
+            raise ValueError("polygons need at least 3 vertices")
+
+        # each polygon's edges run from the previous vertex to the current one, and are stored one polygon after another
+        starts, ends = [], []
+        for polygon in polygons:
+            vertices = np.asarray(polygon, dtype=float).reshape(-1, 2)
+            starts.append(np.roll(vertices, 1, axis=0))
+            ends.append(vertices)
+        starts = np.concatenate(starts) if polygons else np.empty((0, 2))
+        ends = np.concatenate(ends) if polygons else np.empty((0, 2))
+
+        self.lat1, self.long1 = starts[:, 0], starts[:, 1]
+        self.lat2, self.long2 = ends[:, 0], ends[:, 1]
+        self.min_long = np.minimum(self.long1, self.long2)
+        self.max_long = np.maximum(self.long1, self.long2)
+        self.max_lat = np.maximum(self.lat1, self.lat2)
+        self.flat = self.lat1 == self.lat2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.slope = (self.lat2 - self.lat1) / (self.long2 - self.long1)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(int) if polygons else np.empty(0, dtype=int)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def contains(self, latitudes, longitudes):
+        """Returns a (points, polygons) boolean array, True where the point is inside the polygon"""
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+        inside = np.zeros((len(latitudes), len(self)), dtype=bool)
+        if len(self) == 0:
+            return inside
+
+        step = max(1, self.MAX_CELLS // len(self.lat1))
+        for start in range(0, len(latitudes), step):
+            lat = latitudes[start:start + step, None]
+            lon = longitudes[start:start + step, None]
+            spans = (lon > self.min_long) & (lon <= self.max_long) & (lat <= self.max_lat)
+            with np.errstate(invalid='ignore'):
+                crosses = spans & (self.flat | (lat <= (lon - self.long1) * self.slope + self.lat1))
+            # an odd number of crossings among a polygon's edges means the point is inside it
+            inside[start:start + step] = np.logical_xor.reduceat(crosses, self.offsets, axis=1)
+        return inside
+
+    def locate(self, latitudes, longitudes, missing=-1):
+        """Returns the id of the first polygon containing each point, or missing for points outside all of them"""
+        inside = self.contains(latitudes, longitudes)
+        if len(self) == 0:
+            return np.full(len(inside), missing)
+        found = inside.any(axis=1)
+        first = inside.argmax(axis=1)
+        return np.where(found, self.ids[first], missing)
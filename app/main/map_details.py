@@ -0,0 +1,48 @@
+import sqlalchemy as sqla
+
+from app import db
+from app.main.models import Bike, BikePosition, Station, Report, format_timestamp
+
+# Builds the bike and station lists sent to the map in a fixed number of queries, no matter how many bikes are in the fleet
+
+def get_report_severities():
+    # one grouped count over all reports, matches Bike.get_report_severity for every bike at once
+    counts = db.session.execute(sqla.select(Report.bike_id, Report.category)
+                                .group_by(Report.bike_id, Report.category)
+                                .having(sqla.func.count() >= 2)
+                                .order_by(sqla.func.min(Report.timestamp))).all()
+    severities = {}
+    for bike_id, category in counts:
+        severities.setdefault(bike_id, category)
+    return severities
+
+def get_bike_map_details(public=True):
+    query = (sqla.select(Bike.id, Bike.name, Bike.locked, Bike.available, Bike.station_id,
+                         BikePosition.latitude, BikePosition.longitude, BikePosition.timestamp)
+             .outerjoin(BikePosition, BikePosition.bike_id == Bike.id)
+             .order_by(Bike.id))
+
+    # riders only see bikes that are docked and available
+    if public:
+        query = query.where(Bike.station_id != None).where(Bike.available == True)
+
+    severities = get_report_severities()
+
+    bike_list = []
+    for bike in db.session.execute(query):
+        # bikes that have never reported a location are sent as an empty entry
+        if bike.timestamp is None:
+            bike_list.append({})
+            continue
+
+        bike_list.append({'name':bike.name, 'id':bike.id,
+                          'pos':[bike.latitude, bike.longitude],
+                          'lastseen':format_timestamp(bike.timestamp),
+                          'locked':bike.locked,
+                          'avaliable':bike.available,
+                          'station':bike.station_id,
+                          'status':str(severities.get(bike.id, -1))})
+    return bike_list
+
+def get_station_map_details():
+    return [station.get_details() for station in db.session.scalars(sqla.select(Station))]
@@ -1,12 +1,20 @@
 import re
 from datetime import datetime, timezone, timedelta
-from app import db, vapid_private_key
+from app import db
 from typing import Optional
 import sqlalchemy as sqla
 import sqlalchemy.orm as sqlo
-import math
+from flask import current_app
 from flask_login import UserMixin
-from pywebpush import WebPusher, WebPushException, webpush
+from pywebpush import WebPusher
+from app.main.geo import polygon_contains, PolygonSet, haversine, path_length, simplify_path
+from app.main.archive import get_location_archive
+from app.main.notifications import get_notification_dispatcher
+import numpy as np
+
+# formats a unix timestamp for display in the UI
+def format_timestamp(timestamp):
+    return re.sub(r"0(?=.:)", "", datetime.fromtimestamp(timestamp).strftime('%b %d, %Y at %I:%M%p'))
 
 class Location:
     latitude : float
@@ -18,7 +26,7 @@ class Location:
 
     # gets the distance between two locations in meters
     def distance_from (self, coord):
-        return 637101 * math.acos(math.sin(coord.latitude)*math.sin(self.latitude) + math.cos(coord.latitude)*math.cos(self.latitude)*math.cos(coord.longitude - self.longitude))
+        return haversine(self.latitude, self.longitude, coord.latitude, coord.longitude)
 
 class User(UserMixin, db.Model):
     id : sqlo.Mapped[str] = sqlo.mapped_column(primary_key=True)
@@ -49,11 +57,16 @@ class User(UserMixin, db.Model):
         return self.name
 
     def get_first_name(self):
-        name_split = self.name.split(", ")
+        return User.first_name(self.name)
+
+    # names are stored as "Last, First", for use on names loaded without the rest of the user
+    @staticmethod
+    def first_name(name):
+        name_split = name.split(", ")
         if len(name_split) >= 1:
             return name_split[1]
         else:
-            return self.name
+            return name
 
     def get_last_name(self):
         return self.name.split(", ")[0]
@@ -73,7 +86,11 @@ class User(UserMixin, db.Model):
         return db.session.scalars(self.reports.select()).all()
 
     def has_notification_keys(self):
-        return self.notification_auth_key is not None and self.notification_p256dh_key is not None and self.notification_endpoint is not None
+        return User.notification_keys_set(self.notification_endpoint, self.notification_p256dh_key, self.notification_auth_key)
+
+    @staticmethod
+    def notification_keys_set(endpoint, p256dh_key, auth_key):
+        return auth_key is not None and p256dh_key is not None and endpoint is not None
     
     def clear_notification_keys(self):
         self.notification_endpoint = None
@@ -100,25 +117,28 @@ class User(UserMixin, db.Model):
         return True
     
     def send_notification(self, message):
-        fleet = Fleet.get_fleet()
-        print("sending notification to " + self.get_full_name())
+        return User.send_notifications([self], message)[0].status == 'sent'
 
-        try:
-            webpush(
-                subscription_info=dict(endpoint=self.notification_endpoint, keys=dict(p256dh=self.notification_p256dh_key, auth=self.notification_auth_key)),
-                data=message,
-                vapid_private_key=vapid_private_key,
-                vapid_claims=dict(sub="mailto:"+fleet.contact_email),
-                ttl=86400
-            )
-            return True
-        except WebPushException as e:
-            if e.response and e.response.status_code:
-                print(e.response.status_code)
-                # these status codes indicate that the notification endpoint is no longer valid (ex. user denied permission later) and should be deleted
-                if e.response.status_code == 401 or e.response.status_code == 403 or e.response.status_code == 404 or e.response.status_code == 410:
-                    self.clear_notification_keys()
-            return False
+    @staticmethod
+    def send_notifications(recipients, message):
+        """Pushes message to every recipient at once, each a user or a row with the user's id and notification key
+        columns. Returns a PushResult for each in the same order, and clears the keys the push service says expired"""
+        fleet = Fleet.get_fleet()
+        results = get_notification_dispatcher(fleet.contact_email).send(
+            [(recipient.id, recipient.notification_endpoint, recipient.notification_p256dh_key, recipient.notification_auth_key)
+             for recipient in recipients], message)
+        for result in results:
+            if result.status == 'failed':
+                current_app.logger.warning("Error sending notification to %s: %s", result.user_id, result.error)
+        expired = [result.user_id for result in results if result.status == 'expired']
+        if expired:
+            # one update for all of them, which skips the flush so the user table's version is bumped here
+            db.session.execute(sqla.update(User).where(User.id.in_(expired))
+                               .values(notification_endpoint=None, notification_p256dh_key=None, notification_auth_key=None)
+                               .execution_options(synchronize_session='fetch'))
+            TableVersion.bump(db.session.connection(), ['user'])
+            db.session.commit()
+        return results
 
 class Station(db.Model):
     id : sqlo.Mapped[int] = sqlo.mapped_column(primary_key=True)
@@ -142,16 +162,7 @@ class Station(db.Model):
         return {'name': self.get_name(), 'pos': self.get_polygon()}
 
     def contains (self, checkLocation):
-        pairs = (((self.lat1, self.long1), (self.lat2, self.long2)), ((self.lat2, self.long2), (self.lat3, self.long3)), ((self.lat3, self.long3), (self.lat4, self.long4)), ((self.lat4, self.long4), (self.lat1, self.long1)))
-        inside = False
-
-        for pair in pairs:
-            if checkLocation.longitude > min(pair[0][1], pair[1][1]) and checkLocation.longitude <= max(pair[0][1], pair[1][1]) and checkLocation.latitude <= max(pair[0][0], pair[1][0]):
-                intersection = (checkLocation.longitude - pair[0][1]) * (pair[1][0] - pair[0][0]) / (pair[1][1] - pair[0][1]) + pair[0][0]
-                if pair[0][0] == pair[1][0] or checkLocation.latitude <= intersection:
-                    inside = not inside
-
-        return inside
+        return polygon_contains(self.get_polygon(), checkLocation.latitude, checkLocation.longitude)
 
     bikes : sqlo.WriteOnlyMapped['Bike'] = sqlo.relationship(back_populates = 'station', passive_deletes=True)
 
@@ -161,6 +172,15 @@ class Station(db.Model):
     def get_polygon(self):
         return [[self.lat1, self.long1],[self.lat2, self.long2],[self.lat3, self.long3],[self.lat4, self.long4]]
 
+    # every station's polygon in one PolygonSet, for checking many points at once. Takes a connection for use outside of flask
+    @staticmethod
+    def get_polygon_set(connection=None):
+        rows = (connection or db.session).execute(sqla.select(Station.id, Station.lat1, Station.long1, Station.lat2, Station.long2,
+                                                              Station.lat3, Station.long3, Station.lat4, Station.long4)
+                                                  .order_by(Station.id)).all()
+        return PolygonSet([[[row[1], row[2]], [row[3], row[4]], [row[5], row[6]], [row[7], row[8]]] for row in rows],
+                          [row[0] for row in rows])
+
 class Bike(db.Model):
     id : sqlo.Mapped[int] = sqlo.mapped_column(primary_key=True)
     name : sqlo.Mapped[str] = sqlo.mapped_column(sqla.String(6), index = True, unique = True)
@@ -226,6 +246,7 @@ class Bike(db.Model):
         current_ride.completed_ride = True
         current_ride.positive_rating = rating
         current_ride.duration = datetime.now(timezone.utc) - current_ride.ride_date.replace(tzinfo=timezone.utc)
+        current_ride.update_path()
         self.station_id = station
         db.session.add(current_ride)
         db.session.add(self)
@@ -237,15 +258,20 @@ class Bike(db.Model):
     def get_locations(self):
         return db.session.scalars(self.locations.select().order_by(Location.timestamp.desc())).all()
 
+    position : sqlo.Mapped[Optional['BikePosition']] = sqlo.relationship(back_populates = 'bike')
+
+    # reads the newest location from the bike_position table, so the cost doesn't grow with location history
     def get_current_location(self):
-        return db.session.scalars(self.locations.select().order_by(Location.timestamp.desc())).first()
+        return db.session.get(BikePosition, self.id)
 
 class Ride(db.Model):
     bike_id : sqlo.Mapped[int] = sqlo.mapped_column(sqla.ForeignKey(Bike.id), primary_key=True)
     user_id : sqlo.Mapped[int] = sqlo.mapped_column(sqla.ForeignKey(User.id), primary_key=True)
     ride_date: sqlo.Mapped[datetime] = sqlo.mapped_column(default = lambda : datetime.now(timezone.utc), primary_key = True)
     duration: sqlo.Mapped[Optional[timedelta]] = sqlo.mapped_column(sqla.Interval)
+    # length of the ride's path in meters, and the path simplified for drawing, both set when the ride ends
     distance : sqlo.Mapped[float] = sqlo.mapped_column(default=0)
+    path : sqlo.Mapped[Optional[list]] = sqlo.mapped_column(sqla.JSON)
     completed_ride : sqlo.Mapped[bool] = sqlo.mapped_column(sqla.Boolean, default=False, nullable=False)
     # compelted_ride is true if complete, false if in progress
     positive_rating : sqlo.Mapped[bool] = sqlo.mapped_column(sqla.Boolean)
@@ -254,6 +280,72 @@ class Ride(db.Model):
     user : sqlo.Mapped[User] = sqlo.relationship(back_populates = 'rides')
     bike : sqlo.Mapped[Bike] = sqlo.relationship(back_populates = 'rides')
 
+    # tags only report every few minutes, so locations this long after the ride ends still count towards its path
+    PATH_PADDING = 900
+    # detail smaller than this many meters is dropped from stored paths, tags aren't that accurate anyway
+    PATH_TOLERANCE = 5
+
+    def get_time_window(self):
+        start = int(self.ride_date.replace(tzinfo=timezone.utc).timestamp())
+        duration = self.duration.total_seconds() if self.duration is not None else datetime.now(timezone.utc).timestamp() - start
+        return start, int(start + duration) + Ride.PATH_PADDING
+
+    # returns the simplified path and full length in meters of a bike's locations between two unix timestamps
+    @staticmethod
+    def build_path(bike_id, start, end, connection=None):
+        query = (sqla.select(Location.latitude, Location.longitude)
+                 .where(Location.bike_id == bike_id)
+                 .where(Location.timestamp >= start)
+                 .where(Location.timestamp <= end)
+                 .order_by(Location.timestamp))
+
+        # rides older than the archive horizon are read from the archive, and only the rest from the database
+        path = []
+        archive = get_location_archive() if connection is None else None
+        horizon = archive.horizon() if archive is not None else None
+        if horizon is not None and start < horizon:
+            records = archive.read(bike_id, start, min(end, horizon - 1))
+            path = np.column_stack((records['latitude'], records['longitude'])).tolist()
+            query = query.where(Location.timestamp >= horizon)
+
+        path += [[latitude, longitude] for latitude, longitude in (connection or db.session).execute(query)]
+        return simplify_path(path, Ride.PATH_TOLERANCE), path_length(path)
+
+    def update_path(self):
+        self.path, self.distance = Ride.build_path(self.bike_id, *self.get_time_window())
+
+    # rebuilds the stored path of every completed ride started since the given time, picking up locations that were
+    # fetched after the ride ended. Only rides whose path changed are written, so the ride table's version stays put
+    # between cycles that found nothing new. Takes a connection and the event backend to publish through for use outside
+    # of flask, returns the number of rides updated
+    @staticmethod
+    def update_paths(since, connection=None, events=None):
+        connection = connection or db.session
+        rides = connection.execute(sqla.select(Ride.bike_id, Ride.user_id, Ride.ride_date, Ride.duration, Ride.path, Ride.distance)
+                                   .where(Ride.completed_ride == True)
+                                   .where(Ride.ride_date >= since)).all()
+        updates = []
+        for ride in rides:
+            path, distance = Ride.build_path(ride.bike_id, *Ride.get_time_window(ride), connection=connection)
+            if path == ride.path and distance == ride.distance:
+                continue
+            updates.append({'b_bike_id': ride.bike_id, 'b_user_id': ride.user_id, 'b_ride_date': ride.ride_date, 'path': path, 'distance': distance})
+        if updates:
+            table = Ride.__table__
+            connection.execute(sqla.update(table)
+                               .where(table.c.bike_id == sqla.bindparam('b_bike_id'))
+                               .where(table.c.user_id == sqla.bindparam('b_user_id'))
+                               .where(table.c.ride_date == sqla.bindparam('b_ride_date')), updates)
+            TableVersion.bump(connection, ['ride'])
+            # the completed rides tab redraws with the new distances, riders' maps don't change so it is admins only
+            data = {'bike_ids': sorted({update['b_bike_id'] for update in updates}), 'action': 'path', 'station_id': None}
+            if events is not None:
+                events.publish('ride', data, admin=True, connection=connection)
+            elif connection is db.session:
+                from app.main.events import publish_event
+                publish_event('ride', data, admin=True)
+        return len(updates)
+
 class Report(db.Model):
     bike_id : sqlo.Mapped[int] = sqlo.mapped_column(sqla.ForeignKey(Bike.id), primary_key=True)
     user_id : sqlo.Mapped[int] = sqlo.mapped_column(sqla.ForeignKey(User.id), primary_key=True)
@@ -266,6 +358,11 @@ class Report(db.Model):
     bike : sqlo.Mapped[Bike] = sqlo.relationship(back_populates = 'reports')
 
 class Location(db.Model):
+    # a tag reports at most one location per second, so repeated fetches of the same report are dropped instead of piling up
+    # the timestamp index lets retention compaction work through the history one time window at a time
+    __table_args__ = (sqla.Index('ix_location_bike_id_timestamp', 'bike_id', 'timestamp', unique=True),
+                      sqla.Index('ix_location_timestamp', 'timestamp'))
+
     id : sqlo.Mapped[int] = sqlo.mapped_column(primary_key=True)
 
     bike_id : sqlo.Mapped[int] = sqlo.mapped_column(sqla.ForeignKey(Bike.id))
@@ -273,23 +370,85 @@ class Location(db.Model):
     latitude : sqlo.Mapped[float] = sqlo.mapped_column(sqla.Float())
     longitude : sqlo.Mapped[float] = sqlo.mapped_column(sqla.Float())
 
-    def __init__(self, latitude, longitude, bike_id = 0, timestamp = int(datetime.now().timestamp())):
+    def __init__(self, latitude, longitude, bike_id = 0, timestamp = None):
         self.latitude = latitude
         self.longitude = longitude
         self.bike_id = bike_id
-        self.timestamp = timestamp
+        self.timestamp = timestamp if timestamp is not None else int(datetime.now().timestamp())
 
     def distance_from (self, coord):
-        return 637101 * math.acos(math.sin(coord.latitude)*math.sin(self.latitude) + math.cos(coord.latitude)*math.cos(self.latitude)*math.cos(coord.longitude - self.longitude))
+        return haversine(self.latitude, self.longitude, coord.latitude, coord.longitude)
 
     def get_time_formatted(self):
-        return re.sub(r"0(?=.:)", "", datetime.fromtimestamp(self.timestamp).strftime('%b %d, %Y at %I:%M%p'))
+        return format_timestamp(self.timestamp)
 
     def get_coords(self):
         return [self.latitude, self.longitude]
 
     bike : sqlo.Mapped[Bike] = sqlo.relationship(back_populates = 'locations')
 
+    # removes duplicate pings left by older versions of the ingest and adds the (bike_id, timestamp) index to existing databases.
+    # Run before the migrations, which would otherwise fail to add the unique index over the duplicates
+    @staticmethod
+    def dedupe():
+        # a new database has nothing to dedupe, the migrations create the table with its index
+        if not sqla.inspect(db.engine).has_table(Location.__tablename__):
+            return 0
+        keep = sqla.select(sqla.func.min(Location.id)).group_by(Location.bike_id, Location.timestamp)
+        removed = db.session.execute(sqla.delete(Location).where(Location.id.not_in(keep))).rowcount
+        db.session.commit()
+
+        for index in Location.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+        return removed
+
+# one row per bike holding its newest known location, kept up to date whenever a location is inserted
+class BikePosition(db.Model):
+    bike_id : sqlo.Mapped[int] = sqlo.mapped_column(sqla.ForeignKey(Bike.id), primary_key=True)
+    timestamp : sqlo.Mapped[int] = sqlo.mapped_column()
+    latitude : sqlo.Mapped[float] = sqlo.mapped_column(sqla.Float())
+    longitude : sqlo.Mapped[float] = sqlo.mapped_column(sqla.Float())
+    confidence : sqlo.Mapped[Optional[int]] = sqlo.mapped_column()
+
+    bike : sqlo.Mapped[Bike] = sqlo.relationship(back_populates = 'position')
+
+    # only moves the position forward, so inserting an older location never replaces a newer one
+    UPSERT = sqla.text("INSERT INTO bike_position (bike_id, timestamp, latitude, longitude, confidence) "
+                       "VALUES (:bike_id, :timestamp, :latitude, :longitude, :confidence) "
+                       "ON CONFLICT (bike_id) DO UPDATE SET timestamp = excluded.timestamp, latitude = excluded.latitude, "
+                       "longitude = excluded.longitude, confidence = excluded.confidence "
+                       "WHERE excluded.timestamp >= bike_position.timestamp")
+
+    def distance_from (self, coord):
+        return haversine(self.latitude, self.longitude, coord.latitude, coord.longitude)
+
+    def get_time_formatted(self):
+        return format_timestamp(self.timestamp)
+
+    def get_coords(self):
+        return [self.latitude, self.longitude]
+
+    # fills in the position of every bike that has none from its location history, for databases created before this
+    # table existed. Positions already stored are kept, since compaction and archiving can leave the location table
+    # without a bike's newest ping. full replaces every position from the location table instead
+    @staticmethod
+    def rebuild(full=False):
+        latest = sqla.select(Location.bike_id, Location.timestamp, Location.latitude, Location.longitude,
+                             sqla.func.row_number().over(partition_by=Location.bike_id, order_by=Location.timestamp.desc()).label('rank')).subquery()
+        newest = sqla.select(latest.c.bike_id, latest.c.timestamp, latest.c.latitude, latest.c.longitude).where(latest.c.rank == 1)
+        if full:
+            db.session.execute(sqla.delete(BikePosition))
+        else:
+            newest = newest.where(latest.c.bike_id.not_in(sqla.select(BikePosition.bike_id)))
+        filled = db.session.execute(sqla.insert(BikePosition).from_select(['bike_id', 'timestamp', 'latitude', 'longitude'], newest)).rowcount
+        db.session.commit()
+        return filled
+
+@sqla.event.listens_for(Location, 'after_insert')
+def update_bike_position(mapper, connection, location):
+    connection.execute(BikePosition.UPSERT, {'bike_id': location.bike_id, 'timestamp': location.timestamp,
+                                             'latitude': location.latitude, 'longitude': location.longitude, 'confidence': None})
+
 class Fleet(db.Model):
     id : sqlo.Mapped[int] = sqlo.mapped_column(primary_key=True)# there should only ever be one fleet, but it still needs a primary key
     user_agreement : sqlo.Mapped[str] = sqlo.mapped_column(sqla.String(256))
@@ -305,4 +464,61 @@ class Fleet(db.Model):
             db.session.add(fleet)
             db.session.commit()
 
-        return fleet
\ No newline at end of file
+        return fleet
+
+class TableVersion(db.Model):
+    # counts the changes made to each table the admin pages show, so a page polling for updates can be told
+    # nothing changed without its table being queried, and to the stations, so every worker's station index
+    # knows when to rebuild. Bumped in the same transaction as the change itself
+    TRACKED = ('bike', 'report', 'ride', 'station', 'user')
+    BUMP = sqla.text("INSERT INTO table_version (name, version) VALUES (:name, 1) "
+                     "ON CONFLICT (name) DO UPDATE SET version = table_version.version + 1")
+
+    name : sqlo.Mapped[str] = sqlo.mapped_column(sqla.String(64), primary_key=True)
+    version : sqlo.Mapped[int] = sqlo.mapped_column(default=0, nullable=False)
+
+    # writes that skip the ORM, like Ride.update_paths, bump their tables themselves
+    @staticmethod
+    def bump(connection, tables):
+        connection.execute(TableVersion.BUMP, [{'name': table} for table in sorted(tables)])
+
+    @staticmethod
+    def get_versions(tables, connection=None):
+        versions = dict((connection or db.session).execute(sqla.select(TableVersion.name, TableVersion.version)
+                                                           .where(TableVersion.name.in_(tables))).all())
+        return {table: versions.get(table, 0) for table in tables}
+
+@sqla.event.listens_for(sqlo.Session, 'after_flush')
+def collect_changed_tables(session, flush_context):
+    changed = ({instance.__table__.name for instance in session.new} |
+               {instance.__table__.name for instance in session.deleted} |
+               {instance.__table__.name for instance in session.dirty if session.is_modified(instance)})
+    changed &= set(TableVersion.TRACKED)
+    if changed:
+        session.info.setdefault('changed_tables', set()).update(changed)
+
+@sqla.event.listens_for(sqlo.Session, 'before_commit')
+def bump_table_versions(session):
+    # bumped once per commit, right before it, instead of on every flush, so the version rows every writer shares
+    # are locked for as short a time as possible
+    session.flush()
+    changed = session.info.pop('changed_tables', None)
+    if changed:
+        TableVersion.bump(session.connection(), changed)
+
+@sqla.event.listens_for(sqlo.Session, 'after_rollback')
+def forget_changed_tables(session):
+    session.info.pop('changed_tables', None)
+
+class RetentionCutoff(db.Model):
+    # how far back each retention tier has been applied, so a compaction run carries on where the last one stopped
+    age : sqlo.Mapped[int] = sqlo.mapped_column(primary_key=True)
+    cutoff : sqlo.Mapped[int] = sqlo.mapped_column(nullable=False)
+
+class FleetEvent(db.Model):
+    # live updates for the /events streams shared between processes, see app.main.events.DatabaseEventBackend
+    id : sqlo.Mapped[int] = sqlo.mapped_column(primary_key=True)
+    timestamp : sqlo.Mapped[int] = sqlo.mapped_column(index=True)
+    kind : sqlo.Mapped[str] = sqlo.mapped_column(sqla.String(32))
+    admin : sqlo.Mapped[bool] = sqlo.mapped_column(sqla.Boolean, default=False, nullable=False)
+    data : sqlo.Mapped[dict] = sqlo.mapped_column(sqla.JSON)
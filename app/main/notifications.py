@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from flask import current_app
+from py_vapid import Vapid, Vapid01
+from pywebpush import webpush, WebPushException
+
+# Sends web push notifications to many users at once. Pushes go out on a bounded pool of threads, every push service
+# origin gets its own requests session so connections to it are kept open and reused, and the VAPID headers are signed
+# once per origin instead of once per message. See User.send_notifications for sending to users
+
+# status is sent, failed, expired (the push service dropped the subscription, so its keys should be cleared) or no_keys,
+# and error says what went wrong when it failed
+PushResult = namedtuple('PushResult', ['user_id', 'status', 'status_code', 'error'], defaults=[None])
+
+# these status codes mean the subscription is no longer valid, ex. the user took back permission
+EXPIRED_STATUS_CODES = (401, 403, 404, 410)
+
+# how long each signed VAPID header is valid for, push services reject anything over 24 hours
+VAPID_LIFETIME = 12 * 60 * 60
+
+class NotificationDispatcher:
+    def __init__(self, vapid_private_key, contact_email, max_workers=16, timeout=10, ttl=86400):
+        if not vapid_private_key:
+            # every push fails until a key is configured, as they did when pywebpush was handed the missing key
+            self.vapid = None
+        elif isinstance(vapid_private_key, Vapid01):
+            self.vapid = vapid_private_key
+        elif os.path.isfile(vapid_private_key):
+            self.vapid = Vapid.from_file(vapid_private_key)
+        else:
+            self.vapid = Vapid.from_string(vapid_private_key)
+        self.contact_email = contact_email
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='webpush')
+        self.sessions = {}
+        self.headers = {}
+        self.lock = threading.Lock()
+
+    def session(self, origin):
+        with self.lock:
+            session = self.sessions.get(origin)
+            if session is None:
+                session = self.sessions[origin] = requests.Session()
+                # enough pooled connections for every worker thread to keep one open to the same push service
+                session.mount(origin, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers))
+            return session
+
+    def vapid_headers(self, origin):
+        if self.vapid is None:
+            raise WebPushException("VAPID_PRIVATE_KEY is not set")
+        with self.lock:
+            headers, expires = self.headers.get(origin, (None, 0))
+            # signed again a while before they run out, so a slow push never goes out with an expired header
+            if expires - time.time() < VAPID_LIFETIME / 2:
+                expires = int(time.time()) + VAPID_LIFETIME
+                headers = self.vapid.sign({'sub': 'mailto:' + self.contact_email, 'aud': origin, 'exp': expires})
+                self.headers[origin] = (headers, expires)
+            # older pywebpush versions add to the headers they are given
+            return dict(headers)
+
+    def push(self, subscription, message):
+        """Sends one message, returns its (status, status code, error)"""
+        endpoint = urlsplit(subscription['endpoint'])
+        origin = '{}://{}'.format(endpoint.scheme, endpoint.netloc)
+        try:
+            response = webpush(subscription, message, headers=self.vapid_headers(origin), ttl=self.ttl,
+                               timeout=self.timeout, requests_session=self.session(origin))
+            return 'sent', response.status_code, None
+        except WebPushException as e:
+            status_code = e.response.status_code if e.response is not None else None
+            return ('expired' if status_code in EXPIRED_STATUS_CODES else 'failed'), status_code, str(e)
+        except Exception as e:
+            # a broken subscription or an unreachable push service only fails its own recipient
+            return 'failed', None, str(e)
+
+    def send(self, recipients, message):
+        """Sends message to every (user id, endpoint, p256dh key, auth key) in recipients at once, and returns a
+        PushResult for each of them in the same order"""
+        results = []
+        for user_id, endpoint, p256dh_key, auth_key in recipients:
+            if endpoint is None or p256dh_key is None or auth_key is None:
+                results.append(PushResult(user_id, 'no_keys', None))
+            else:
+                subscription = dict(endpoint=endpoint, keys=dict(p256dh=p256dh_key, auth=auth_key))
+                try:
+                    results.append((user_id, self.executor.submit(self.push, subscription, message)))
+                except RuntimeError:
+                    # the dispatcher was replaced and closed while this send was starting, so the rest go out here
+                    results.append(PushResult(user_id, *self.push(subscription, message)))
+        return [result if isinstance(result, PushResult) else PushResult(result[0], *result[1].result())
+                for result in results]
+
+    def close(self):
+        """Waits for the pushes already handed to the pool to finish, then closes the open connections"""
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+
+dispatcher_lock = threading.Lock()
+
+def get_notification_dispatcher(contact_email):
+    """The dispatcher for the current app, made again if the fleet's contact email changed. The old one is closed
+    on its own thread once the pushes it was given are done, so sends still using it aren't cut off"""
+    with dispatcher_lock:
+        dispatcher = current_app.extensions.get('notifications')
+        if dispatcher is not None and dispatcher.contact_email == contact_email:
+            return dispatcher
+        replaced = dispatcher
+        dispatcher = current_app.extensions['notifications'] = NotificationDispatcher(
+            current_app.config['VAPID_PRIVATE_KEY'], contact_email,
+            max_workers=current_app.config['NOTIFICATION_WORKERS'], timeout=current_app.config['NOTIFICATION_TIMEOUT'])
+    if replaced is not None:
+        threading.Thread(target=replaced.close, name='webpush-close', daemon=True).start()
+    return dispatcher
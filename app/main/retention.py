@@ -0,0 +1,99 @@
+import time
+from datetime import datetime
+
+import sqlalchemy as sqla
+
+from app import db
+from app.main.models import Location, RetentionCutoff
+from app.main.archive import month_of, month_start, next_month
+
+# Thins out old location history in place. Each retention tier keeps the earliest ping of every bike in each
+# resolution sized bucket once the pings are older than the tier's age. Work is split into time windows that are
+# each committed on their own, so the table is never locked for long. Readers like get_ride_path and
+# Bike.get_locations keep querying the location table and simply see fewer points for old rides
+
+DAY = 86400
+
+def compact_window(start, end, resolution):
+    """Deletes all but the earliest location per bike and bucket of resolution seconds, for pings in [start, end).
+    Returns the number of rows removed"""
+    ranked = (sqla.select(Location.id,
+                          sqla.func.row_number().over(partition_by=(Location.bike_id, Location.timestamp // resolution),
+                                                      order_by=Location.timestamp).label('rank'))
+              .where(Location.timestamp >= start)
+              .where(Location.timestamp < end)
+              .subquery())
+    return db.session.execute(sqla.delete(Location)
+                              .where(Location.id.in_(sqla.select(ranked.c.id).where(ranked.c.rank > 1)))
+                              .execution_options(synchronize_session=False)).rowcount
+
+def compact_locations(tiers, now=None, full=False, window=DAY, pause=0):
+    """Applies each (age in days, resolution in seconds) tier, finest first. Each tier carries on from the cutoff it
+    was last applied up to, however long ago that run was. The first run of a tier, or one with full, goes through the
+    whole history. Returns {age: rows removed}"""
+    now = int(now if now is not None else datetime.now().timestamp())
+    removed = {}
+    for age, resolution in sorted(tiers):
+        cutoff = now - age * DAY
+        last = db.session.get(RetentionCutoff, age)
+        if last is not None and not full:
+            start = last.cutoff
+        else:
+            start = db.session.scalar(sqla.select(sqla.func.min(Location.timestamp)))
+        removed[age] = 0
+        if start is None or start >= cutoff:
+            continue
+
+        # windows line up with the buckets, so a bucket is never split between two transactions. A bucket cut in
+        # half by the cutoff is looked at again whole by the next run, which starts from the bucket's beginning
+        step = max(resolution, window // resolution * resolution)
+        start = start // resolution * resolution
+        while start < cutoff:
+            end = min(start + step, cutoff)
+            removed[age] += compact_window(start, end, resolution)
+            # saved with each window, so an interrupted run is picked up from the last window it finished
+            db.session.merge(RetentionCutoff(age=age, cutoff=end))
+            db.session.commit()
+            start = end
+            if pause:
+                time.sleep(pause)
+    return removed
+
+def archive_locations(archive, before, pause=0):
+    """Moves every whole month of locations before the month before ('YYYY-MM') into the archive. Every bike's month
+    is written to its file and the month marked complete before any of its rows are deleted, one bike per
+    transaction, so ride paths read each month from either the database or the archive and never half of each. An
+    interrupted run only leaves rows that the next run archives again. Returns the number of rows moved"""
+    end = month_start(before)
+    first = db.session.scalar(sqla.select(sqla.func.min(Location.timestamp)).where(Location.timestamp < end))
+    archived = set(archive.months())
+    months = [month for month in archived if month_start(month) < end]
+    if first is not None:
+        months.append(month_of(first))
+    if not months:
+        return 0
+
+    moved = 0
+    # starts from the oldest archived month, so months archived before they were marked complete get marked too
+    month = min(months)
+    while month_start(month) < end:
+        in_month = (Location.timestamp >= month_start(month), Location.timestamp < month_start(next_month(month)))
+        bike_ids = db.session.scalars(sqla.select(Location.bike_id).where(*in_month).distinct()).all()
+        for bike_id in bike_ids:
+            rows = db.session.execute(sqla.select(Location.timestamp, Location.latitude, Location.longitude)
+                                      .where(Location.bike_id == bike_id).where(*in_month)
+                                      .order_by(Location.timestamp)).all()
+            archive.write(month, bike_id, [tuple(row) for row in rows])
+            moved += len(rows)
+        db.session.commit()
+        if bike_ids or month in archived:
+            archive.complete(month)
+
+        for bike_id in bike_ids:
+            db.session.execute(sqla.delete(Location).where(Location.bike_id == bike_id).where(*in_month)
+                               .execution_options(synchronize_session=False))
+            db.session.commit()
+            if pause:
+                time.sleep(pause)
+        month = next_month(month)
+    return moved
@@ -5,8 +5,11 @@ import sqlalchemy as sqla
 from flask_login import login_required, current_user, login_user
 
 from app import db, get_nav_pages, ms_login, vapid_public_key
-from app.main.models import User, Bike, Station, Ride, Location, Report, Fleet
+from app.main.models import User, Bike, Ride, Location, Report, Fleet
 from app.main.forms import RentalForm, EndRentalForm, SetLockForm, CreateReportForm
+from app.main.map_details import get_bike_map_details, get_station_map_details
+from app.main.station_index import find_station
+from app.main.events import event_stream_response, publish_event
 from app.main import main_blueprint as bp_main
 
 # Render_template handler
@@ -113,8 +116,8 @@ def startride(bike_id):
 
         # check if user is close enough to station
         location = bike.get_current_location()
-        print(location.distance_from(Location(float(rform.lat.data), float(rform.long.data))))
-        if not (bike.station.contains(Location(float(rform.lat.data), float(rform.long.data))) or (location is not None and location.distance_from(Location(float(rform.lat.data), float(rform.long.data))) < 60)):
+        user_location = Location(float(rform.lat.data), float(rform.long.data))
+        if not (bike.station.contains(user_location) or (location is not None and location.distance_from(user_location) < 60)):
             return jsonify({'message': 'error-too-far-bike'})
 
         # update bike status and create new ride
@@ -122,6 +125,7 @@ def startride(bike_id):
         ride = Ride(bike_id=bike.id, user_id=current_user.id, completed_ride=False, positive_rating=False)
         db.session.add(ride)
         db.session.add(bike)
+        publish_event('ride', {'bike_id': bike.id, 'action': 'start', 'station_id': None})
         db.session.commit()
         return jsonify({'message': 'success', 'ride_date': ride.ride_date.replace(tzinfo=timezone.utc).timestamp() * 1000})
 
@@ -153,22 +157,19 @@ def endride(bike_id):
         if not bike.locked:
             return jsonify({'message': 'error-not-locked'})
 
-        stations = db.session.query(Station).all()
-        nearby_station = None
-        for station in stations:
-            if station.contains(Location(float(eform.lat.data), float(eform.long.data))):
-                nearby_station = station
-                break
+        nearby_station_id = find_station(float(eform.lat.data), float(eform.long.data))
 
-        if nearby_station is None:
+        if nearby_station_id is None:
             return jsonify({'message': 'error-too-far-station'})
 
         ride.completed_ride = True
         ride.positive_rating = eform.rating.data == 'positive'
         ride.duration = datetime.now(timezone.utc) - ride.ride_date.replace(tzinfo=timezone.utc)
-        bike.station_id = nearby_station.id
+        ride.update_path()
+        bike.station_id = nearby_station_id
         db.session.add(ride)
         db.session.add(bike)
+        publish_event('ride', {'bike_id': bike.id, 'action': 'end', 'station_id': nearby_station_id})
         db.session.commit()
 
         if eform.report_issue.data:
@@ -199,6 +200,7 @@ def setlock(bike_id):
         bike.locked = lform.state.data == 'locked'
         # eventually do something here to actually lock/unlock bike, for now we just update the database
         db.session.add(bike)
+        publish_event('bike', {'bike_id': bike.id, 'locked': bike.locked, 'available': bike.available, 'station_id': bike.station_id})
         db.session.commit()
 
         return jsonify({'message': 'success', 'lock_status': bike.locked})
@@ -209,19 +211,20 @@ def setlock(bike_id):
 @bp_main.route('/mapDetails', methods=['POST'])
 @login_required
 def get_map_details():
-    # Get all bikes that have a location in a list
-    bikes = db.session.scalars(sqla.select(Bike).where(Bike.station_id != None).where(Bike.available == True)).all()
-    bike_list = [bike.get_details() if bike.get_current_location() else {} for bike in bikes]
-
-    # Get all stations in a list
-    stations = db.session.scalars(sqla.select(Station)).all()
-    station_list = [station.get_details() for station in stations]
+    # Get all docked, available bikes and all stations
+    bike_list = get_bike_map_details(public=True)
+    station_list = get_station_map_details()
 
     pin_red = url_for('static', filename='pins/pin_red.svg')
     pin_orange = url_for('static', filename='pins/pin_orange.svg')
 
     return jsonify({'message':'success', 'bikes':bike_list, 'stations':station_list, 'pin_red':pin_red, 'pin_orange':pin_orange})
 
+@bp_main.route('/events')
+@login_required
+def events():
+    # the rider map's stream, admin only events such as reports and raw positions are left out of it
+    return event_stream_response(admin=False)
 
 @bp_main.route('/report/create', methods=['GET', 'POST'])
 def create_report():
@@ -236,6 +239,7 @@ def create_report():
                                 completed = False)
             print(db.session.scalars(sqla.select(Report)).all())
             db.session.add(the_report)
+            publish_event('report', {'bike_id': the_report.bike_id, 'category': the_report.category}, admin=True)
             db.session.commit()
             flash("Your report has been Submitted")
             return redirect(url_for('main.home'))
@@ -0,0 +1,134 @@
+import sqlalchemy as sqla
+import sqlalchemy.orm as sqlo
+from flask import current_app, has_app_context
+
+from app import db
+from app.main.models import User, Bike, Report
+
+# Substring search for the admin search boxes. On SQLite each searched table has an FTS5 trigram index kept in sync by
+# triggers, <table>_search, holding a copy of the searched columns and the table's primary key. On PostgreSQL the same
+# columns get pg_trgm GIN indexes, which LIKE '%term%' can use directly. Either way each table is searched on its own
+# and joined back by its key, so an OR across users and bikes doesn't turn into a scan of the whole join
+
+SEARCH_COLUMNS = {'user': ('name', 'email'), 'bike': ('name',), 'report': ('description',)}
+
+# the primary key copied into each SQLite index. user and report have no INTEGER PRIMARY KEY, so their rowids can be
+# renumbered, ex. by VACUUM or a restore from a dump, and an index keyed on them would drift away from the rows
+SEARCH_KEYS = {'user': ('id',), 'bike': ('id',), 'report': ('bike_id', 'user_id', 'timestamp')}
+
+# trigram indexes can't find anything shorter than a trigram, shorter terms fall back to LIKE
+MIN_INDEXED_LENGTH = 3
+
+def sqlite_ddl(table, keys, columns):
+    names = ', '.join(keys + columns)
+    new = ', '.join('new.' + column for column in keys + columns)
+    insert = 'INSERT INTO {0}_search ({1}) VALUES ({2});'.format(table, names, new)
+    # keys are stored but not indexed, so removing a row scans the table's index. That is only done when a row is
+    # deleted or the text it is searched by changes
+    delete = 'DELETE FROM {0}_search WHERE {1};'.format(table, ' AND '.join('{0} = old.{0}'.format(key) for key in keys))
+    unindexed = ', '.join(key + ' UNINDEXED' for key in keys)
+    return ['CREATE VIRTUAL TABLE IF NOT EXISTS {0}_search USING fts5({1}, {2}, tokenize=\'trigram\')'.format(table, unindexed, ', '.join(columns)),
+            'CREATE TRIGGER IF NOT EXISTS {0}_search_insert AFTER INSERT ON "{0}" BEGIN {1} END'.format(table, insert),
+            'CREATE TRIGGER IF NOT EXISTS {0}_search_delete AFTER DELETE ON "{0}" BEGIN {1} END'.format(table, delete),
+            'CREATE TRIGGER IF NOT EXISTS {0}_search_update AFTER UPDATE OF {1} ON "{0}" BEGIN {2} {3} END'.format(table, names, delete, insert),
+            # indexes whatever is already in the table
+            'INSERT INTO {0}_search ({1}) SELECT {1} FROM "{0}"'.format(table, names)]
+
+def postgresql_ddl(table, columns):
+    return ['CREATE INDEX IF NOT EXISTS ix_{0}_{1}_trgm ON "{0}" USING gin ({1} gin_trgm_ops)'.format(table, column) for column in columns]
+
+def existing_search_tables(connection):
+    names = ['{}_search'.format(table) for table in SEARCH_COLUMNS]
+    return set(connection.scalars(sqla.select(sqla.column('name')).select_from(sqla.table('sqlite_master'))
+                                  .where(sqla.column('name').in_(names))).all())
+
+def create_search_index(connection, rebuild=False):
+    """Creates the search index for the connection's database where it isn't there and fills it from the tables.
+    An index that already exists is left alone unless rebuild is set. Safe to run again at any time"""
+    if connection.dialect.name == 'sqlite':
+        if rebuild:
+            # also replaces an index made by an older version of this module
+            drop_search_index(connection)
+        existing = existing_search_tables(connection)
+        statements = [statement for table, columns in SEARCH_COLUMNS.items() if '{}_search'.format(table) not in existing
+                      for statement in sqlite_ddl(table, SEARCH_KEYS[table], columns)]
+    elif connection.dialect.name == 'postgresql':
+        statements = ['CREATE EXTENSION IF NOT EXISTS pg_trgm'] + [statement for table, columns in SEARCH_COLUMNS.items()
+                                                                    for statement in postgresql_ddl(table, columns)]
+    else:
+        return False
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+    if statements and has_app_context():
+        current_app.extensions.pop('search_index', None)
+    return True
+
+def drop_search_index(connection):
+    if connection.dialect.name == 'sqlite':
+        for table in SEARCH_COLUMNS:
+            # the triggers belong to the searched table, so they outlive the index unless dropped too
+            for trigger in ('insert', 'delete', 'update'):
+                connection.exec_driver_sql('DROP TRIGGER IF EXISTS {}_search_{}'.format(table, trigger))
+            connection.exec_driver_sql('DROP TABLE IF EXISTS {}_search'.format(table))
+    if has_app_context():
+        current_app.extensions.pop('search_index', None)
+
+def fts_ready():
+    """Whether the SQLite search tables exist, checked once per app"""
+    ready = current_app.extensions.get('search_index')
+    if ready is None:
+        ready = current_app.extensions['search_index'] = len(existing_search_tables(db.session.connection())) == len(SEARCH_COLUMNS)
+    return ready
+
+def fts_keys(table, term):
+    # the term is matched as one quoted phrase, so it is found anywhere in any of the table's columns
+    phrase = '"{}"'.format(term.replace('"', '""'))
+    fts = sqla.table('{}_search'.format(table), *[sqla.column(key) for key in SEARCH_KEYS[table]])
+    return sqla.select(*fts.c).where(sqla.literal_column(fts.name).op('MATCH')(phrase))
+
+def search_condition(term, users=False, bikes=False, reports=False):
+    """A where clause for rows of a query joining the chosen tables whose user name or email, bike name or report
+    description contains term. An empty term matches everything"""
+    if not term:
+        return sqla.true()
+    conditions = []
+    if db.session.get_bind().dialect.name == 'sqlite' and len(term) >= MIN_INDEXED_LENGTH and fts_ready():
+        if users:
+            conditions.append(User.id.in_(fts_keys('user', term)))
+        if bikes:
+            conditions.append(Bike.id.in_(fts_keys('bike', term)))
+        if reports:
+            conditions.append(sqla.tuple_(Report.bike_id, Report.user_id, Report.timestamp).in_(fts_keys('report', term)))
+    else:
+        # aliases keep the subqueries from being correlated with the same tables in the outer query
+        if users:
+            user = sqlo.aliased(User)
+            conditions.append(User.id.in_(sqla.select(user.id).where(sqla.or_(user.name.contains(term), user.email.contains(term)))))
+        if bikes:
+            bike = sqlo.aliased(Bike)
+            conditions.append(Bike.id.in_(sqla.select(bike.id).where(bike.name.contains(term))))
+        if reports:
+            conditions.append(Report.description.contains(term))
+    return sqla.or_(*conditions)
+
+def include_in_migrations(name, type_, parent_names):
+    # keeps alembic autogenerate from dropping the FTS5 tables and their shadow tables, which aren't in the models
+    return not (type_ == 'table' and any(name == table + '_search' or name.startswith(table + '_search_') for table in SEARCH_COLUMNS))
+
+@sqla.event.listens_for(db.metadata, 'after_create')
+def search_after_create(metadata, connection, **kw):
+    # runs on every create_all, main.initDB calls it before each request, so an index that is already there is only
+    # looked up and never refilled here
+    # the SQLite index costs nothing to set up, PostgreSQL needs the pg_trgm extension so it is left to "flask main build-search-index"
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        with connection.begin_nested():
+            create_search_index(connection)
+    except sqla.exc.OperationalError as e:
+        # SQLite builds without FTS5 or older than 3.34 have no trigram tokenizer, search falls back to LIKE there
+        print("Search index not created:", e)
+
+@sqla.event.listens_for(db.metadata, 'before_drop')
+def search_before_drop(metadata, connection, **kw):
+    drop_search_index(connection)
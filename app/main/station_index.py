@@ -0,0 +1,106 @@
+import math
+
+import sqlalchemy as sqla
+import sqlalchemy.orm as sqlo
+from flask import current_app, has_app_context
+
+from app import db
+from app.main.models import Station, TableVersion
+from app.main.geo import polygon_contains, bounding_box
+
+# Finds the station containing a point without loading every Station. Station bounding boxes are bucketed into a grid,
+# so a lookup only ray casts the few polygons whose box covers the point's cell
+
+class StationIndex:
+    # about 100m of latitude, a drop zone usually fits in one or two cells
+    CELL_SIZE = 0.001
+    # a station covering more cells than this, like one with a mistyped corner, is checked against every lookup
+    # instead of being bucketed, so it can't make the index take minutes or all of the memory to build
+    MAX_CELLS = 10000
+
+    def __init__(self, stations, cell_size=CELL_SIZE, max_cells=MAX_CELLS):
+        """stations is a list of (station id, polygon) pairs"""
+        self.cell_size = cell_size
+        self.cells = {}
+        self.oversized = []
+        self.size = 0
+        for station_id, polygon in sorted(stations, key=lambda station: station[0]):
+            box = bounding_box(polygon)
+            min_cell = self.cell(box[0], box[1])
+            max_cell = self.cell(box[2], box[3])
+            if (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1) > max_cells:
+                self.oversized.append((station_id, box, polygon))
+            else:
+                for row in range(min_cell[0], max_cell[0] + 1):
+                    for col in range(min_cell[1], max_cell[1] + 1):
+                        self.cells.setdefault((row, col), []).append((station_id, box, polygon))
+            self.size += 1
+
+    def cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size))
+
+    @staticmethod
+    def contains(box, polygon, latitude, longitude):
+        return box[0] <= latitude <= box[2] and box[1] <= longitude <= box[3] and polygon_contains(polygon, latitude, longitude)
+
+    def find(self, latitude, longitude):
+        """Returns the id of the lowest numbered station containing the point, or None"""
+        found = None
+        for station_id, box, polygon in self.cells.get(self.cell(latitude, longitude), []):
+            if self.contains(box, polygon, latitude, longitude):
+                found = station_id
+                break
+        # both lists are in id order, so only oversized stations numbered below the one found can take its place
+        for station_id, box, polygon in self.oversized:
+            if found is not None and station_id > found:
+                break
+            if self.contains(box, polygon, latitude, longitude):
+                return station_id
+        return found
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def from_database():
+        rows = db.session.execute(sqla.select(Station.id, Station.lat1, Station.long1, Station.lat2, Station.long2,
+                                              Station.lat3, Station.long3, Station.lat4, Station.long4))
+        return StationIndex([(row[0], [[row[1], row[2]], [row[3], row[4]], [row[5], row[6]], [row[7], row[8]]]) for row in rows])
+
+# each app keeps its own index, tagged with the station table's version so a change made by any worker or process
+# rebuilds it on the next lookup
+def get_station_index():
+    # stations changed but not yet committed in this session are looked up in an index that isn't kept, so one
+    # built from a change that is then rolled back never outlives it
+    if db.session.info.get('stations_changed'):
+        return StationIndex.from_database()
+    version = TableVersion.get_versions(['station'])['station']
+    cached = current_app.extensions.get('station_index')
+    if cached is None or cached[0] != version:
+        cached = current_app.extensions['station_index'] = (version, StationIndex.from_database())
+    return cached[1]
+
+def invalidate_station_index():
+    if has_app_context():
+        current_app.extensions.pop('station_index', None)
+
+def find_station(latitude, longitude):
+    return get_station_index().find(latitude, longitude)
+
+# stations changed in a session are only dropped from this worker's index once the change is committed
+@sqla.event.listens_for(Station, 'after_insert')
+@sqla.event.listens_for(Station, 'after_update')
+@sqla.event.listens_for(Station, 'after_delete')
+def station_changed(mapper, connection, station):
+    session = sqlo.object_session(station)
+    if session is not None:
+        session.info['stations_changed'] = True
+
+@sqla.event.listens_for(sqlo.Session, 'after_commit')
+def station_commit(session):
+    if session.info.pop('stations_changed', False):
+        invalidate_station_index()
+
+@sqla.event.listens_for(sqlo.Session, 'after_rollback')
+def station_rollback(session):
+    session.info.pop('stations_changed', None)
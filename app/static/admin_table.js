@@ -0,0 +1,60 @@
+// Pages through one of the admin tables' filter endpoints. Rows come a page at a time, and a refresh reloads as many
+// pages as are already shown. The server answers 304 while the table hasn't changed since the version it last sent
+class AdminTable {
+    constructor(url, page_size = 50) {
+        this.url = url;
+        this.page_size = page_size;
+        this.shown = 0;
+        this.next_cursor = null;
+        this.version = null;
+    }
+
+    // the next refresh only loads the first page, for when the filters change
+    reset() {
+        this.shown = 0;
+    }
+
+    has_more() {
+        return this.next_cursor !== null;
+    }
+
+    // one page of the table, or null when it hasn't changed since the version given
+    fetch_page(filters, cursor, since) {
+        return fetch(this.url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({...filters,
+                'limit': this.page_size,
+                'cursor': cursor,
+                'since': since
+            })
+        }).then(response => response.status === 304 ? null : response.json());
+    }
+
+    // the next page, or on a refresh the pages from the start until there are as many rows as were shown, a single
+    // page is capped by the server. null when a refresh finds the table unchanged
+    async fetch_rows(filters, more = false) {
+        let data;
+        if (more) {
+            data = await this.fetch_page(filters, this.next_cursor, null);
+        } else {
+            data = await this.fetch_page(filters, null, this.version);
+            while (data !== null && data["result"].length < this.shown && data["next_cursor"] !== null) {
+                let page = await this.fetch_page(filters, data["next_cursor"], null);
+                data = {...data, 'result': data["result"].concat(page["result"]), 'next_cursor': page["next_cursor"]};
+            }
+        }
+        if (data === null) {
+            return null;
+        }
+        if (!more) {
+            this.shown = 0;
+            this.version = data["version"];
+        }
+        this.shown += data["result"].length;
+        this.next_cursor = data["next_cursor"];
+        return data;
+    }
+}
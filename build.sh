@@ -1,7 +1,13 @@
 python3 -m venv .venv
 source .venv/bin/activate
 pip install -r requirements.txt
+# duplicate pings have to go before the migrations add the unique (bike_id, timestamp) index the ingest's ON CONFLICT
+# needs, or the upgrade fails and rolls back every other table with it
+flask main dedupe-locations
 flask db init
 flask db migrate
 flask db upgrade
+# fills in bike_position for bikes without a position, the map and the ingest's watermarks are read from it
+flask main rebuild-positions
+flask main build-search-index
 docker-compose up --build -d
\ No newline at end of file
@@ -24,3 +24,28 @@ class Config(object):
 
     VAPID_PUBLIC_KEY = os.getenv("VAPID_PUBLIC_KEY")
     VAPID_PRIVATE_KEY = os.getenv("VAPID_PRIVATE_KEY")
+
+    # location history is thinned as it ages, each tier is (age in days, seconds between the points kept after that age).
+    # raw for 30 days, one point per 5 minutes for a year, then one per hour. Run with "flask main compact-locations"
+    LOCATION_RETENTION = [(30, 300), (365, 3600)]
+
+    # whole months of locations older than this many months can be moved out of the database into .npy files
+    # with "flask main archive-locations", get_ride_path still reads them from there
+    LOCATION_ARCHIVE_DIR = os.environ.get('LOCATION_ARCHIVE_DIR') or os.path.join(basedir, 'archive', 'locations')
+    LOCATION_ARCHIVE_AFTER_MONTHS = 13
+
+    # live updates for the /events and /admin/events streams go through the fleet_event table so every web worker and
+    # the ingest service share them, "memory" keeps them inside one process. Streams are closed after
+    # EVENT_STREAM_TIMEOUT seconds and the browser reconnects where it left off. Every open stream holds a web worker
+    # thread, so gunicorn.conf.py runs gunicorn with threaded workers and the riders' open maps don't take every worker
+    EVENT_BACKEND = os.environ.get('EVENT_BACKEND') or 'database'
+    EVENT_POLL_INTERVAL = 1
+    EVENT_RETENTION = 3600
+    # how long a reader waits for a missing event id to commit before taking it as rolled back
+    EVENT_SETTLE = 5
+    EVENT_STREAM_TIMEOUT = 300
+    EVENT_HEARTBEAT = 15
+
+    # admin messages are pushed to this many users at once, each push giving up after NOTIFICATION_TIMEOUT seconds
+    NOTIFICATION_WORKERS = 16
+    NOTIFICATION_TIMEOUT = 10
@@ -0,0 +1,8 @@
+import os
+
+# Read by gunicorn from the directory it is started in. Every open /events or /admin/events stream holds a request
+# thread for up to EVENT_STREAM_TIMEOUT seconds, so workers serve requests on threads, and sync workers would be taken
+# one per open map. Bind address and certificates are left to the command line
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS') or 2)
+threads = int(os.environ.get('GUNICORN_THREADS') or 100)
@@ -0,0 +1,47 @@
+import os,glob,base64
+from os.path import join
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+class Keyring:
+    """Holds each tag's private key by hashed advertisement key. The elliptic curve key objects are derived once
+    and reused for every report, instead of once per report"""
+
+    def __init__(self, private_values=None, names=None):
+        self.private_values = dict(private_values or {})
+        self.names = dict(names or {})
+        self._private_keys = {}
+
+    @classmethod
+    def load(cls, keysDir):
+        keyring = cls()
+        for keyfile in glob.glob(join(keysDir, '*.keys')):
+            # read key files generated with generate_keys.py
+            print("Located key file at:", keyfile)
+            with open(keyfile) as f:
+                hashed_adv = priv = ''
+                name = os.path.basename(keyfile)[0:-5]
+                for line in f:
+                    key = line.strip().split(': ')
+                    if key[0] == 'Private key': priv = key[1]
+                    elif key[0] == 'Hashed adv key': hashed_adv = key[1]
+
+                if priv and hashed_adv:
+                    keyring.add(hashed_adv, name, int.from_bytes(base64.b64decode(priv), 'big'))
+                else: print(f"Couldn't find key pair in {keyfile}")
+        return keyring
+
+    def add(self, hashed_adv, name, private_value):
+        self.private_values[hashed_adv] = private_value
+        self.names[hashed_adv] = name
+        self._private_keys.pop(hashed_adv, None)
+
+    def private_key(self, hashed_adv):
+        key = self._private_keys.get(hashed_adv)
+        if key is None:
+            key = ec.derive_private_key(self.private_values[hashed_adv], ec.SECP224R1())
+            self._private_keys[hashed_adv] = key
+        return key
+
+    def __len__(self):
+        return len(self.private_values)
@@ -0,0 +1,88 @@
+import io
+import time
+
+from sqlalchemy import text
+
+from app.main.models import BikePosition
+
+# skips reports already stored by an earlier fetch, see the unique (bike_id, timestamp) index on app.main.models.Location
+LOCATION_UPSERT = text("INSERT INTO location (bike_id, timestamp, latitude, longitude) "
+                       "VALUES (:bike_id, :timestamp, :latitude, :longitude) "
+                       "ON CONFLICT (bike_id, timestamp) DO NOTHING")
+
+# PostgreSQL batches are copied into a session temp table, then moved over with the same conflict handling as LOCATION_UPSERT
+STAGING_CREATE = ("CREATE TEMP TABLE IF NOT EXISTS location_staging "
+                  "(bike_id integer, timestamp integer, latitude double precision, longitude double precision) "
+                  "ON COMMIT DELETE ROWS")
+STAGING_COPY = "COPY location_staging (bike_id, timestamp, latitude, longitude) FROM STDIN"
+STAGING_MOVE = ("INSERT INTO location (bike_id, timestamp, latitude, longitude) "
+                "SELECT bike_id, timestamp, latitude, longitude FROM location_staging "
+                "ON CONFLICT (bike_id, timestamp) DO NOTHING")
+
+class LocationWriter:
+    """Writes decoded tags to the location table in batches of batch_size as they arrive, and keeps
+    bike_position up to date. Only one batch and one position per key are held at a time.
+    Nothing is committed, the caller commits the connection once the writer is closed"""
+
+    def __init__(self, connection, batch_size=500):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.postgres = connection.dialect.name == 'postgresql'
+        self.batch = []
+        self.positions = {}
+        self.written = 0
+        self.write_time = 0
+
+    def add(self, tag):
+        self.batch.append({'bike_id': tag['key'], 'timestamp': tag['timestamp'],
+                           'latitude': tag['lat'], 'longitude': tag['lon']})
+
+        # tags can arrive in any order, so only a newer one replaces the position kept for its key
+        position = self.positions.get(tag['key'])
+        if position is None or tag['timestamp'] >= position['timestamp']:
+            self.positions[tag['key']] = {'bike_id': tag['key'], 'timestamp': tag['timestamp'],
+                                          'latitude': tag['lat'], 'longitude': tag['lon'], 'confidence': tag['conf']}
+
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def write(self, tags):
+        """Adds every tag from an iterable or generator, returns the number of new locations written so far"""
+        for tag in tags:
+            self.add(tag)
+        return self.written
+
+    def flush(self):
+        if not self.batch:
+            return
+        start = time.perf_counter()
+        # only the rows actually inserted are counted, ones already stored are skipped by the conflict handling
+        if self.postgres:
+            self.written += self.copy_batch(self.batch)
+        else:
+            self.written += self.connection.execute(LOCATION_UPSERT, self.batch).rowcount
+        self.batch = []
+        self.write_time += time.perf_counter() - start
+
+    def copy_batch(self, rows):
+        # COPY goes through the psycopg2 cursor, which shares the connection's open transaction
+        buffer = io.StringIO(''.join(f"{row['bike_id']}\t{row['timestamp']}\t{row['latitude']!r}\t{row['longitude']!r}\n" for row in rows))
+        cursor = self.connection.connection.cursor()
+        try:
+            cursor.execute(STAGING_CREATE)
+            cursor.copy_expert(STAGING_COPY, buffer)
+            cursor.execute(STAGING_MOVE)
+            inserted = cursor.rowcount
+            cursor.execute("TRUNCATE location_staging")
+            return inserted
+        finally:
+            cursor.close()
+
+    def close(self):
+        """Writes the last partial batch and the newest position of every key seen"""
+        self.flush()
+        if self.positions:
+            start = time.perf_counter()
+            self.connection.execute(BikePosition.UPSERT, list(self.positions.values()))
+            self.write_time += time.perf_counter() - start
+        return self.written
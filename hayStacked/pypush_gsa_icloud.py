@@ -1,4 +1,7 @@
 from getpass import getpass
+import os
+import threading
+import time
 import plistlib as plist
 import json
 import uuid
@@ -145,20 +148,69 @@ def generate_cpd():
     cpd.update(generate_anisette_headers())
     return cpd
 
-_ani_headers = None
-def generate_anisette_headers():
-    global _ani_headers
-    if _ani_headers is None:
-        print(f'Querying {ANISETTE_URL} for an anisette server')
-        h = json.loads(requests.get(ANISETTE_URL, timeout=5).text)
+class AnisetteHeaders:
+    """Caches the headers from the anisette server for ttl seconds. A timer fetches fresh ones refresh_margin
+    seconds before they expire, so callers never wait on the anisette server or send Apple stale headers"""
+
+    def __init__(self, url=ANISETTE_URL, ttl=600, refresh_margin=60):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        # keeps the connection to the anisette server open between fetches
+        self.session = requests.Session()
+        self.fetched_at = None
+        self._headers = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def fetch(self):
+        print(f'Querying {self.url} for an anisette server')
+        h = json.loads(self.session.get(self.url, timeout=5).text)
         a = {"X-Apple-I-MD": h["X-Apple-I-MD"], "X-Apple-I-MD-M": h["X-Apple-I-MD-M"]}
         a.update(generate_meta_headers(user_id=USER_ID, device_id=DEVICE_ID))
-        _ani_headers = a
-    return _ani_headers
+        with self._lock:
+            self._headers = a
+            self.fetched_at = time.time()
+            self._schedule_refresh()
+        return a
+
+    def _schedule_refresh(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(self.ttl - self.refresh_margin, 0), self._refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self):
+        try:
+            self.fetch()
+        except Exception as e:
+            # the next get() fetches synchronously once the cached headers expire
+            print("Background anisette refresh failed:", e)
+
+    def get(self):
+        with self._lock:
+            headers = self._headers
+            fresh = self.fetched_at is not None and time.time() - self.fetched_at < self.ttl
+        if headers is None or not fresh:
+            headers = self.fetch()
+        return dict(headers)
+
+    def reset(self):
+        with self._lock:
+            self._headers = None
+            self.fetched_at = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+_anisette = AnisetteHeaders(ttl=int(os.environ.get("ANISETTE_TTL", 600)))
+
+def generate_anisette_headers():
+    return _anisette.get()
 
 def reset_headers():
-    global _ani_headers
-    _ani_headers = None
+    _anisette.reset()
 
 def generate_meta_headers(serial="0", user_id=uuid.uuid4(), device_id=uuid.uuid4()):
     return {
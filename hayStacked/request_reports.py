@@ -1,18 +1,21 @@
 #!/usr/bin/env python3
-import os,glob,datetime,time
+import os,datetime,time
 import base64,json
 import hashlib,struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import requests
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.asymmetric import ec
-from os.path import dirname, join, abspath
+from os.path import abspath
 
 from sqlalchemy import text
 
 from hayStacked.pypush_gsa_icloud import generate_anisette_headers, reset_headers
+from hayStacked.keyring import Keyring
+from hayStacked.location_writer import LocationWriter
 
-retryCount = 0
+FETCH_URL = "https://gateway.icloud.com/acsnservice/fetch"
 
 def getKeysDir():
     return abspath(os.path.join('hayStacked', 'keys'))
@@ -33,6 +36,57 @@ def decode_tag(data):
     status = int.from_bytes(data[9:10], 'big')
     return {'lat': latitude, 'lon': longitude, 'conf': confidence, 'status':status}
 
+def decrypt_report(private_key, data, timestamp, name):
+    # the following is all copied from https://github.com/hatomist/openhaystack-python, thanks @hatomist!
+    eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), data[5:62])
+    shared_key = private_key.exchange(ec.ECDH(), eph_key)
+    symmetric_key = sha256(shared_key + b'\x00\x00\x00\x01' + data[5:62])
+    decryption_key = symmetric_key[:16]
+    iv = symmetric_key[16:]
+    enc_data = data[62:72]
+    tag = data[72:]
+
+    decrypted = decrypt(enc_data, algorithms.AES(decryption_key), modes.GCM(iv, tag))
+    tag = decode_tag(decrypted)
+    tag['timestamp'] = timestamp
+    tag['isodatetime'] = datetime.datetime.fromtimestamp(timestamp).isoformat()
+    tag['key'] = name
+    tag['goog'] = 'https://maps.google.com/maps?q=' + str(tag['lat']) + ',' + str(tag['lon'])
+    return tag
+
+# key objects can't be sent to other processes, so each pool worker builds its own keyring once when it starts
+_worker_keyring = None
+
+def init_decrypt_worker(private_values):
+    global _worker_keyring
+    _worker_keyring = Keyring(private_values)
+
+def create_decrypt_pool(keyring, workers):
+    """Returns a process pool whose workers hold a copy of the keyring, reusable across runs with the same keys"""
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_decrypt_worker, initargs=(keyring.private_values,))
+
+def decrypt_batch(jobs, keyring=None):
+    keyring = keyring or _worker_keyring
+    return [decrypt_report(keyring.private_key(hashed_adv), data, timestamp, name) for hashed_adv, data, timestamp, name in jobs]
+
+def decrypt_reports(jobs, keyring, workers=1, batch_size=64, executor=None):
+    """Decrypts (hashed adv key, payload, timestamp, key name) jobs and returns the tags oldest first.
+    With more than one worker, batches are spread over a process pool. Pass an executor from create_decrypt_pool to reuse one between runs"""
+    if workers <= 1 and executor is None:
+        ordered = decrypt_batch(jobs, keyring)
+    else:
+        batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+        if executor is None:
+            with create_decrypt_pool(keyring, workers) as pool:
+                results = list(pool.map(decrypt_batch, batches))
+        else:
+            results = list(executor.map(decrypt_batch, batches))
+        # map keeps the batches in submission order, so the sort below gives the same order as the serial path
+        ordered = [tag for batch in results for tag in batch]
+
+    ordered.sort(key=lambda item: item.get('timestamp'))
+    return ordered
+
 def getAuth(authFile):
     print("Searching for auth.json at:", authFile)
     if os.path.exists(authFile):
@@ -42,9 +96,106 @@ def getAuth(authFile):
         raise Exception("Please provide auth.json")
 
 
-def request_reports(anisette, database, authFile, keysDir, hours=24):
-    global retryCount
+def get_watermarks(connection):
+    """Returns the newest stored report timestamp for each key name. Reports at or before it are already in the database"""
+    try:
+        rows = connection.execute(text("SELECT bike_id, timestamp FROM bike_position")).all()
+    except Exception as e:
+        print("Couldn't read watermarks, fetching the full window:", e)
+        connection.rollback()
+        return {}
+    return {str(bike_id): timestamp for bike_id, timestamp in rows}
+
+def build_search(names, watermarks, startdate, enddate):
+    """Groups key IDs by the time they need reports from, so each key only asks for what is newer than its watermark"""
+    starts = {}
+    for hashed_adv, name in names.items():
+        start = max(startdate, watermarks.get(name, 0) + 1)
+        starts.setdefault(start, []).append(hashed_adv)
+    return [{"startDate": start *1000, "endDate": enddate *1000, "ids": ids} for start, ids in sorted(starts.items())]
+
+class AnisetteError(Exception):
+    pass
+
+class FetchError(Exception):
+    pass
+
+def chunk_ids(ids, chunk_size):
+    return [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+def fetch_chunk(session, url, auth, body, retries=3):
+    """Posts one search to the fetch endpoint and returns its reports. Rejected anisette headers are refreshed and retried"""
+    for attempt in range(retries + 1):
+        r = session.post(url, auth=auth, headers=generate_anisette_headers(), json=body)
+        if r.status_code != 401:
+            break
+        reset_headers()
+    else:
+        raise AnisetteError("Request_reports unable to start anisette, 401")
 
+    try:
+        r.raise_for_status()
+    except requests.HTTPError as e:
+        raise FetchError(f"HTTP error: {e}") from e
+    res = r.json()['results']
+    print(f'{r.status_code}: {len(res)} reports received.')
+    return res
+
+def parse_reports(res, names, watermarks, startdate):
+    """Turns fetched reports into decrypt jobs, dropping the ones outside the window or already stored"""
+    jobs = []
+    skipped = 0
+    for report in res:
+        data = base64.b64decode(report['payload'].replace('\n', '').replace('\r', ''))
+        if len(data) > 88: data = data[:4] + data[5:]
+
+        timestamp = int.from_bytes(data[0:4], 'big') +978307200
+        # the timestamp isn't encrypted, so reports we already stored are dropped before any key exchange
+        if timestamp <= watermarks.get(names[report['id']], 0):
+            skipped += 1
+        elif timestamp >= startdate:
+            jobs.append((report['id'], data, timestamp, names[report['id']]))
+    return jobs, skipped
+
+def stream_tags(bodies, session, url, auth, keyring, watermarks, startdate, fetch_threads=4, workers=1, executor=None, stats=None):
+    """Fetches each search body over fetch_threads threads and yields its decrypted tags as soon as the chunk arrives.
+    Report counts and fetch and decrypt times are added to stats, and the error of each chunk that failed to stats['errors']"""
+    names = keyring.names
+    stats = stats if stats is not None else {}
+    for key in ('received', 'skipped', 'fetch', 'decrypt'):
+        stats.setdefault(key, 0)
+    stats.setdefault('errors', [])
+
+    with ThreadPoolExecutor(max_workers=fetch_threads) as fetcher:
+        futures = [fetcher.submit(fetch_chunk, session, url, auth, body) for body in bodies]
+        for future in as_completed(futures):
+            wait_start = time.perf_counter()
+            try:
+                res = future.result()
+            except FetchError as e:
+                # the other chunks are still stored, the run fails once they are
+                print(e)
+                stats['errors'].append(str(e))
+                continue
+            decrypt_start = time.perf_counter()
+
+            jobs, chunk_skipped = parse_reports(res, names, watermarks, startdate)
+            tags = decrypt_reports(jobs, keyring, workers=workers, executor=executor)
+            stats['received'] += len(res)
+            stats['skipped'] += chunk_skipped
+
+            stats['fetch'] += decrypt_start - wait_start
+            stats['decrypt'] += time.perf_counter() - decrypt_start
+            yield from tags
+
+def request_reports(anisette, database, authFile, keysDir, hours=24, workers=1, keyring=None, session=None, executor=None,
+                    chunk_size=100, fetch_threads=4, fetch_url=FETCH_URL, batch_size=500):
+    """Fetches and stores new reports for every key. anisette is terminated when finished, pass None to leave it running.
+    A keyring, requests session and decrypt pool can be passed in to reuse them between runs. Key IDs are fetched in
+    chunks of chunk_size over fetch_threads threads, and each chunk is decrypted and written in batches of batch_size
+    as soon as it arrives. Returns the report counts, or raises FetchError once the chunks that did arrive are stored
+    if any fetch failed"""
+    sqla = None
     try:
         try:
             sqla = database.connect()
@@ -52,103 +203,46 @@ def request_reports(anisette, database, authFile, keysDir, hours=24):
             print("Error connecting to local database. Is it in use?")
             print("SQLAlchemy error: ", e)
 
-        privkeys = {}
-        names = {}
-        for keyfile in glob.glob(join(keysDir, '*.keys')):
-            # read key files generated with generate_keys.py
-            print("Located key file at:", keyfile)
-            with open(keyfile) as f:
-                hashed_adv = priv = ''
-                name = os.path.basename(keyfile)[0:-5]
-                for line in f:
-                    key = line.strip().split(': ')
-                    if key[0] == 'Private key': priv = key[1]
-                    elif key[0] == 'Hashed adv key': hashed_adv = key[1]
-
-                if priv and hashed_adv:
-                    privkeys[hashed_adv] = priv
-                    names[hashed_adv] = name
-                else: print(f"Couldn't find key pair in {keyfile}")
+        if keyring is None:
+            keyring = Keyring.load(keysDir)
+        names = keyring.names
 
         unixEpoch = int(time.time())
         startdate = unixEpoch - (60 * 60 * hours)
-        data = { "search": [{"startDate": startdate *1000, "endDate": unixEpoch *1000, "ids": list(names.keys())}] }
+        watermarks = get_watermarks(sqla)
+        auth = getAuth(authFile)
+        bodies = [{ "search": build_search({hashed_adv: names[hashed_adv] for hashed_adv in chunk}, watermarks, startdate, unixEpoch) }
+                  for chunk in chunk_ids(list(names.keys()), chunk_size)]
+
+        own_executor = None
+        if executor is None and workers > 1:
+            executor = own_executor = create_decrypt_pool(keyring, workers)
 
-        r = requests.post("https://gateway.icloud.com/acsnservice/fetch",
-                auth=getAuth(authFile),
-                headers=generate_anisette_headers(),
-                json=data)
-        print(r)
+        stats = {}
+        writer = LocationWriter(sqla, batch_size)
         try:
-            r.raise_for_status()
-        except requests.HTTPError as e:
-            if r.status_code == 401:
-                if retryCount < 3:
-                    reset_headers()
-                    retryCount += 1
-                    return request_reports(anisette, database, authFile, keysDir, hours)
-                else:
-                    print("Request_reports unable to start anisette, 401")
-                    anisette.terminate()
-                    return None
-            else:
-                print(f"HTTP error: {e}")
-        res = json.loads(r.content.decode())['results']
-        print(f'{r.status_code}: {len(res)} reports received.')
-
-        ordered = []
-        found = set()
-        for report in res:
-            priv = int.from_bytes(base64.b64decode(privkeys[report['id']]), 'big')
-            data = base64.b64decode(report['payload'].replace('\n', '').replace('\r', ''))
-            if len(data) > 88: data = data[:4] + data[5:]
-
-            # the following is all copied from https://github.com/hatomist/openhaystack-python, thanks @hatomist!
-            timestamp = int.from_bytes(data[0:4], 'big') +978307200
-            if timestamp >= startdate:
-                eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), data[5:62])
-                shared_key = ec.derive_private_key(priv, ec.SECP224R1()).exchange(ec.ECDH(), eph_key)
-                symmetric_key = sha256(shared_key + b'\x00\x00\x00\x01' + data[5:62])
-                decryption_key = symmetric_key[:16]
-                iv = symmetric_key[16:]
-                enc_data = data[62:72]
-                tag = data[72:]
-
-                decrypted = decrypt(enc_data, algorithms.AES(decryption_key), modes.GCM(iv, tag))
-                tag = decode_tag(decrypted)
-                tag['timestamp'] = timestamp
-                tag['isodatetime'] = datetime.datetime.fromtimestamp(timestamp).isoformat()
-                tag['key'] = names[report['id']]
-                tag['goog'] = 'https://maps.google.com/maps?q=' + str(tag['lat']) + ',' + str(tag['lon'])
-                found.add(tag['key'])
-                ordered.append(tag)
-        print(f'{len(ordered)} reports used.')
-        ordered.sort(key=lambda item: item.get('timestamp'))
-        print("Found reports:")
-        for rep in ordered: print(f"('{rep['key']}', {rep['timestamp']}, '{rep['isodatetime']}', '{rep['lat']}', '{rep['lon']}', '{rep['goog']}', {rep['status']}, {rep['conf']})")
-
-        parameters_to_insert = []
-        for rep in ordered:
-            parameters_to_insert.append({
-                'bike_id': rep['key'],
-                'timestamp': rep['timestamp'],
-                'latitude': rep['lat'],
-                'longitude': rep['lon']
-            })
-
-        if parameters_to_insert:
-            sqla.execute(
-                text("INSERT OR REPLACE INTO location (bike_id, timestamp, latitude, longitude) VALUES (:bike_id, :timestamp, :latitude, :longitude)"),
-                parameters_to_insert
-            )
+            writer.write(stream_tags(bodies, session or requests, fetch_url, auth, keyring, watermarks, startdate,
+                                     fetch_threads=fetch_threads, workers=workers, executor=executor, stats=stats))
+        finally:
+            if own_executor is not None: own_executor.shutdown()
+        used = writer.close()
+        sqla.commit()
+        if stats['errors']:
+            raise FetchError(f"{len(stats['errors'])} of {len(bodies)} fetches failed: {stats['errors'][0]}")
 
+        found = set(writer.positions)
+        print(f"{stats['received']} reports received, {used} used, {stats['skipped']} already stored.")
         print(f'found:   {list(found)}')
         print(f'missing: {[key for key in names.values() if key not in found]}')
-        sqla.commit()
-        sqla.close()
-        retryCount = 0
+        return {'received': stats['received'], 'used': used, 'skipped': stats['skipped'], 'found': len(found), 'keys': len(names),
+                'timings': {'fetch': stats['fetch'], 'decrypt': stats['decrypt'], 'write': writer.write_time}}
+    except AnisetteError as e:
+        print(e)
+        return None
     except Exception as e:
         print("Error getting reports:")
         raise e
     finally:
-        anisette.terminate()
\ No newline at end of file
+        # closing rolls back whatever a failed run left uncommitted, so a resident service doesn't leak a connection per failure
+        if sqla is not None: sqla.close()
+        if anisette is not None: anisette.terminate()
@@ -1,45 +1,232 @@
-import os
+import os, glob, json, time, argparse
+from datetime import datetime, timedelta, timezone
 import threading, platform, subprocess
-from os.path import abspath
+from os.path import abspath, join
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import requests
 from sqlalchemy import create_engine
 
-from hayStacked.request_reports import request_reports
+from config import Config
+from hayStacked.keyring import Keyring
+from hayStacked.pypush_gsa_icloud import ANISETTE_URL
+from hayStacked.request_reports import request_reports, create_decrypt_pool, AnisetteError, FETCH_URL
+from app.main.docking import dock_bikes
+from app.main.models import Ride
+from app.main.events import DatabaseEventBackend, position_timestamps, publish_positions
 
-anisette = None
-
-db = create_engine('sqlite:///gears.db')
 auth = abspath(os.path.join("secrets", "auth.json"))
 keys = abspath(os.path.join("secrets", "keys"))
+# number of processes used to decrypt reports, 1 decrypts in this process
+workers = int(os.environ.get("INGEST_WORKERS", 1))
+# seconds between fetches when running as a service
+interval = int(os.environ.get("INGEST_INTERVAL", 900))
+# port serving the service's health and last cycle timings as JSON
+health_port = int(os.environ.get("INGEST_HEALTH_PORT", 6970))
+# number of key IDs sent in each fetch request, and how many requests run at once
+chunk_size = int(os.environ.get("INGEST_CHUNK_SIZE", 100))
+fetch_threads = int(os.environ.get("INGEST_FETCH_THREADS", 4))
+# number of locations written to the database in each insert
+batch_size = int(os.environ.get("INGEST_BATCH_SIZE", 500))
+# set to 0 to stop docking bikes to the station they were found at after each fetch
+auto_dock = os.environ.get("INGEST_AUTO_DOCK", "1") != "0"
+# new positions and dockings are sent to the web app's /events streams through the fleet_event table
+publish_events = Config.EVENT_BACKEND == 'database'
 
-def getLocations():
-    """Queries the Apple server to get Tag locations. Writes locations to local database"""
-
-    global anisette
-    anisette = None
-    if anisette is None:
-        def start_anisette():
-            global anisette
-            print("started anisette")
-            if platform.system() == "Windows":
-                anisette = subprocess.Popen("./hayStacked/anisette-v3-server/anisette-v3-server.exe")
-            else:
-                anisette = subprocess.Popen("./hayStacked/anisette-v3-server/anisette-v3-server")
-            output, error = anisette.communicate()
-            anisette.wait()
-            anisette.terminate()
-            # anisette = None
-
-        print("Attempting to start anisette...")
-
-        threading.Thread(target=start_anisette, daemon=True).start()
-
-        print("Anisette instance:", anisette)
-
-        request_reports(anisette, db, auth, keys, hours=24)
-        # t = threading.Timer(1, lambda: threading.Thread(target=request_reports, args=(anisette, db), daemon=True).start())
-        # t.start()
+def start_anisette():
+    print("Attempting to start anisette...")
+    if platform.system() == "Windows":
+        return subprocess.Popen("./hayStacked/anisette-v3-server/anisette-v3-server.exe")
     else:
-        print("Hold on, another instance of anisette is running.")
+        return subprocess.Popen("./hayStacked/anisette-v3-server/anisette-v3-server")
+
+class IngestService:
+    """Queries the Apple server for Tag locations on an interval. The anisette server, the keyring, the HTTP
+    connections and the database engine are kept alive between cycles instead of being set up for every fetch"""
+
+    def __init__(self, database_url, authFile, keysDir, interval=900, hours=24, workers=1,
+                 chunk_size=100, fetch_threads=4, fetch_url=FETCH_URL, batch_size=500, auto_dock=True, publish_events=True):
+        self.authFile = authFile
+        self.keysDir = keysDir
+        self.interval = interval
+        self.hours = hours
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.fetch_threads = fetch_threads
+        self.fetch_url = fetch_url
+        self.batch_size = batch_size
+        self.auto_dock = auto_dock
+
+        self.engine = create_engine(database_url)
+        self.events = DatabaseEventBackend(self.engine) if publish_events else None
+        self.session = requests.Session()
+        # enough pooled connections for every fetch thread to keep its own open
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max(fetch_threads, 10)))
+        self.anisette = None
+        self.keyring = None
+        self.keys_version = None
+        self.executor = None
+
+        self.cycles = 0
+        self.failures = 0
+        self.last_cycle = None
+        self.last_error = None
+        self.stopped = threading.Event()
+
+    def ensure_anisette(self):
+        # restart anisette if it was never started or has exited
+        if self.anisette is None or self.anisette.poll() is not None:
+            self.anisette = start_anisette()
+            self.wait_for_anisette()
+
+    def wait_for_anisette(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.anisette.poll() is None:
+            try:
+                self.session.get(ANISETTE_URL, timeout=1)
+                return True
+            except requests.RequestException:
+                time.sleep(0.5)
+        print("Anisette didn't respond within", timeout, "seconds")
+        return False
+
+    def ensure_keyring(self):
+        # only re-read the key files when one has been added, removed or changed
+        keyfiles = glob.glob(join(self.keysDir, '*.keys'))
+        version = (len(keyfiles), max((os.path.getmtime(f) for f in keyfiles), default=0))
+        if self.keyring is None or version != self.keys_version:
+            self.keyring = Keyring.load(self.keysDir)
+            self.keys_version = version
+
+            # pool workers hold their own copy of the keys, so they are replaced along with the keyring
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            if self.workers > 1:
+                self.executor = create_decrypt_pool(self.keyring, self.workers)
+
+    def run_cycle(self):
+        started = time.time()
+        setup_start = time.perf_counter()
+        self.ensure_anisette()
+        self.ensure_keyring()
+        setup = time.perf_counter() - setup_start
+
+        cycle_start = time.perf_counter()
+        if self.events is not None:
+            with self.engine.connect() as connection:
+                positions_before = position_timestamps(connection)
+        result = request_reports(None, self.engine, self.authFile, self.keysDir, self.hours, self.workers,
+                                 self.keyring, self.session, self.executor,
+                                 self.chunk_size, self.fetch_threads, self.fetch_url, self.batch_size)
+        # request_reports only returns None when anisette headers were rejected, which has to count as a failed cycle
+        if result is None:
+            raise AnisetteError("Anisette headers were rejected")
+        timings = result.pop('timings', {})
+
+        if self.auto_dock:
+            dock_start = time.perf_counter()
+            with self.engine.begin() as connection:
+                result['docked'] = dock_bikes(connection)
+            timings['dock'] = time.perf_counter() - dock_start
+
+        # reports can arrive well after a ride ends, so rides inside the fetch window get their stored path rebuilt
+        paths_start = time.perf_counter()
+        with self.engine.begin() as connection:
+            since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=self.hours)
+            result['ride_paths'] = Ride.update_paths(since, connection, self.events)
+        timings['ride_paths'] = time.perf_counter() - paths_start
 
-getLocations()
\ No newline at end of file
+        if self.events is not None:
+            with self.engine.begin() as connection:
+                publish_positions(self.events, connection, positions_before)
+                if result.get('docked'):
+                    self.events.publish('dock', {'docked': result['docked']}, connection=connection)
+        timings = dict(timings, setup=setup, total=time.perf_counter() - cycle_start + setup)
+
+        self.cycles += 1
+        self.last_cycle = {'started': started, 'timings': timings, 'reports': result}
+        self.last_error = None
+        return self.last_cycle
+
+    def health(self):
+        if self.last_error is not None:
+            status = 'failing'
+        elif self.last_cycle is None:
+            status = 'starting'
+        else:
+            status = 'ok'
+        return {'status': status, 'cycles': self.cycles, 'failures': self.failures,
+                'anisette_running': self.anisette is not None and self.anisette.poll() is None,
+                'keys': len(self.keyring) if self.keyring else 0,
+                'interval': self.interval, 'last_cycle': self.last_cycle, 'last_error': self.last_error}
+
+    def serve_health(self, port):
+        service = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                health = service.health()
+                body = json.dumps(health).encode()
+                self.send_response(200 if health['status'] != 'failing' else 503)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), HealthHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving ingest health on http://127.0.0.1:{server.server_address[1]}")
+        return server
+
+    def run_forever(self):
+        while not self.stopped.is_set():
+            try:
+                self.run_cycle()
+                print(f"Ingest cycle {self.cycles} finished:", self.last_cycle['timings'])
+            except Exception as e:
+                self.failures += 1
+                self.last_error = repr(e)
+                print("Ingest cycle failed:", e)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.anisette is not None:
+            self.anisette.terminate()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.session.close()
+        self.engine.dispose()
+
+def getLocations():
+    """Queries the Apple server once to get Tag locations. Writes locations to local database"""
+    service = IngestService(Config.SQLALCHEMY_DATABASE_URI, auth, keys, workers=workers,
+                            chunk_size=chunk_size, fetch_threads=fetch_threads, batch_size=batch_size, auto_dock=auto_dock, publish_events=publish_events)
+    try:
+        return service.run_cycle()
+    finally:
+        service.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch tag locations into the database")
+    parser.add_argument('--once', action='store_true', help="run a single fetch and exit")
+    parser.add_argument('--interval', type=int, default=interval, help="seconds between fetches")
+    parser.add_argument('--health-port', type=int, default=health_port)
+    args = parser.parse_args()
+
+    if args.once:
+        getLocations()
+    else:
+        service = IngestService(Config.SQLALCHEMY_DATABASE_URI, auth, keys, interval=args.interval, workers=workers,
+                                chunk_size=chunk_size, fetch_threads=fetch_threads, batch_size=batch_size, auto_dock=auto_dock, publish_events=publish_events)
+        service.serve_health(args.health_port)
+        try:
+            service.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.stop()
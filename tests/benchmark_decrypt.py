@@ -0,0 +1,52 @@
+import argparse
+import base64
+import os
+import time
+
+from hayStacked.keyring import Keyring
+from hayStacked.request_reports import decrypt_reports
+from tests.synthetic_reports import generate_key, encrypt_report
+
+# Compares serial and process pool report decryption on locally generated reports.
+# Run with: python -m tests.benchmark_decrypt --tags 100 --reports 5000 --workers 4
+
+def build_jobs(tags, reports):
+    keyring = Keyring()
+    keys = []
+    for i in range(tags):
+        hashed_adv, private = generate_key()
+        keyring.add(hashed_adv, str(i), int.from_bytes(base64.b64decode(private), 'big'))
+        keys.append((hashed_adv, private))
+
+    now = int(time.time())
+    jobs = []
+    for i in range(reports):
+        hashed_adv, private = keys[i % tags]
+        report = encrypt_report(hashed_adv, private, now - (i * 7919) % 86400, 42.27, -71.80)
+        data = base64.b64decode(report['payload'])
+        jobs.append((hashed_adv, data, int.from_bytes(data[0:4], 'big') + 978307200, keyring.names[hashed_adv]))
+    return keyring, jobs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare serial and process pool report decryption")
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--reports', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"Generating {args.reports} reports for {args.tags} tags...")
+    keyring, jobs = build_jobs(args.tags, args.reports)
+
+    start = time.perf_counter()
+    serial = decrypt_reports(jobs, keyring)
+    serial_time = time.perf_counter() - start
+    print(f"serial:            {serial_time:.3f}s ({args.reports / serial_time:.0f} reports/s)")
+
+    start = time.perf_counter()
+    parallel = decrypt_reports(jobs, keyring, workers=args.workers, batch_size=args.batch_size)
+    parallel_time = time.perf_counter() - start
+    print(f"{args.workers} workers:         {parallel_time:.3f}s ({args.reports / parallel_time:.0f} reports/s)")
+
+    assert parallel == serial, "parallel results differ from the serial path"
+    print(f"speedup: {serial_time / parallel_time:.2f}x")
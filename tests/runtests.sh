@@ -2,5 +2,6 @@
 
 source .venv/bin/activate
 coverage run -m unittest tests/test_models.py
-coverage run -m pytest tests/test_routes.py
+coverage run -a -m unittest tests/test_request_reports.py
+coverage run -a -m pytest tests/test_routes.py
 coverage report -m
\ No newline at end of file
@@ -0,0 +1,36 @@
+import base64, hashlib, os, struct
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+# Generates tag keys and encrypted location reports in the same format Apple's fetch endpoint returns,
+# so the ingest can be exercised offline
+
+def generate_key():
+    """Returns a (hashed advertisement key, private key) pair, both base64 encoded like a .keys file"""
+    private_key = ec.generate_private_key(ec.SECP224R1())
+    adv = private_key.public_key().public_numbers().x.to_bytes(28, 'big')
+    hashed_adv = base64.b64encode(hashlib.sha256(adv).digest()).decode()
+    private = base64.b64encode(private_key.private_numbers().private_value.to_bytes(28, 'big')).decode()
+    return hashed_adv, private
+
+def write_keyfile(keysDir, name, hashed_adv, private):
+    with open(os.path.join(keysDir, name + '.keys'), 'w') as f:
+        f.write(f"Private key: {private}\nHashed adv key: {hashed_adv}\n")
+
+def encrypt_report(hashed_adv, private, timestamp, lat, lon, conf=0, status=0, published=None):
+    """Encrypts a location report for the tag owning the given private key. published is when Apple received it,
+    the same as the timestamp unless given"""
+    tag_key = ec.derive_private_key(int.from_bytes(base64.b64decode(private), 'big'), ec.SECP224R1())
+    eph_key = ec.generate_private_key(ec.SECP224R1())
+    eph_bytes = eph_key.public_key().public_bytes(Encoding.X962, PublicFormat.UncompressedPoint)
+
+    shared_key = eph_key.exchange(ec.ECDH(), tag_key.public_key())
+    symmetric_key = hashlib.sha256(shared_key + b'\x00\x00\x00\x01' + eph_bytes).digest()
+    encryptor = Cipher(algorithms.AES(symmetric_key[:16]), modes.GCM(symmetric_key[16:])).encryptor()
+    enc_data = encryptor.update(struct.pack(">ii", int(lat * 10000000), int(lon * 10000000)) + bytes([conf, status])) + encryptor.finalize()
+
+    data = (timestamp - 978307200).to_bytes(4, 'big') + bytes([conf]) + eph_bytes + enc_data + encryptor.tag
+    published = published if published is not None else timestamp
+    return {'id': hashed_adv, 'datePublished': published * 1000, 'payload': base64.b64encode(data).decode()}
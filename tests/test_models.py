@@ -3,15 +3,64 @@ from unicodedata import category
 
 warnings.filterwarnings("ignore")
 
+import os
 import unittest
+from datetime import datetime, timedelta, timezone
 from app import create_app, db
-from app.main.models import Station, User, Bike, Ride, Report, Location, Fleet
+from app.main.models import Station, User, Bike, Ride, Report, Location, Fleet, BikePosition, TableVersion, FleetEvent, RetentionCutoff
+from app.main.map_details import get_bike_map_details
+from app.main.station_index import StationIndex, find_station
+from app.main.docking import dock_bikes
+from app.main.retention import compact_locations, archive_locations
+from app.main.archive import LocationArchive
+from app.main.search import search_condition, fts_ready, create_search_index, MIN_INDEXED_LENGTH
+from app.main.events import EventHub, MemoryEventBackend, DatabaseEventBackend, publish_event, get_event_hub, position_timestamps, publish_positions
+import tempfile
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from py_vapid import Vapid
+from cryptography.hazmat.primitives.asymmetric import ec
+from app.main.notifications import NotificationDispatcher, get_notification_dispatcher
+from app.main.geo import PolygonSet, polygon_contains, haversine, equirectangular, equirectangular_array, segment_lengths, path_length, simplify_path, encode_polyline
+import numpy as np
+from hayStacked.location_writer import LOCATION_UPSERT
 from config import Config
+import sqlalchemy as sqla
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     
+class PushServer(ThreadingHTTPServer):
+    # room for every worker to connect at once
+    request_queue_size = 64
+
+class PushHandler(BaseHTTPRequestHandler):
+    # stands in for a browser push service. While barrier is set a push is only answered once barrier.parties
+    # pushes are in flight together, and fails if they never are, so pushes sent one at a time can't pass
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    requests = []
+    barrier = None
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        with PushHandler.lock:
+            PushHandler.requests.append((self.path, self.client_address[1], self.headers['Authorization']))
+        status = 410 if self.path.startswith('/gone') else 201
+        if PushHandler.barrier is not None:
+            try:
+                PushHandler.barrier.wait()
+            except threading.BrokenBarrierError:
+                status = 500
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
 class TestModels(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
@@ -62,6 +111,132 @@ class TestModels(unittest.TestCase):
         self.assertFalse(s3.contains(Location(bike_id=0, latitude=0, longitude=0)), "v: lower left is outside")
         self.assertFalse(s3.contains(Location(bike_id=0, latitude=4, longitude=0)), "v: lower right is outside")
     
+    def test_station_index(self):
+        stations = [Station(id=1, name="s1", lat1=0, long1=0, lat2=0.002, long2=0, lat3=0.002, long3=0.002, lat4=0, long4=0.002),
+                    Station(id=2, name="s3", lat1=0, long1=0.004, lat2=0.002, long2=0.003, lat3=0.004, long3=0.004, lat4=0.002, long4=0),
+                    Station(id=3, name="far", lat1=42, long1=-72, lat2=42.001, long2=-72, lat3=42.001, long3=-71.999, lat4=42, long4=-71.999)]
+        db.session.add_all(stations)
+        db.session.commit()
+
+        index = StationIndex.from_database()
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.find(42.0005, -71.9995), 3)
+        self.assertIsNone(index.find(10, 10))
+
+        # the index gives the same answer as checking every station in order
+        for i in range(-5, 50):
+            for j in range(-5, 50):
+                point = Location(bike_id=0, latitude=i / 10000, longitude=j / 10000)
+                expected = next((station.id for station in stations if station.contains(point)), None)
+                self.assertEqual(index.find(point.latitude, point.longitude), expected, (i, j))
+
+        # a station with a mistyped corner spans tens of degrees, it is checked on every lookup instead of bucketed,
+        # and still loses to a lower numbered station that contains the point
+        typo = [[4.27, -71.81], [42.28, -71.81], [42.28, -71.80], [4.27, -71.80]]
+        large = StationIndex([(2, typo), (3, [[42.27, -71.81], [42.28, -71.81], [42.28, -71.80], [42.27, -71.80]]),
+                              (1, [[0, 0], [0.001, 0], [0.001, 0.001], [0, 0.001]])])
+        self.assertFalse(any(entry[0] == 2 for entries in large.cells.values() for entry in entries))
+        self.assertEqual([station[0] for station in large.oversized], [2])
+        self.assertEqual(large.find(42.275, -71.805), 2)
+        self.assertEqual(large.find(20, -71.805), 2)
+        self.assertEqual(large.find(0.0005, 0.0005), 1)
+        self.assertIsNone(large.find(20, -71.7))
+
+        # a station moved by another worker doesn't go through this app's listeners, the table version still
+        # tells the cached index to rebuild
+        self.assertEqual(find_station(42.0005, -71.9995), 3)
+        db.session.execute(sqla.update(Station).where(Station.id == 3).values(lat1=10, lat2=10.001, lat3=10.001, lat4=10))
+        TableVersion.bump(db.session.connection(), ['station'])
+        db.session.commit()
+        self.assertIsNone(find_station(42.0005, -71.9995))
+        self.assertEqual(find_station(10.0005, -71.9995), 3)
+
+    def test_table_versions(self):
+        versions = TableVersion.get_versions(['bike', 'station'])
+        # however many flushes a transaction makes, its tables are bumped once when it commits
+        db.session.add(Bike(name="WPI001", station_id=None, locked=True))
+        db.session.flush()
+        db.session.add(Bike(name="WPI002", station_id=None, locked=True))
+        db.session.flush()
+        self.assertEqual(TableVersion.get_versions(['bike', 'station']), versions)
+        db.session.commit()
+        self.assertEqual(TableVersion.get_versions(['bike', 'station']), {'bike': versions['bike'] + 1, 'station': versions['station']})
+
+        # changes that are rolled back aren't counted by the next commit
+        db.session.add(Bike(name="WPI003", station_id=None, locked=True))
+        db.session.flush()
+        db.session.rollback()
+        db.session.add(Station(name="Quad", lat1=0, long1=0, lat2=0, long2=0, lat3=0, long3=0, lat4=0, long4=0))
+        db.session.commit()
+        self.assertEqual(TableVersion.get_versions(['bike', 'station']), {'bike': versions['bike'] + 1, 'station': versions['station'] + 1})
+
+    def test_polygon_set(self):
+        polygons = [[[0, 0], [2, 0], [2, 2], [0, 2]],
+                    [[0, 4], [2, 3], [4, 4], [2, 0]],
+                    [[5, 5], [6, 7], [8, 6], [7.5, 4], [6, 3.5], [5.5, 4.5]],
+                    [[1, 1], [3, 1], [2, 3]]]
+        polygon_set = PolygonSet(polygons, [10, 20, 30, 40])
+
+        rng = np.random.default_rng(0)
+        lats, longs = rng.uniform(-1, 9, 2000), rng.uniform(-1, 9, 2000)
+        # split into small batches to check the chunked path gives the same result
+        polygon_set.MAX_CELLS = 100
+        inside = polygon_set.contains(lats, longs)
+        for i in range(len(lats)):
+            self.assertEqual(list(inside[i]), [polygon_contains(polygon, lats[i], longs[i]) for polygon in polygons])
+
+        # overlapping polygons go to the first one listed
+        self.assertEqual(list(polygon_set.locate([1.2, 2.8, 1.5, 6.5, 20], [1.1, 1.2, 2.5, 5.5, 20])), [10, 40, 20, 30, -1])
+        self.assertEqual(len(PolygonSet([]).locate([1], [1])), 1)
+
+        db.session.add(Station(name="s1", lat1=0, long1=0, lat2=2, long2=0, lat3=2, long3=2, lat4=0, long4=2))
+        db.session.commit()
+        self.assertEqual(list(Station.get_polygon_set().locate([1, 3], [1, 3])), [1, -1])
+
+    def test_distance(self):
+        # one degree of latitude, and a quarter of the way around the equator
+        self.assertAlmostEqual(haversine(0, 0, 1, 0), 111195, delta=1)
+        self.assertAlmostEqual(haversine(0, 0, 0, 90), 10007557, delta=1)
+        self.assertEqual(haversine(42.27, -71.81, 42.27, -71.81), 0)
+
+        # 50m apart on campus, the check startride uses
+        l1 = Location(bike_id=0, latitude=42.27390, longitude=-71.80572)
+        l2 = Location(bike_id=0, latitude=42.27390, longitude=-71.80511)
+        self.assertAlmostEqual(l1.distance_from(l2), 50.2, delta=0.1)
+        self.assertAlmostEqual(equirectangular(42.27390, -71.80572, 42.27390, -71.80511), l1.distance_from(l2), places=3)
+
+        rng = np.random.default_rng(0)
+        points = rng.uniform([42.2, -71.9], [42.3, -71.7], (500, 2))
+        lengths = segment_lengths(points)
+        self.assertEqual(len(lengths), 499)
+        for i in range(0, 499, 50):
+            self.assertAlmostEqual(lengths[i], haversine(*points[i], *points[i + 1]), places=6)
+        # the flat approximation is well under 0.1% off across a city
+        self.assertLess(abs(path_length(points, equirectangular_array) / path_length(points) - 1), 0.001)
+        self.assertEqual(path_length([]), 0)
+
+    def test_simplify_path(self):
+        # a 2km zigzag ride with a point every 2m, wobbling by up to 3m either side of the line
+        rng = np.random.default_rng(0)
+        latitudes = np.linspace(42.26, 42.278, 1000)
+        zigzag = -71.80 + 0.002 * np.abs(((np.arange(1000) // 250) % 2) - (np.arange(1000) % 250) / 250)
+        path = np.column_stack((latitudes, zigzag + rng.uniform(-3, 3, 1000) / 82000)).tolist()
+
+        simplified = simplify_path(path, tolerance=5)
+        self.assertLess(len(simplified), 50)
+        self.assertEqual(simplified[0], path[0])
+        self.assertEqual(simplified[-1], path[-1])
+        # the wobble is smoothed out, leaving close to the length of the zigzag itself
+        self.assertAlmostEqual(path_length(simplified) / path_length(np.column_stack((latitudes, zigzag))), 1, delta=0.02)
+
+        budget = simplify_path(path, tolerance=0, max_points=20)
+        self.assertEqual(len(budget), 20)
+        self.assertTrue(all(point in path for point in budget))
+        self.assertEqual(simplify_path(path[:2]), path[:2])
+        self.assertEqual(simplify_path([]), [])
+
+        self.assertEqual(encode_polyline([(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+
     def test_user_notifications(self):
         u1 = User(id='1', name="gompei", email="gompei@wpi.edu")
         db.session.add(u1)
@@ -231,6 +406,460 @@ class TestModels(unittest.TestCase):
         self.assertEqual(b1.get_current_location().latitude, l2.latitude)
         self.assertIsNone(b2.get_current_location())
 
+    def test_bike_position(self):
+        b1 = Bike(name = "WPI001", station_id = None, locked = True)
+        db.session.add(b1)
+        db.session.commit()
+
+        db.session.add(Location(bike_id=b1.id, latitude=1, longitude=0, timestamp=1763518449))
+        db.session.commit()
+        db.session.add(Location(bike_id=b1.id, latitude=0, longitude=0, timestamp=1763518447))
+        db.session.commit()
+
+        # an older location inserted later doesn't replace the newest position
+        position = db.session.get(BikePosition, b1.id)
+        self.assertEqual(position.latitude, 1)
+        self.assertEqual(position.timestamp, 1763518449)
+        self.assertEqual(b1.position.latitude, 1)
+
+        db.session.execute(sqla.delete(BikePosition))
+        db.session.commit()
+        self.assertIsNone(b1.get_current_location())
+
+        self.assertEqual(BikePosition.rebuild(), 1)
+        self.assertEqual(b1.get_current_location().timestamp, 1763518449)
+
+        # a position newer than anything left in the location table, after compaction or archiving, is kept unless
+        # the rebuild is full
+        db.session.execute(sqla.delete(Location).where(Location.timestamp == 1763518449))
+        db.session.commit()
+        self.assertEqual(BikePosition.rebuild(), 0)
+        self.assertEqual(b1.get_current_location().timestamp, 1763518449)
+        self.assertEqual(BikePosition.rebuild(full=True), 1)
+        self.assertEqual(b1.get_current_location().timestamp, 1763518447)
+
+    def test_event_hub(self):
+        for backend in [MemoryEventBackend(), DatabaseEventBackend(db.engine, poll_interval=0.01)]:
+            hub = EventHub(backend, read_timeout=0.05)
+            start = hub.last
+            hub.publish('bike', {'bike_id': 1, 'locked': True})
+            hub.publish('report', {'bike_id': 1, 'category': 2}, admin=True)
+            self.assertEqual([event.kind for event in hub.wait(start, 1)], ['bike', 'report'])
+
+            # admin only events are left out of rider streams, and a stream resumes after the id it is given
+            stream = list(hub.stream(start, admin=False, timeout=0.1, heartbeat=0.05))
+            self.assertEqual(stream[0], 'retry: 2000\n\n')
+            self.assertIn('id: {}\nevent: bike\ndata: {{"bike_id": 1, "locked": true}}\n\n'.format(start + 1), stream)
+            self.assertFalse(any('event: report' in message for message in stream))
+            self.assertIn(': keepalive\n\n', stream)
+            stream = ''.join(hub.stream(start + 1, admin=True, timeout=0.1, heartbeat=0.05))
+            self.assertNotIn('event: bike', stream)
+            self.assertIn('event: report', stream)
+            # the reader is stopped before anything else uses the database
+            hub.close()
+            self.assertFalse(hub.reader.is_alive())
+
+        # a stream from before the hub started, or from before what its buffer still holds, is replayed from the backend
+        for backend in [MemoryEventBackend(), DatabaseEventBackend(db.engine, poll_interval=0.01)]:
+            start = backend.last_id()
+            ids = [backend.publish('bike', {'bike_id': i}) for i in range(3)]
+            hub = EventHub(backend, size=2, read_timeout=0.05)
+            self.assertEqual([event.id for event in hub.wait(start, 1)], ids)
+            stream = ''.join(hub.stream(start, admin=True, timeout=0.1, heartbeat=0.05))
+            self.assertEqual([int(line[4:]) for line in stream.split('\n') if line.startswith('id: ')], ids)
+            ids += [hub.publish('bike', {'bike_id': i}) for i in range(3)]
+            self.assertEqual([event.id for event in hub.wait(ids[-1] - 1, 1)], ids[-1:])
+            self.assertEqual(hub.floor, ids[-3])
+            stream = ''.join(hub.stream(start, admin=True, timeout=0.1, heartbeat=0.05))
+            self.assertEqual([int(line[4:]) for line in stream.split('\n') if line.startswith('id: ')], ids)
+            hub.close()
+
+        # an id taken by a transaction that hasn't committed yet holds back the events after it, so they still go out in order
+        backend = DatabaseEventBackend(db.engine, poll_interval=0.01, settle=60)
+        start = backend.last_id()
+        ids = [backend.publish('bike', {'bike_id': i}) for i in range(3)]
+        table = FleetEvent.__table__
+        with db.engine.begin() as connection:
+            pending = connection.execute(sqla.select(table).where(table.c.id == ids[1])).one()
+            connection.execute(sqla.delete(table).where(table.c.id == ids[1]))
+        self.assertEqual([event.id for event in backend.read(start, 0.05)], ids[:1])
+        self.assertEqual(backend.read(ids[0], 0.05), [])
+        with db.engine.begin() as connection:
+            connection.execute(sqla.insert(table).values(**pending._asdict()))
+        self.assertEqual([event.id for event in backend.read(ids[0], 0.05)], ids[1:])
+        # one that never turns up was rolled back, and is passed over once it has been missing for settle seconds
+        backend.settle = 0
+        ids = [backend.publish('bike', {'bike_id': i}) for i in range(2)]
+        with db.engine.begin() as connection:
+            connection.execute(sqla.delete(table).where(table.c.id == ids[0]))
+        self.assertEqual([event.id for event in backend.read(ids[0] - 1, 0.05)], ids[1:])
+        self.assertEqual(backend.gaps, {})
+
+        # positions are published for the bikes whose newest position changed
+        db.session.add_all([BikePosition(bike_id=1, timestamp=100, latitude=1, longitude=1),
+                            BikePosition(bike_id=2, timestamp=200, latitude=2, longitude=2)])
+        db.session.commit()
+        before = position_timestamps(db.session.connection())
+        db.session.get(BikePosition, 1).timestamp = 150
+        db.session.commit()
+        backend = MemoryEventBackend()
+        self.assertEqual(publish_positions(backend, db.session.connection(), before), 1)
+        self.assertEqual(backend.events[0].data, {'bikes': [{'bike_id': 1, 'timestamp': 150, 'latitude': 1, 'longitude': 1}]})
+        self.assertTrue(backend.events[0].admin)
+
+        # events go out when the transaction they were published in commits, and not at all if it rolls back
+        self.app.config['EVENT_BACKEND'] = 'memory'
+        hub = get_event_hub()
+        start = hub.last
+        publish_event('bike', {'bike_id': 1})
+        db.session.rollback()
+        publish_event('ride', {'bike_id': 2})
+        self.assertEqual(hub.backend.last_id(), start)
+        db.session.commit()
+        self.assertEqual([event.kind for event in hub.wait(start, 1)], ['ride'])
+        hub.close()
+        self.assertFalse(hub.reader.is_alive())
+
+    def test_search_index(self):
+        self.assertTrue(fts_ready())
+        db.session.add_all([User(id="a", name="McGeorgeson, George", email="george@wpi.edu"),
+                            User(id="b", name="Pi, Gompei", email="gompei@wpi.edu"),
+                            Bike(id=5, name="WPI005", locked=True), Bike(id=6, name="WPI016", locked=True)])
+        db.session.commit()
+        db.session.add_all([Report(bike_id=5, user_id="a", category=3, description="Front tire is \"flat\""),
+                            Report(bike_id=6, user_id="b", category=1, description="Brakes squeak")])
+        db.session.commit()
+
+        def users(term):
+            return sorted(db.session.scalars(sqla.select(User.id).where(search_condition(term, users=True))).all())
+
+        def reports(term):
+            return sorted(db.session.scalars(sqla.select(Report.bike_id).join(User).join(Bike)
+                                             .where(search_condition(term, users=True, bikes=True, reports=True))).all())
+
+        # matches anywhere in any column and ignores case, like the LIKE search it replaces
+        self.assertEqual(users("eorge"), ["a"])
+        self.assertEqual(users("WPI.EDU"), ["a", "b"])
+        self.assertEqual(users(""), ["a", "b"])
+        self.assertEqual(users("nobody"), [])
+        self.assertEqual(reports("016"), [6])
+        self.assertEqual(reports('"flat"'), [5])
+        self.assertEqual(reports("squeak"), [6])
+        self.assertEqual(reports("Gompei"), [6])
+        # too short for a trigram, so this goes through LIKE
+        self.assertLess(len("ei"), MIN_INDEXED_LENGTH)
+        self.assertEqual(users("ei"), ["b"])
+
+        # the index follows updates and deletes
+        db.session.get(User, "a").name = "Renamed, Someone"
+        db.session.get(User, "a").email = "someone@example.com"
+        db.session.delete(db.session.scalar(sqla.select(Report).where(Report.bike_id == 6)))
+        db.session.commit()
+        self.assertEqual(users("eorge"), [])
+        self.assertEqual(users("example"), ["a"])
+        self.assertEqual(reports("squeak"), [])
+
+        # the rowids of tables without an integer primary key can change under the index, ex. with VACUUM or a restore
+        # from a dump, so the index is keyed on the real keys instead
+        db.session.execute(sqla.text('UPDATE "user" SET rowid = rowid + 100'))
+        db.session.execute(sqla.text('UPDATE report SET rowid = rowid + 100'))
+        db.session.commit()
+        self.assertEqual(users("gompei"), ["b"])
+        self.assertEqual(reports("flat"), [5])
+        db.session.add(Report(bike_id=6, user_id="b", category=1, description="Chain fell off"))
+        db.session.commit()
+        self.assertEqual(reports("chain"), [6])
+        # flask main build-search-index replaces the whole index and gives the same answers
+        create_search_index(db.session.connection(), rebuild=True)
+        db.session.commit()
+        self.assertEqual(users("gompei"), ["b"])
+        self.assertEqual(reports("chain"), [6])
+
+        # create_all runs before every request, with the index already there it only reads
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        sqla.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            db.create_all()
+        finally:
+            sqla.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertFalse([statement for statement in statements if '_search' in statement and not statement.lstrip().upper().startswith('SELECT')])
+        self.assertEqual(users("gompei"), ["b"])
+
+    def test_notification_dispatcher(self):
+        server = PushServer(('127.0.0.1', 0), PushHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        PushHandler.requests = []
+
+        vapid = Vapid(ec.generate_private_key(ec.SECP256R1()))
+        raw = vapid.private_key.private_numbers().private_value.to_bytes(32, 'big')
+        self.app.config['VAPID_PRIVATE_KEY'] = base64.urlsafe_b64encode(raw).decode().rstrip('=')
+        Fleet.get_fleet().contact_email = "gompei@wpi.edu"
+
+        # user 3 has unsubscribed since, and users 20 and 21 never subscribed
+        users = [User(id=str(i), name="user{}".format(i), email="user{}@wpi.edu".format(i)) for i in range(22)]
+        for i, user in enumerate(users[:20]):
+            user.notification_endpoint = "{}/{}/{}".format(url, "gone" if i == 3 else "push", i)
+            user.notification_p256dh_key = "BLv7r3fEORbv1XGq_KdzImkRRFyuYuIrbsRc9bag2v_taz_UxIjYfwibIvZDI0XIR9sXfy2Q7xwvxJtSJlocak0"
+            user.notification_auth_key = "CvBimGKvEPzdOS6oxqDLOQ"
+        db.session.add_all(users)
+        db.session.commit()
+
+        # the twenty pushes only get through four at a time together
+        PushHandler.barrier = threading.Barrier(4, timeout=5)
+        results = User.send_notifications(users, '{"title": "Hi", "body": "Return your bikes"}')
+        PushHandler.barrier = None
+
+        self.assertEqual([result.user_id for result in results], [user.id for user in users])
+        self.assertEqual([result.status for result in results], ['sent'] * 3 + ['expired'] + ['sent'] * 16 + ['no_keys'] * 2)
+        self.assertEqual(results[0].status_code, 201)
+        self.assertEqual(results[3].status_code, 410)
+        self.assertEqual(len(PushHandler.requests), 20)
+        # every push was signed with the same VAPID header, and went over no more connections than there are workers
+        self.assertEqual(len({authorization for path, port, authorization in PushHandler.requests}), 1)
+        self.assertTrue(PushHandler.requests[0][2].startswith("vapid t="))
+        self.assertLessEqual(len({port for path, port, authorization in PushHandler.requests}), self.app.config['NOTIFICATION_WORKERS'])
+
+        # the expired subscription is cleared, the others are kept
+        db.session.expire_all()
+        self.assertFalse(db.session.get(User, "3").has_notification_keys())
+        self.assertTrue(db.session.get(User, "4").has_notification_keys())
+
+        # the next message reuses the open connections
+        ports = {port for path, port, authorization in PushHandler.requests}
+        self.assertTrue(db.session.get(User, "0").send_notification("again"))
+        self.assertIn(PushHandler.requests[-1][1], ports)
+
+        # an unreachable push service only fails its own recipients
+        dispatcher = NotificationDispatcher(vapid, "gompei@wpi.edu", max_workers=2, timeout=1)
+        results = dispatcher.send([("a", "http://127.0.0.1:1/push", users[0].notification_p256dh_key, users[0].notification_auth_key),
+                                   ("b", url + "/push/b", users[0].notification_p256dh_key, users[0].notification_auth_key)], "hi")
+        self.assertEqual([result.status for result in results], ['failed', 'sent'])
+        self.assertIsNotNone(results[0].error)
+        self.assertIsNone(results[1].error)
+        dispatcher.close()
+
+        # without a VAPID key every push fails on its own, and nothing is sent
+        sent = len(PushHandler.requests)
+        results = NotificationDispatcher(None, "gompei@wpi.edu").send([("a", url + "/push/a", users[0].notification_p256dh_key, users[0].notification_auth_key)], "hi")
+        self.assertEqual(results, [('a', 'failed', None, 'WebPushException: VAPID_PRIVATE_KEY is not set')])
+        self.assertEqual(len(PushHandler.requests), sent)
+
+        # a push in flight when the contact email changes still goes out, and so does a send that started on the old one
+        old = get_notification_dispatcher("gompei@wpi.edu")
+        recipient = [("a", url + "/push/a", users[0].notification_p256dh_key, users[0].notification_auth_key)]
+        PushHandler.barrier = threading.Barrier(2, timeout=5)
+        in_flight = []
+        sender = threading.Thread(target=lambda: in_flight.extend(old.send(recipient, "hi")))
+        sender.start()
+        new = get_notification_dispatcher("bikes@wpi.edu")
+        self.assertIsNot(new, old)
+        PushHandler.barrier.wait()
+        PushHandler.barrier = None
+        sender.join()
+        self.assertEqual(in_flight[0].status, 'sent')
+        self.assertEqual(old.send(recipient, "hi")[0].status, 'sent')
+        new.close()
+        server.shutdown()
+        server.server_close()
+
+    def test_dock_bikes(self):
+        s1 = Station(name="s1", lat1=0, long1=0, lat2=2, long2=0, lat3=2, long3=2, lat4=0, long4=2)
+        s2 = Station(name="s2", lat1=4, long1=4, lat2=6, long2=4, lat3=6, long3=6, lat4=4, long4=6)
+        db.session.add_all([s1, s2])
+        db.session.commit()
+
+        parked = Bike(name="WPI001", station_id=None, locked=True)
+        moved = Bike(name="WPI002", station_id=s1.id, locked=True)
+        away = Bike(name="WPI003", station_id=s1.id, locked=True)
+        riding = Bike(name="WPI004", station_id=None, locked=False)
+        unseen = Bike(name="WPI005", station_id=None, locked=True)
+        db.session.add_all([parked, moved, away, riding, unseen])
+        db.session.commit()
+        riding.start_ride(1)
+
+        for bike, latitude in [(parked, 1), (moved, 5), (away, 10), (riding, 1)]:
+            db.session.add(Location(bike_id=bike.id, latitude=latitude, longitude=latitude, timestamp=1763518449))
+        db.session.commit()
+
+        self.assertEqual(dock_bikes(db.session.connection()), 2)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual([bike.station_id for bike in [parked, moved, away, riding, unseen]], [s1.id, s2.id, s1.id, None, None])
+
+        # nothing changes on the next run
+        self.assertEqual(dock_bikes(db.session.connection()), 0)
+
+        # a bike ridden from s1 and returned at s2 stays at s2, its last ping from s1 is older than the return
+        returned = db.session.get(Bike, parked.id)
+        ride = returned.start_ride(1)
+        ride.ride_date = datetime(2025, 11, 19, 2, 20)
+        ride.completed_ride = True
+        ride.duration = timedelta(minutes=10)
+        returned.station_id = s2.id
+        db.session.commit()
+        self.assertLess(1763518449, datetime(2025, 11, 19, 2, 30, tzinfo=timezone.utc).timestamp())
+        self.assertEqual(dock_bikes(db.session.connection()), 0)
+        db.session.commit()
+        self.assertEqual(db.session.get(Bike, parked.id).station_id, s2.id)
+
+        # a ping from after the return still docks it wherever it is now
+        db.session.add(Location(bike_id=parked.id, latitude=1, longitude=1, timestamp=1763520000))
+        db.session.commit()
+        self.assertEqual(dock_bikes(db.session.connection()), 1)
+        db.session.commit()
+        self.assertEqual(db.session.get(Bike, parked.id).station_id, s1.id)
+
+    def test_ride_path(self):
+        u1 = User(id='1', name="gompei", email="gompei@wpi.edu")
+        b1 = Bike(name="WPI001", station_id=None, locked=True)
+        db.session.add_all([u1, b1])
+        db.session.commit()
+
+        ride = b1.start_ride(u1.id)
+        start = int(ride.ride_date.replace(tzinfo=timezone.utc).timestamp())
+        # 100m north, a repeat of the same spot, then 100m north again
+        for i, latitude in enumerate([42.2700, 42.2709, 42.27090001, 42.2718]):
+            db.session.add(Location(bike_id=b1.id, latitude=latitude, longitude=-71.80, timestamp=start + 60 * i))
+        db.session.commit()
+
+        ride.completed_ride = True
+        ride.duration = timedelta(minutes=5)
+        ride.update_path()
+        db.session.commit()
+        self.assertAlmostEqual(ride.distance, 200.2, delta=0.1)
+        # the points in between lie on a straight line, so only the ends are kept for drawing
+        self.assertEqual(ride.path, [[42.27, -71.8], [42.2718, -71.8]])
+
+        # a report fetched after the ride ended is picked up by the next rebuild, one outside the window isn't
+        db.session.add(Location(bike_id=b1.id, latitude=42.2727, longitude=-71.80, timestamp=start + 300 + Ride.PATH_PADDING - 1))
+        db.session.add(Location(bike_id=b1.id, latitude=42.2800, longitude=-71.80, timestamp=start + 300 + Ride.PATH_PADDING + 1))
+        db.session.commit()
+        self.assertEqual(Ride.update_paths(datetime.now(timezone.utc) - timedelta(days=1), db.session.connection()), 1)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(ride.path, [[42.27, -71.8], [42.2727, -71.8]])
+        self.assertAlmostEqual(ride.distance, 300.3, delta=0.1)
+
+        # with nothing new the next rebuild writes nothing, so the ride table's version is left alone
+        version = TableVersion.get_versions(['ride'])['ride']
+        self.assertEqual(Ride.update_paths(datetime.now(timezone.utc) - timedelta(days=1), db.session.connection()), 0)
+        db.session.commit()
+        self.assertEqual(TableVersion.get_versions(['ride'])['ride'], version)
+
+    def test_compact_locations(self):
+        b1 = Bike(name="WPI001", station_id=None, locked=True)
+        b2 = Bike(name="WPI002", station_id=None, locked=True)
+        db.session.add_all([b1, b2])
+        db.session.commit()
+
+        # a ping every minute for an hour, 400 days ago, 40 days ago and an hour ago, for two bikes
+        now = 1763510400
+        for bike in [b1, b2]:
+            for age in [400 * 86400, 40 * 86400, 3600]:
+                for minute in range(60):
+                    db.session.add(Location(bike_id=bike.id, latitude=minute, longitude=0, timestamp=now - age + 60 * minute))
+        db.session.commit()
+
+        tiers = [(30, 300), (365, 3600)]
+        removed = compact_locations(tiers, now=now, full=True, window=3 * 3600)
+        self.assertEqual(removed, {30: 2 * (120 - 24), 365: 2 * (12 - 1)})
+
+        def count(age):
+            return db.session.scalar(sqla.select(sqla.func.count()).select_from(Location)
+                                     .where(Location.bike_id == b1.id)
+                                     .where(Location.timestamp >= now - age).where(Location.timestamp < now - age + 3600))
+        # one point per hour a year ago, one per 5 minutes a month ago, every point from today
+        self.assertEqual([count(400 * 86400), count(40 * 86400), count(3600)], [1, 12, 60])
+        # the earliest ping of each bucket is the one kept
+        self.assertEqual(sorted(l.latitude for l in b1.get_locations() if l.timestamp < now - 86400)[:4], [0, 0, 5, 10])
+
+        # running again finds nothing left to do, and without full only carries on from the last run's cutoffs
+        self.assertEqual(compact_locations(tiers, now=now, full=True), {30: 0, 365: 0})
+        self.assertEqual(compact_locations(tiers, now=now), {30: 0, 365: 0})
+        self.assertEqual(db.session.get(RetentionCutoff, 30).cutoff, now - 30 * 86400)
+
+        # pings that cross a tier's age while the job isn't run for weeks are still thinned by the next run
+        for minute in range(60):
+            db.session.add(Location(bike_id=b1.id, latitude=minute, longitude=0, timestamp=now - 25 * 86400 + 60 * minute))
+        db.session.commit()
+        self.assertEqual(compact_locations(tiers, now=now + 20 * 86400), {30: 60 - 12, 365: 0})
+
+    def test_location_archive(self):
+        b1 = Bike(name="WPI001", station_id=None, locked=True)
+        b2 = Bike(name="WPI002", station_id=None, locked=True)
+        db.session.add_all([b1, b2])
+        db.session.commit()
+
+        # pings every 10 days from mid January to the end of March 2024, 2024-01-15 is 1705276800
+        timestamps = [1705276800 + 10 * 86400 * i for i in range(8)]
+        for i, timestamp in enumerate(timestamps):
+            db.session.add(Location(bike_id=b1.id, latitude=42 + i / 1000, longitude=-71.8, timestamp=timestamp))
+        db.session.add(Location(bike_id=b2.id, latitude=1, longitude=1, timestamp=timestamps[0]))
+        db.session.commit()
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        archive = LocationArchive(tmp.name)
+        self.assertIsNone(archive.horizon())
+
+        # a month a run was interrupted in isn't marked complete, so it isn't read from the archive yet
+        archive.write('2024-01', b1.id, [(timestamps[0], 42, -71.8)])
+        self.assertIsNone(archive.horizon())
+
+        # January and February move out of the database, March stays
+        self.assertEqual(archive_locations(archive, '2024-03'), 6)
+        self.assertEqual(archive.months(), ['2024-01', '2024-02'])
+        self.assertEqual(archive.horizon(), 1709251200)
+
+        # the horizon stops at the first month that isn't complete, and a later run marks months it finds unmarked
+        os.remove(archive.marker('2024-02'))
+        self.assertEqual(archive.horizon(), 1706745600)
+        self.assertEqual(archive_locations(archive, '2024-03'), 0)
+        self.assertEqual(archive.horizon(), 1709251200)
+        self.assertEqual([l.timestamp for l in b1.get_locations()], timestamps[:4:-1])
+        self.assertEqual(len(b2.get_locations()), 0)
+
+        # reads inside one month are views onto the memory mapped file
+        records = archive.read(b1.id, timestamps[0], timestamps[1])
+        self.assertIsInstance(records, np.memmap)
+        self.assertEqual(list(records['timestamp']), timestamps[:2])
+        self.assertEqual(list(archive.read(b1.id, timestamps[0], timestamps[7])['timestamp']), timestamps[:5])
+        self.assertEqual(len(archive.read(b2.id, timestamps[3], timestamps[7])), 0)
+
+        # archiving rows a second time doesn't duplicate them
+        self.assertEqual(archive.write('2024-01', b1.id, [(timestamps[0], 0, 0)]), 2)
+        self.assertEqual(archive.read(b1.id, timestamps[0], timestamps[0])['latitude'][0], 42)
+
+        # ride paths read the archive for the months that aren't in the database anymore
+        self.app.config['LOCATION_ARCHIVE_DIR'] = tmp.name
+        path, distance = Ride.build_path(b1.id, timestamps[4], timestamps[7])
+        self.assertEqual([point[0] for point in path], [42.004, 42.007])
+        self.assertAlmostEqual(distance, haversine(42.004, -71.8, 42.007, -71.8))
+
+    def test_location_dedupe(self):
+        b1 = Bike(name = "WPI001", station_id = None, locked = True)
+        db.session.add(b1)
+        db.session.commit()
+
+        # databases created before the unique index can hold duplicate pings
+        for index in Location.__table__.indexes:
+            index.drop(db.engine)
+        for i in range(3):
+            db.session.add(Location(bike_id=b1.id, latitude=0, longitude=0, timestamp=1763518447))
+        db.session.add(Location(bike_id=b1.id, latitude=1, longitude=0, timestamp=1763518449))
+        db.session.commit()
+
+        self.assertEqual(Location.dedupe(), 2)
+        self.assertEqual(len(b1.get_locations()), 2)
+
+        # the index is back, so the ingest upsert skips pings that are already stored
+        ping = {'bike_id': b1.id, 'timestamp': 1763518449, 'latitude': 1, 'longitude': 0}
+        db.session.execute(LOCATION_UPSERT, [ping, ping])
+        db.session.commit()
+        self.assertEqual(len(b1.get_locations()), 2)
+
     def test_report_severity(self):
         u1 = User(id='1', name="gompei", email="gompei@wpi.edu")
         b1 = Bike(id=100, name="WPI100", station_id=None, locked=True)
@@ -245,5 +874,36 @@ class TestModels(unittest.TestCase):
         self.assertEqual(b1.get_report_severity(), 3)
         self.assertEqual(b2.get_report_severity(), -1)
 
+    def test_bike_map_details(self):
+        u1 = User(id='1', name="gompei", email="gompei@wpi.edu")
+        s1 = Station(name="s1", lat1=0, long1=0, lat2=2, long2=0, lat3=2, long3=2, lat4=0, long4=2)
+        db.session.add(u1)
+        db.session.add(s1)
+        db.session.commit()
+
+        b1 = Bike(id=100, name="WPI100", station_id=s1.id, locked=True)
+        b2 = Bike(id=101, name="WPI101", station_id=None, locked=False)
+        b3 = Bike(id=102, name="WPI102", station_id=s1.id, locked=True, available=False)
+        b4 = Bike(id=103, name="WPI103", station_id=s1.id, locked=True)
+        l1 = Location(bike_id=b1.id, latitude=0, longitude=0, timestamp=1763518447)
+        l2 = Location(bike_id=b1.id, latitude=1, longitude=1, timestamp=1763518449)
+        l3 = Location(bike_id=b2.id, latitude=2, longitude=2, timestamp=1763518440)
+        l4 = Location(bike_id=b3.id, latitude=3, longitude=3, timestamp=1763518441)
+        r1 = Report(bike_id=b1.id, category=4, user_id=u1.id, description="lock is stuck")
+        r2 = Report(bike_id=b1.id, category=4, user_id=u1.id, description="still stuck")
+        for item in [b1, b2, b3, b4, l1, l2, l3, l4, r1, r2]: db.session.add(item)
+        db.session.commit()
+
+        # admin map includes every bike, and should match each bike's own details
+        bikes = db.session.scalars(sqla.select(Bike).order_by(Bike.id)).all()
+        self.assertEqual(get_bike_map_details(public=False), [bike.get_details() if bike.get_current_location() else {} for bike in bikes])
+
+        # public map only includes docked, available bikes
+        details = get_bike_map_details(public=True)
+        self.assertEqual(len(details), 2)
+        self.assertEqual(details[0]['pos'], [1, 1])
+        self.assertEqual(details[0]['status'], '4')
+        self.assertEqual(details[1], {})
+
 if __name__ == '__main__':
     unittest.main(verbosity=1)
\ No newline at end of file
@@ -0,0 +1,339 @@
+import warnings
+
+warnings.filterwarnings("ignore")
+
+import json
+import os
+import tempfile
+import time
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, call, patch
+
+import sqlalchemy as sqla
+from sqlalchemy.pool import StaticPool
+
+from app import db
+from app.main.models import BikePosition
+import hayStacked.request_reports as request_reports_module
+import hayStackedInterface
+from hayStacked.keyring import Keyring
+from hayStacked.location_writer import LocationWriter, STAGING_CREATE, STAGING_COPY, STAGING_MOVE
+from hayStacked.pypush_gsa_icloud import AnisetteHeaders
+from hayStacked.request_reports import request_reports, build_search, get_watermarks, decrypt_reports
+from tests.synthetic_reports import generate_key, write_keyfile, encrypt_report
+from tests.benchmark_decrypt import build_jobs
+
+def serve(handler):
+    # starts a local HTTP server on a free port, standing in for a remote service
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+class AnisetteHandler(BaseHTTPRequestHandler):
+    requests = 0
+
+    def do_GET(self):
+        AnisetteHandler.requests += 1
+        body = json.dumps({"X-Apple-I-MD": "md{}".format(AnisetteHandler.requests), "X-Apple-I-MD-M": "machine"}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FetchHandler(BaseHTTPRequestHandler):
+    # stands in for Apple's fetch endpoint, answering each search with the reports published inside its window
+    reports = []
+    bodies = []
+    reject = 0
+    fail = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if FetchHandler.reject > 0 or FetchHandler.fail > 0:
+            status = 401 if FetchHandler.reject > 0 else 500
+            if status == 401:
+                FetchHandler.reject -= 1
+            else:
+                FetchHandler.fail -= 1
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        FetchHandler.bodies.append(body)
+        results = [report for search in body['search'] for report in FetchHandler.reports
+                   if report['id'] in search['ids'] and search['startDate'] <= report['datePublished'] <= search['endDate']]
+        response = json.dumps({'results': results, 'statusCode': '200'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+class TestRequestReports(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqla.create_engine('sqlite://', poolclass=StaticPool)
+        db.metadata.create_all(self.engine)
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.keysDir = os.path.join(self.tmp.name, 'keys')
+        os.mkdir(self.keysDir)
+        self.authFile = os.path.join(self.tmp.name, 'auth.json')
+        with open(self.authFile, 'w') as f:
+            json.dump({'dsid': 'dsid', 'searchPartyToken': 'token'}, f)
+
+        self.keys = {}
+        for name in ['100', '101']:
+            self.keys[name] = generate_key()
+            write_keyfile(self.keysDir, name, *self.keys[name])
+
+        self.now = int(time.time())
+
+        self.server, self.fetch_url = serve(FetchHandler)
+        FetchHandler.reports = []
+        FetchHandler.bodies = []
+        FetchHandler.reject = 0
+        FetchHandler.fail = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.tmp.cleanup()
+        self.engine.dispose()
+
+    def fetch(self, reports, **kwargs):
+        # runs request_reports against the local fetch endpoint, returns the searches sent and the number of reports decrypted
+        FetchHandler.reports = reports
+        FetchHandler.bodies = []
+        with patch.object(request_reports_module, 'generate_anisette_headers', return_value={}), \
+             patch.object(request_reports_module, 'decrypt', wraps=request_reports_module.decrypt) as decrypt:
+            result = request_reports(None, self.engine, self.authFile, self.keysDir, hours=24, fetch_url=self.fetch_url, **kwargs)
+        self.result = result
+        return [body['search'] for body in FetchHandler.bodies], decrypt.call_count
+
+    def locations(self):
+        with self.engine.connect() as connection:
+            return connection.execute(sqla.text("SELECT bike_id, timestamp FROM location ORDER BY timestamp")).all()
+
+    def test_build_search(self):
+        names = {'a': '100', 'b': '101', 'c': '102'}
+        search = build_search(names, {'100': 5000, '102': 500}, 1000, 9000)
+        self.assertEqual(search, [{'startDate': 1000000, 'endDate': 9000000, 'ids': ['b', 'c']},
+                                  {'startDate': 5001000, 'endDate': 9000000, 'ids': ['a']}])
+
+    def test_watermarks(self):
+        # two of the reports reach Apple a while after they were recorded, so they come back in the next fetch too
+        reports = [encrypt_report(*self.keys['100'], self.now - 600, 42.27, -71.80),
+                   encrypt_report(*self.keys['100'], self.now - 300, 42.28, -71.81, published=self.now - 200),
+                   encrypt_report(*self.keys['101'], self.now - 900, 42.29, -71.82, published=self.now - 100)]
+        searches, decrypted = self.fetch(reports)
+        self.assertEqual(len(searches), 1)
+        self.assertEqual(len(searches[0]), 1)
+        self.assertEqual(decrypted, 3)
+        self.assertEqual(len(self.locations()), 3)
+
+        with self.engine.connect() as connection:
+            self.assertEqual(get_watermarks(connection), {'100': self.now - 300, '101': self.now - 900})
+
+        # the next run only asks for newer reports, and skips decrypting anything already stored
+        reports.append(encrypt_report(*self.keys['101'], self.now - 60, 42.30, -71.83))
+        searches, decrypted = self.fetch(reports)
+        self.assertEqual([entry['startDate'] for entry in searches[0]], [(self.now - 899) * 1000, (self.now - 299) * 1000])
+        self.assertEqual(decrypted, 1)
+        self.assertEqual(self.result['skipped'], 2)
+        self.assertEqual(len(self.locations()), 4)
+
+    def test_decrypt_reports_parallel(self):
+        keyring, jobs = build_jobs(tags=3, reports=40)
+        serial = decrypt_reports(jobs, keyring)
+        self.assertEqual(len(serial), 40)
+        self.assertEqual(serial, sorted(serial, key=lambda tag: tag['timestamp']))
+        self.assertAlmostEqual(serial[0]['lat'], 42.27)
+
+        # the process pool returns the same tags in the same order
+        self.assertEqual(decrypt_reports(jobs, keyring, workers=2, batch_size=7), serial)
+
+    def test_keyring(self):
+        keyring = Keyring.load(self.keysDir)
+        self.assertEqual(len(keyring), 2)
+        self.assertEqual(sorted(keyring.names.values()), ['100', '101'])
+
+        # each key is only derived once
+        hashed_adv = self.keys['100'][0]
+        self.assertIs(keyring.private_key(hashed_adv), keyring.private_key(hashed_adv))
+
+    def test_ingest_service(self):
+        service = hayStackedInterface.IngestService('sqlite://', self.authFile, self.keysDir, interval=60, fetch_url=self.fetch_url)
+        db.metadata.create_all(service.engine)
+        self.assertEqual(service.health()['status'], 'starting')
+
+        FetchHandler.reports = [encrypt_report(*self.keys['100'], self.now - 600, 42.27, -71.80, published=self.now - 60)]
+        anisette = MagicMock(**{'poll.return_value': None})
+        with patch.object(hayStackedInterface, 'start_anisette', return_value=anisette) as start, \
+             patch.object(service, 'wait_for_anisette'), \
+             patch.object(service.session, 'post', wraps=service.session.post) as post, \
+             patch.object(request_reports_module, 'generate_anisette_headers', return_value={}):
+            service.run_cycle()
+            keyring = service.keyring
+            service.run_cycle()
+
+        # anisette, the keyring and the HTTP session are reused between cycles
+        self.assertEqual(start.call_count, 1)
+        self.assertIs(service.keyring, keyring)
+        self.assertEqual(post.call_count, 2)
+        anisette.terminate.assert_not_called()
+
+        health = service.health()
+        self.assertEqual(health['status'], 'ok')
+        self.assertEqual(health['cycles'], 2)
+        self.assertEqual(health['last_cycle']['reports']['skipped'], 1)
+        self.assertIn('decrypt', health['last_cycle']['timings'])
+        self.assertEqual(health['last_cycle']['reports']['docked'], 0)
+        self.assertIn('dock', health['last_cycle']['timings'])
+        self.assertEqual(health['last_cycle']['reports']['ride_paths'], 0)
+
+        # a cycle whose anisette headers are rejected is a failure, not an empty success
+        FetchHandler.reject = 100
+        with patch.object(request_reports_module, 'generate_anisette_headers', return_value={}), \
+             patch.object(request_reports_module, 'reset_headers'), \
+             patch.object(service.stopped, 'wait', side_effect=lambda timeout: service.stopped.set()):
+            service.run_forever()
+        health = service.health()
+        self.assertEqual(health['status'], 'failing')
+        self.assertEqual(health['failures'], 1)
+        self.assertIn('AnisetteError', health['last_error'])
+        self.assertEqual(health['cycles'], 2)
+
+        # so is one whose fetches fail with a server error
+        FetchHandler.reject = 0
+        FetchHandler.fail = 100
+        service.stopped.clear()
+        with patch.object(request_reports_module, 'generate_anisette_headers', return_value={}), \
+             patch.object(service.stopped, 'wait', side_effect=lambda timeout: service.stopped.set()):
+            service.run_forever()
+        health = service.health()
+        self.assertEqual(health['status'], 'failing')
+        self.assertEqual(health['failures'], 2)
+        self.assertIn('FetchError', health['last_error'])
+
+        service.stop()
+        anisette.terminate.assert_called_once()
+
+    def test_chunked_fetch(self):
+        for name in ['102', '103', '104']:
+            self.keys[name] = generate_key()
+            write_keyfile(self.keysDir, name, *self.keys[name])
+        reports = [encrypt_report(*self.keys[name], self.now - 60 * i, 42.27 + i / 1000, -71.80) for i, name in enumerate(sorted(self.keys))]
+
+        # five keys in chunks of two are fetched in three requests, and the result is the same as one request
+        FetchHandler.reject = 1
+        with patch.object(request_reports_module, 'reset_headers') as reset:
+            searches, decrypted = self.fetch(reports, chunk_size=2, fetch_threads=3)
+        reset.assert_called_once()
+        self.assertEqual(sorted(len(search[0]['ids']) for search in searches), [1, 2, 2])
+        self.assertEqual(decrypted, 5)
+        self.assertEqual(self.result['received'], 5)
+        self.assertEqual([int(bike_id) for bike_id, timestamp in self.locations()], [104, 103, 102, 101, 100])
+
+        # a chunk the endpoint fails on fails the run, once the other chunks are stored
+        newer = [encrypt_report(*self.keys[name], self.now - 30, 42.28, -71.80) for name in sorted(self.keys)]
+        FetchHandler.fail = 1
+        with self.assertRaises(request_reports_module.FetchError):
+            self.fetch(newer, chunk_size=2, fetch_threads=1)
+        self.assertEqual(len(self.locations()), 5 + 3)
+
+        # headers that are never accepted fail the run, and its connection is still closed
+        FetchHandler.reject = 100
+        connection = self.engine.connect()
+        with patch.object(request_reports_module, 'reset_headers'), \
+             patch.object(request_reports_module, 'generate_anisette_headers', return_value={}):
+            result = request_reports(None, MagicMock(**{'connect.return_value': connection}), self.authFile, self.keysDir,
+                                     fetch_url=self.fetch_url, chunk_size=2)
+        self.assertIsNone(result)
+        self.assertTrue(connection.closed)
+
+    def test_location_writer(self):
+        def tags():
+            # newest report for 100 arrives first, like an out of order chunk would
+            for i, timestamp in enumerate([900, 300, 600, 300, 120, 60, 30]):
+                yield {'key': '100' if i % 2 == 0 else '101', 'timestamp': self.now - timestamp,
+                       'lat': 42.27 + i / 1000, 'lon': -71.80, 'conf': i}
+
+        with self.engine.connect() as connection:
+            writer = LocationWriter(connection, batch_size=3)
+            with patch.object(writer, 'flush', wraps=writer.flush) as flush:
+                writer.write(tags())
+                # full batches are written as they fill, never holding more than one
+                self.assertEqual(flush.call_count, 2)
+                self.assertEqual(len(writer.batch), 1)
+                # the repeated (101, now - 300) report is only stored and counted once
+                self.assertEqual(writer.close(), 6)
+            connection.commit()
+
+            positions = connection.execute(sqla.text("SELECT bike_id, timestamp, confidence FROM bike_position ORDER BY bike_id")).all()
+        self.assertEqual(positions, [(100, self.now - 30, 6), (101, self.now - 60, 5)])
+        self.assertEqual(len(self.locations()), 6)
+
+        # a full run streams its tags through the same writer, newer than the positions stored above
+        reports = [encrypt_report(*self.keys['100'], self.now - i, 42.27, -71.80) for i in range(1, 6)]
+        self.fetch(reports, batch_size=2)
+        self.assertEqual(self.result['used'], 5)
+        self.assertEqual(len(self.locations()), 11)
+
+    def test_location_writer_copy(self):
+        # PostgreSQL batches go through COPY on the DBAPI cursor, stood in for here by a mock
+        cursor = MagicMock()
+        moved = iter([2, 1])
+        def execute(statement):
+            cursor.rowcount = next(moved) if statement == STAGING_MOVE else -1
+        cursor.execute.side_effect = execute
+        connection = MagicMock(**{'dialect.name': 'postgresql', 'connection.cursor.return_value': cursor})
+
+        writer = LocationWriter(connection, batch_size=3)
+        writer.write({'key': '100', 'timestamp': self.now - i, 'lat': 42.27, 'lon': -71.80 - i / 1000, 'conf': i} for i in range(4))
+        # the first batch had a row that was already stored, only the rows the move inserted are counted
+        self.assertEqual(writer.close(), 3)
+
+        self.assertEqual(cursor.execute.call_args_list,
+                         [call(STAGING_CREATE), call(STAGING_MOVE), call("TRUNCATE location_staging")] * 2)
+        self.assertEqual(cursor.copy_expert.call_count, 2)
+        statement, buffer = cursor.copy_expert.call_args_list[0].args
+        self.assertEqual(statement, STAGING_COPY)
+        self.assertEqual(buffer.getvalue(), ''.join(f"100\t{self.now - i}\t42.27\t{-71.80 - i / 1000!r}\n" for i in range(3)))
+        self.assertEqual(cursor.close.call_count, 2)
+
+        # the positions still go through SQLAlchemy, with the newest tag for the key
+        statement, positions = connection.execute.call_args.args
+        self.assertIs(statement, BikePosition.UPSERT)
+        self.assertEqual(positions, [{'bike_id': '100', 'timestamp': self.now, 'latitude': 42.27, 'longitude': -71.80, 'confidence': 0}])
+
+    def test_anisette_headers(self):
+        server, url = serve(AnisetteHandler)
+        AnisetteHandler.requests = 0
+        anisette = AnisetteHeaders(url, ttl=2, refresh_margin=1.5)
+        try:
+            self.assertEqual(anisette.get()['X-Apple-I-MD'], 'md1')
+            self.assertEqual(anisette.get()['X-Apple-I-MD'], 'md1')
+            self.assertEqual(AnisetteHandler.requests, 1)
+
+            # headers are refreshed in the background before they expire
+            time.sleep(1)
+            self.assertEqual(AnisetteHandler.requests, 2)
+            self.assertEqual(anisette.get()['X-Apple-I-MD'], 'md2')
+            self.assertEqual(AnisetteHandler.requests, 2)
+
+            anisette.reset()
+            self.assertEqual(anisette.get()['X-Apple-I-MD'], 'md3')
+        finally:
+            anisette.reset()
+            server.shutdown()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
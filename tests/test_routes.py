@@ -1,4 +1,5 @@
 import os
+import json
 import datetime
 import time
 import re
@@ -6,11 +7,15 @@ from datetime import timezone
 from urllib.parse import urlencode
 
 import pytest
+from contextlib import contextmanager
 from flask import jsonify
 import requests
 
 from app import create_app, db
 from app.main.models import User, Station, Bike, Ride, Location, Fleet, Report
+from app.main.station_index import find_station
+from app.admin.admin_routes import get_overview_counts
+from app.main.events import get_event_hub
 from config import Config
 from flask_login import login_user, current_user
 import sqlalchemy as sqla
@@ -22,6 +27,23 @@ class TestConfig(Config):
     WTF_CSRF_ENABLED = False
     DEBUG = True
     TESTING = True
+    EVENT_BACKEND = 'memory'
+    EVENT_STREAM_TIMEOUT = 0.3
+    EVENT_HEARTBEAT = 0.1
+
+
+@contextmanager
+def count_queries():
+    # counts the SQL statements sent to the database while the block runs
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sqla.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sqla.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
 
 
 @pytest.fixture(scope='module')
@@ -574,6 +596,43 @@ def test_return_success(test_client, init_database):
     assert DBbike.get_current_ride() is None
     assert DBbike.station.id == 1
 
+def test_return_stores_path(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN a ride with location history is ended through '/rental/<bike_id>/end'
+    THEN check that its distance and path are stored and served to the admin pages without reading locations again
+    """
+
+    bike = db.session.get(Bike, 100)
+    bike.station_id = None
+    ride = bike.start_ride(1)
+    start = int(ride.ride_date.replace(tzinfo=timezone.utc).timestamp())
+    for location in bike.get_locations():
+        db.session.delete(location)
+    for i, (latitude, longitude) in enumerate([(42.2700, -71.80), (42.2709, -71.80), (42.2709, -71.7988)]):
+        db.session.add(Location(latitude=latitude, longitude=longitude, bike_id=100, timestamp=start + 1 + i))
+    db.session.commit()
+
+    response = test_client.post('/rental/100/end',
+                                data=dict(rating='positive', lat=42.27387630416786, long=-71.80569690484587))
+    assert b"success" in response.data
+
+    ride = db.session.scalar(sqla.select(Ride).where(Ride.bike_id == 100))
+    assert round(ride.distance) == 199
+    assert len(ride.path) == 3
+
+    for location in bike.get_locations():
+        db.session.delete(location)
+    db.session.commit()
+    response = test_client.post('/admin/rides/path',
+                                json={"bike_id": 100, "start_time": ride.ride_date.isoformat(), "end_time": ride.ride_date.isoformat()})
+    assert response.json['path'] == ride.path
+    assert response.json['distance'] == 0.12
+
+    response = test_client.post('/admin/rides/filter',
+                                json={"search": "", "date": 0, "overtime": False, "completed": True})
+    assert [r['distance'] for r in response.json['result'] if r['start_time'] == ride.ride_date.isoformat()] == [0.12]
+
 def test_return_admin_success(test_client, init_database):
     """
     GIVEN a Flask application configured for testing
@@ -888,6 +947,34 @@ def test_edit_station_success(test_client, init_database):
     assert response.status_code == 200
     assert b"Updated station New Station" in response.data
 
+def test_edit_station_updates_return_zone(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN a station is moved through '/admin/fleet/station/<id>' after the station index was built
+    THEN check that bikes are only returned to the station's new area
+    """
+
+    founders = (42.27387630416786, -71.80569690484587)
+    assert find_station(*founders) == 1
+
+    test_client.post('/admin/fleet/station/1',
+        follow_redirects=True,
+        data=dict(name="Moved", lat1=10, long1=10, lat2=11, long2=10, lat3=11, long3=11, lat4=10, long4=11))
+    assert find_station(*founders) is None
+
+    bike = db.session.get(Bike, 100)
+    bike.station_id = None
+    bike.start_ride(1)
+    db.session.add(bike)
+    db.session.commit()
+
+    response = test_client.post('/rental/100/end', data=dict(rating='positive', lat=founders[0], long=founders[1]))
+    assert b"error-too-far-station" in response.data
+
+    response = test_client.post('/rental/100/end', data=dict(rating='positive', lat=10.5, long=10.5))
+    assert b"success" in response.data
+    assert db.session.get(Bike, 100).station_id == 1
+
 def test_edit_station_fail_nonexistant(test_client, init_database):
     """
     GIVEN a Flask application configured for testing
@@ -961,6 +1048,234 @@ def test_map_response_data(test_client, init_database):
     station1 = db.session.get(Station, 1)
     assert station1.name in str(response.data)
 
+def test_map_response_query_count(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the map data is requested for a small and a large fleet
+    THEN check that the number of queries does not grow with the number of bikes
+    """
+
+    with count_queries() as small_fleet:
+        response = test_client.post('/mapDetails', data=dict(), follow_redirects=True)
+    assert response.status_code == 200
+    with count_queries() as small_fleet_admin:
+        response = test_client.post('/admin/assets/mapDetails', data=dict(), follow_redirects=True)
+    assert response.status_code == 200
+
+    for i in range(20):
+        db.session.add(Bike(id=200 + i, name="WPI{}".format(200 + i), station_id=1, locked=True))
+        db.session.add(Location(latitude=42, longitude=-72, bike_id=200 + i, timestamp=1763518447 + i))
+        db.session.add(Report(bike_id=200 + i, user_id="2", category=i % 3, description="flat tire"))
+    db.session.commit()
+
+    with count_queries() as large_fleet:
+        response = test_client.post('/mapDetails', data=dict(), follow_redirects=True)
+    assert response.status_code == 200
+    assert len(response.json['bikes']) == 21
+    assert len(large_fleet) == len(small_fleet)
+
+    with count_queries() as large_fleet_admin:
+        response = test_client.post('/admin/assets/mapDetails', data=dict(), follow_redirects=True)
+    assert response.status_code == 200
+    assert len(response.json['bikes']) == 24
+    assert len(large_fleet_admin) == len(small_fleet_admin)
+
+def test_admin_filter_query_count(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the admin rides, reports and users tables are requested for a few rows and for many
+    THEN check that each table is built with the same two queries however many rows it has
+    """
+
+    filters = [('/admin/rides/filter', {"search": "", "date": 0, "overtime": False, "completed": True}),
+               ('/admin/reports/filter', {"search": "", "category": 1, "completed": False}),
+               ('/admin/users/filter', {"search": "", "admin": False, "banned": False})]
+
+    def table_queries():
+        # loads the logged in user first, so only the tables' own queries are counted
+        test_client.get('/admin/overview')
+        counts = []
+        for url, body in filters:
+            with count_queries() as statements:
+                response = test_client.post(url, json=body)
+            assert response.status_code == 200
+            counts.append((len(response.json['result']), len(statements)))
+        return counts
+
+    few = table_queries()
+
+    for i in range(20):
+        db.session.add(User(id=str(10 + i), name="Tester, Number{}".format(i), email="tester{}@wpi.edu".format(i)))
+        db.session.add(Ride(bike_id=100 + i % 2, user_id=str(10 + i), completed_ride=True, positive_rating=True,
+                            ride_date=datetime.datetime.now(timezone.utc) - datetime.timedelta(hours=i + 1), duration=datetime.timedelta(minutes=20)))
+        db.session.add(Report(bike_id=100 + i % 2, user_id=str(10 + i), category=1, description="flat tire"))
+    db.session.commit()
+    many = table_queries()
+
+    for (few_rows, few_queries), (many_rows, many_queries) in zip(few, many):
+        assert many_rows >= few_rows + 20
+        # the version check, then the table itself
+        assert many_queries == few_queries == 2
+
+def test_admin_filter_not_modified(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN an admin table is polled again with the version it was last sent
+    THEN check that it answers 304 until the rows it shows change
+    """
+
+    users = {"search": "", "admin": False, "banned": False}
+    response = test_client.post('/admin/users/filter', json=users)
+    assert response.status_code == 200
+    version = response.json['version']
+    assert response.headers['ETag'] == '"{}"'.format(version)
+
+    response = test_client.post('/admin/users/filter', json=dict(users, since=version))
+    assert response.status_code == 304
+    assert response.data == b""
+    response = test_client.post('/admin/users/filter', json=users, headers={'If-None-Match': '"{}"'.format(version)})
+    assert response.status_code == 304
+
+    # every page of the same view shares its version, other filters are a different view of the table
+    assert test_client.post('/admin/users/filter', json=dict(users, limit=1)).json['version'] == version
+    response = test_client.post('/admin/users/filter', json=dict(users, descending=True, since=version))
+    assert response.status_code == 200
+    response = test_client.post('/admin/users/filter', json=dict(users, search="Gina", since=version))
+    assert response.status_code == 200
+
+    # a report doesn't change the users table, banning a user does
+    db.session.add(Report(bike_id=100, user_id="2", category=1, description="flat tire"))
+    db.session.commit()
+    response = test_client.post('/admin/users/filter', json=dict(users, since=version))
+    assert response.status_code == 304
+    test_client.post('/admin/users/toggle/banned?' + urlencode({"user_id": "2"}))
+    response = test_client.post('/admin/users/filter', json=dict(users, since=version))
+    assert response.status_code == 200
+    assert response.json['version'] != version
+
+    reports = {"search": "", "category": "0", "completed": False}
+    version = test_client.post('/admin/reports/filter', json=reports).json['version']
+    assert test_client.post('/admin/reports/filter', json=dict(reports, since=version)).status_code == 304
+    test_client.post('/admin/reports/toggle/report?' + urlencode({"bike_id": 100, "user_id": "2", "timestamp": db.session.scalar(sqla.select(Report.timestamp)).isoformat()}))
+    assert test_client.post('/admin/reports/filter', json=dict(reports, since=version)).status_code == 200
+
+    # ride paths are written without the ORM, and still count as a change
+    rides = {"search": "", "date": 0, "overtime": False, "completed": True}
+    version = test_client.post('/admin/rides/filter', json=rides).json['version']
+    Ride.update_paths(since=datetime.datetime(2000, 1, 1))
+    db.session.commit()
+    assert test_client.post('/admin/rides/filter', json=dict(rides, since=version)).status_code == 200
+
+def test_events_stream(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN a bike is taken out of service and the event stream is opened from before that
+    THEN check that the stream sends the change as a server sent event
+    """
+
+    start = get_event_hub().backend.last_id()
+    response = test_client.post('/admin/reports/toggle/bike?' + urlencode({"bike_id": 100}))
+    assert response.json['available'] == False
+
+    response = test_client.get('/admin/events', headers={'Last-Event-ID': str(start)})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    messages = response.get_data(as_text=True).split('\n\n')
+    assert messages[0] == 'retry: 2000'
+    bike = next(message for message in messages if 'event: bike' in message)
+    assert bike.startswith('id: {}\n'.format(start + 1))
+    data = json.loads(bike.split('data: ', 1)[1])
+    assert data == {'bike_id': 100, 'locked': True, 'available': False, 'station_id': 1}
+
+    # the riders' map gets the same change from its own stream
+    messages = test_client.get('/events', headers={'Last-Event-ID': str(start)}).get_data(as_text=True)
+    assert 'event: bike' in messages
+
+    # a stream opened without an id only gets what happens after it starts
+    messages = test_client.get('/admin/events').get_data(as_text=True)
+    assert 'event: bike' not in messages
+    assert ': keepalive' in messages
+
+    # marking a report done is pushed to the admins' report tables
+    db.session.add(Report(bike_id=100, user_id="2", category=1, description="flat tire"))
+    db.session.commit()
+    start = get_event_hub().backend.last_id()
+    test_client.post('/admin/reports/toggle/report?' + urlencode({"bike_id": 100, "user_id": "2", "timestamp": db.session.scalar(sqla.select(Report.timestamp)).isoformat()}))
+    messages = test_client.get('/admin/events', headers={'Last-Event-ID': str(start)}).get_data(as_text=True)
+    assert 'event: report' in messages
+    # but not to the riders, whose stream leaves out the admin only events
+    messages = test_client.get('/events', headers={'Last-Event-ID': str(start)}).get_data(as_text=True)
+    assert 'event: report' not in messages
+
+    # distances rebuilt after a ride ended are pushed to the admins' rides tables
+    start = get_event_hub().backend.last_id()
+    assert Ride.update_paths(since=datetime.datetime(2000, 1, 1)) > 0
+    db.session.commit()
+    messages = test_client.get('/admin/events', headers={'Last-Event-ID': str(start)}).get_data(as_text=True)
+    ride = next(message for message in messages.split('\n\n') if 'event: ride' in message)
+    assert json.loads(ride.split('data: ', 1)[1])['action'] == 'path'
+
+def test_admin_filter_pagination(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the admin rides and users tables are walked through a page at a time
+    THEN check that every row comes back exactly once, in order, and that bad cursors are rejected
+    """
+
+    for i in range(12):
+        db.session.add(User(id=str(10 + i), name="Tester, Number{:02d}".format(i), email="tester{}@wpi.edu".format(i)))
+        db.session.add(Ride(bike_id=100 + i % 2, user_id=str(10 + i), completed_ride=True, positive_rating=True, distance=i % 3,
+                            ride_date=datetime.datetime.now(timezone.utc) - datetime.timedelta(hours=i + 1), duration=datetime.timedelta(minutes=20)))
+    db.session.commit()
+
+    def walk(url, body, limit):
+        rows, cursor, pages = [], None, 0
+        while True:
+            response = test_client.post(url, json=dict(body, limit=limit, cursor=cursor))
+            assert response.status_code == 200
+            assert len(response.json['result']) <= limit
+            rows += response.json['result']
+            cursor = response.json['next_cursor']
+            pages += 1
+            if cursor is None:
+                return rows, pages
+
+    rides = {"search": "", "date": 0, "overtime": False, "completed": True}
+    everything = test_client.post('/admin/rides/filter', json=dict(rides, limit=500)).json
+    assert everything['next_cursor'] is None
+    assert len(everything['result']) >= 12
+
+    rows, pages = walk('/admin/rides/filter', rides, 5)
+    assert rows == everything['result']
+    assert pages == -(-len(rows) // 5)
+    assert [row['start_time'] for row in rows] == sorted(row['start_time'] for row in rows)
+
+    rows, _ = walk('/admin/rides/filter', dict(rides, sort='date', descending=True), 4)
+    assert rows == everything['result'][::-1]
+
+    # ties on the sort column are split by the primary key, so no ride is skipped or repeated
+    rows, _ = walk('/admin/rides/filter', dict(rides, sort='distance'), 3)
+    assert sorted((row['bike_id'], row['start_time']) for row in rows) == sorted((row['bike_id'], row['start_time']) for row in everything['result'])
+    assert [row['distance'] for row in rows] == sorted(row['distance'] for row in rows)
+
+    users, _ = walk('/admin/users/filter', {"search": "Tester", "admin": False, "banned": False}, 5)
+    assert [user['user_id'] for user in users] == [str(10 + i) for i in range(12)]
+
+    # a cursor only continues the sort it came from
+    cursor = test_client.post('/admin/rides/filter', json=dict(rides, limit=2)).json['next_cursor']
+    response = test_client.post('/admin/rides/filter', json=dict(rides, limit=2, cursor=cursor, sort='bike'))
+    assert response.status_code == 400
+    response = test_client.post('/admin/rides/filter', json=dict(rides, cursor="not a cursor"))
+    assert response.status_code == 400
+    response = test_client.post('/admin/rides/filter', json=dict(rides, sort='rating'))
+    assert response.status_code == 400
+
+    # malformed paging fields are rejected the same way instead of being guessed at
+    for bad in [dict(descending="false"), dict(descending=1), dict(limit=[5]), dict(limit={"n": 5}), dict(limit="five"), dict(cursor=[1])]:
+        response = test_client.post('/admin/rides/filter', json=dict(rides, **bad))
+        assert response.status_code == 400, bad
+
 def test_map_page(test_client, init_database):
     response = test_client.get('/home', follow_redirects=True)
     assert response.status_code == 200
@@ -1179,6 +1494,70 @@ def test_get_admin_rides(test_client, init_database):
     assert response.status_code == 200
     assert b"Bike Statistics:" in response.data
 
+def test_ride_path_distance(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/admin/rides/path' endpoint is requested (POST) for a ride
+    THEN check that the path length is measured along the ground in miles
+    """
+
+    start = datetime.datetime(2025, 11, 18, 12, 0)
+    # 0.01 degrees of latitude north, then 0.01 degrees of longitude east at 42 degrees north
+    for i, (lat, long) in enumerate([(42.27, -71.81), (42.275, -71.81), (42.28, -71.81), (42.28, -71.80)]):
+        db.session.add(Location(latitude=lat, longitude=long, bike_id=100, timestamp=int(start.replace(tzinfo=timezone.utc).timestamp()) + 60 * i))
+    db.session.commit()
+
+    window = {"bike_id": 100, "start_time": start.isoformat(), "end_time": (start + datetime.timedelta(minutes=5)).isoformat()}
+    response = test_client.post('/admin/rides/path', json=window)
+    assert response.status_code == 200
+    # the middle point of the straight leg is simplified away, but still counts towards the distance of 1112m + 823m
+    assert response.json['path'] == [[42.27, -71.81], [42.28, -71.81], [42.28, -71.80]]
+    assert response.json['distance'] == 1.2
+
+    response = test_client.post('/admin/rides/path', json=dict(window, max_points=2, encoding='polyline'))
+    assert response.json['polyline'] == 'oz~`GnkhuLo}@o}@'
+    assert response.json['points'] == 2
+    assert 'path' not in response.json
+
+    # a tolerance of 0 is below the one paths are stored at, so it gives back the same path instead of the default
+    assert test_client.post('/admin/rides/path', json=dict(window, tolerance=0)).json['points'] == 3
+    assert test_client.post('/admin/rides/path', json=dict(window, tolerance=2000)).json['points'] == 2
+    assert test_client.post('/admin/rides/path', json=dict(window, tolerance='fine')).status_code == 400
+    assert test_client.post('/admin/rides/path', json=dict(window, tolerance=-1)).status_code == 400
+
+    # locations reported more than 15 minutes after the ride ended aren't part of it
+    db.session.add(Location(latitude=42.29, longitude=-71.80, bike_id=100, timestamp=int(start.replace(tzinfo=timezone.utc).timestamp()) + 60 * 21))
+    db.session.commit()
+    assert test_client.post('/admin/rides/path', json=window).json['distance'] == 1.2
+
+def test_admin_overview(test_client, init_database):
+    """
+    GIVEN a Flask application configured for testing
+    WHEN the '/admin/overview' endpoint is requested (GET)
+    THEN check that every counter is computed in a single query and the response can be cached
+    """
+
+    db.session.add(Ride(bike_id = 101, user_id = "2", completed_ride = False, positive_rating = False))
+    db.session.add(Ride(bike_id = 100, user_id = "3", ride_date = datetime.datetime.now(timezone.utc) - datetime.timedelta(days=40), completed_ride = True, positive_rating = False))
+    db.session.add(Report(bike_id = 100, user_id = "2", description = "flat", completed = False))
+    db.session.add(Report(bike_id = 101, user_id = "2", description = "old", completed = True, timestamp = datetime.datetime.now(timezone.utc) - datetime.timedelta(days=40)))
+    db.session.commit()
+
+    with count_queries() as statements:
+        counts = get_overview_counts()
+    assert len(statements) == 1
+    assert counts == {'num_reports': 1, 'reports_month': 1, 'num_trips': 1, 'rides_month': 1, 'bikes_out': 1}
+
+    response = test_client.get('/admin/overview')
+    assert response.status_code == 200
+    assert 'max-age' in response.headers['Cache-Control']
+    assert sorted(response.json['broken_bikes']) == ['WPI100', 'WPI101']
+    assert response.json['num_trips'] == 1
+
+    # the table endpoint no longer recomputes the dashboard
+    response = test_client.post('/admin/rides/filter', json={"search": "", "date": 0, "overtime": False, "completed": False})
+    assert 'num_reports' not in response.json
+
 def test_filter_no_searchbar_admin_rides(test_client, init_database):
     # add rides
 
@@ -1217,6 +1596,7 @@ def test_filter_no_searchbar_admin_rides(test_client, init_database):
         assert data['result'][i]['user_name'] == db.session.get(User, db_data[i].user_id).get_first_name()
 
     # checks the page data is accurate
+    data = test_client.get('/admin/overview').json
     assert data['num_reports'] == 0
     assert data['rides_month'] == 5
     assert data['broken_bikes'] == []
@@ -1259,6 +1639,7 @@ def test_filter_searchbar_admin_rides(test_client, init_database):
     assert data['result'][0]['user_name'] == db.session.get(User, db_data.user_id).get_first_name()
 
     # checks the page data is accurate
+    data = test_client.get('/admin/overview').json
     assert data['num_reports'] == 0
     assert data['rides_month'] == 5
     assert data['broken_bikes'] == []